@@ -0,0 +1,222 @@
+"""
+Archive of snapshots taken on many hosts, storing every distinct load option only once.
+
+Most Boot#### variables of a fleet are byte-identical (same shim path, same partition GUIDs in a
+disk image family) and so are whole configurations of hosts installed from the same image. Both
+are stored once, content-addressed, and referenced by the history of every host:
+
+    blobs/<first 2 hex digits>/<rest of the SHA-256>    raw load options
+    configs/<first 2 hex digits>/<snapshot digest>.json attributes and blob hash of every
+                                                        variable, the data of BootOrder, BootNext
+                                                        and Timeout in hex
+    hosts/<host>.jsonl                                  one line per snapshot of the host: time,
+                                                        label and digest of the configuration
+    index.json                                          blob hash -> hosts having it
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+from collections.abc import Iterable
+
+from efiboots.efivarfs import boot_entry_regex
+from efiboots.loadoption import parse_load_option
+from efiboots.snapshot import Snapshot, SnapshotVariable
+
+CONFIG_FORMAT = 1
+HISTORY_SUFFIX = '.jsonl'
+
+
+def blob_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def host_file_name(host: str) -> str:
+    """:return: host made safe to use as a file name"""
+    return re.sub(r'[^A-Za-z0-9._-]', '_', host).lstrip('.') or 'unknown'
+
+
+def write_atomically(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def dump_json(value) -> bytes:
+    return json.dumps(value, separators=(',', ':'), sort_keys=True).encode()
+
+
+class SnapshotArchive:
+    log = logging.getLogger('SnapshotArchive')
+
+    def __init__(self, path: str):
+        self.path = path
+        self._index = None
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.path, 'blobs', digest[:2], digest[2:])
+
+    def config_path(self, digest: str) -> str:
+        return os.path.join(self.path, 'configs', digest[:2], f'{digest}.json')
+
+    def history_path(self, host: str) -> str:
+        return os.path.join(self.path, 'hosts', host_file_name(host) + HISTORY_SUFFIX)
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.path, 'index.json')
+
+    @property
+    def index(self) -> dict[str, list[str]]:
+        """Hash of every blob -> sorted hosts having it in at least one snapshot"""
+        if self._index is None:
+            try:
+                with open(self.index_path) as f:
+                    self._index = json.load(f)
+            except FileNotFoundError:
+                self._index = {}
+        return self._index
+
+    def _store_blob(self, data: bytes) -> str:
+        digest = blob_hash(data)
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            write_atomically(path, data)
+        return digest
+
+    def load_blob(self, digest: str) -> bytes:
+        """:raise ValueError: if the blob doesn't match its hash."""
+        with open(self.blob_path(digest), 'rb') as f:
+            data = f.read()
+        if blob_hash(data) != digest:
+            raise ValueError(f"blob {digest} is corrupted")
+        return data
+
+    def _store_config(self, snapshot: Snapshot, digest: str):
+        path = self.config_path(digest)
+        if os.path.exists(path):
+            return
+        variables = {}
+        for name, variable in snapshot.variables.items():
+            if boot_entry_regex.match(name):
+                variables[name] = {'attributes': variable.attributes, 'blob': self._store_blob(variable.data)}
+            else:
+                variables[name] = {'attributes': variable.attributes, 'data': variable.data.hex()}
+        write_atomically(path, dump_json({'format': CONFIG_FORMAT, 'variables': variables}))
+
+    def hosts(self) -> list[str]:
+        try:
+            names = os.listdir(os.path.join(self.path, 'hosts'))
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-len(HISTORY_SUFFIX)] for name in names if name.endswith(HISTORY_SUFFIX))
+
+    def history(self, host: str) -> list[dict]:
+        """:return: time, label and configuration digest of every snapshot of host, oldest first"""
+        try:
+            with open(self.history_path(host)) as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def add(self, snapshot: Snapshot, host: str | None = None) -> str:
+        """:return: the digest of the configuration, see add_many()."""
+        return self.add_many([snapshot], host)[0]
+
+    def add_many(self, snapshots: Iterable[Snapshot], host: str | None = None) -> list[str]:
+        """
+        Stores snapshots for host (the one each was taken on by default). A snapshot holding the
+        same variables as the latest one of its host is not added again. The index is written
+        once at the end.
+        :return: the digests of the configurations.
+        """
+        digests = []
+        index_changed = False
+        for snapshot in snapshots:
+            snapshot_host = host_file_name(host or snapshot.host)
+            digest = snapshot.digest
+            digests.append(digest)
+            history = self.history(snapshot_host)
+            if history and history[-1]['digest'] == digest:
+                continue
+            self._store_config(snapshot, digest)
+            os.makedirs(os.path.dirname(self.history_path(snapshot_host)), exist_ok=True)
+            with open(self.history_path(snapshot_host), 'ab') as f:
+                f.write(dump_json({'created': snapshot.created, 'label': snapshot.label, 'digest': digest}) + b'\n')
+            for name, variable in snapshot.variables.items():
+                if not boot_entry_regex.match(name):
+                    continue
+                hosts = self.index.setdefault(blob_hash(variable.data), [])
+                if snapshot_host not in hosts:
+                    hosts.append(snapshot_host)
+                    hosts.sort()
+                    index_changed = True
+            self.log.info("Archived snapshot %s of %s", digest[:16], snapshot_host)
+        if index_changed:
+            write_atomically(self.index_path, dump_json(self.index))
+        return digests
+
+    def load(self, digest: str, record: dict | None = None, host: str = '') -> Snapshot:
+        """
+        :param record: the entry of history() the snapshot is loaded for, to restore its time and label.
+        :raise ValueError: if the configuration or one of its blobs is corrupted.
+        """
+        with open(self.config_path(digest)) as f:
+            config = json.load(f)
+        if config.get('format') != CONFIG_FORMAT:
+            raise ValueError(f"unsupported configuration format {config.get('format')}")
+        variables = {}
+        for name, variable in config['variables'].items():
+            data = self.load_blob(variable['blob']) if 'blob' in variable else bytes.fromhex(variable['data'])
+            variables[name] = SnapshotVariable(variable['attributes'], data)
+        snapshot = Snapshot(variables, host=host)
+        if record is not None:
+            snapshot.created, snapshot.label = record['created'], record['label']
+        if snapshot.digest != digest:
+            raise ValueError(f"configuration {digest} is corrupted")
+        return snapshot
+
+    def latest(self, host: str) -> Snapshot | None:
+        history = self.history(host)
+        if not history:
+            return None
+        return self.load(history[-1]['digest'], history[-1], host)
+
+    def hosts_with(self, digest: str) -> list[str]:
+        """:return: the hosts having the load option with the given hash in one of their snapshots"""
+        return self.index.get(digest, [])
+
+    def find_blobs(self, prefix: str) -> list[str]:
+        """:return: the hashes of the blobs starting with prefix"""
+        return sorted(digest for digest in self.index if digest.startswith(prefix))
+
+    def describe_blob(self, digest: str) -> str:
+        """:return: the label and loader of the load option with the given hash"""
+        try:
+            load_option = parse_load_option(self.load_blob(digest))
+        except (OSError, ValueError) as e:
+            return f"unreadable: {e}"
+        return f"{load_option.description}\t{load_option.file_path or ''}"
+
+    def rebuild_index(self):
+        """Recomputes the index from the histories of all hosts, e.g. after editing some of them"""
+        index = {}
+        blobs_of_configs = {}
+        for host in self.hosts():
+            for record in self.history(host):
+                digest = record['digest']
+                if digest not in blobs_of_configs:
+                    with open(self.config_path(digest)) as f:
+                        variables = json.load(f)['variables'].values()
+                    blobs_of_configs[digest] = [variable['blob'] for variable in variables if 'blob' in variable]
+                for blob in blobs_of_configs[digest]:
+                    hosts = index.setdefault(blob, [])
+                    if host not in hosts:
+                        hosts.append(host)
+        for hosts in index.values():
+            hosts.sort()
+        self._index = index
+        write_atomically(self.index_path, dump_json(index))
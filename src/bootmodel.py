@@ -0,0 +1,272 @@
+"""
+The boot state being edited, without any GTK dependency: EfibootsListStore only mirrors it in
+rows for the GUI, while scripts and tests can use it directly.
+"""
+import copy
+import logging
+from dataclasses import dataclass, field
+
+from efiboots.desiredstate import normalize_loader
+from efiboots.efibootmgr import Efibootmgr, ParsedEfibootmgr, ParsedEfibootmgrEntry
+from efiboots.nvram import BootChanges, NvramPlan, diff_boot_states, efibootmgr_script, plan_direct_writes
+
+
+@dataclass
+class MergeResult:
+    """What reading again the variables changed by another program did to the edited state"""
+    changed: list[str] = field(default_factory=list)
+    added: list[str] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+    order_changed: bool = False
+    boot_next_changed: bool = False
+    timeout_changed: bool = False
+    # external changes that were not applied because they clash with pending edits
+    conflicts: list[str] = field(default_factory=list)
+
+    def __bool__(self):
+        return bool(self.changed or self.added or self.removed or self.order_changed or self.boot_next_changed
+                    or self.timeout_changed or self.conflicts)
+
+
+class BootModel:
+    """
+    Keeps the snapshot read from NVRAM and the edits made to it. Edits are compared with the
+    snapshot to find pending changes. New entries have NEW# numbers until they are written.
+    """
+    def __init__(self):
+        self.parsed_efi: ParsedEfibootmgr | None = None
+        self.entries: dict[str, ParsedEfibootmgrEntry] = {}
+        self.boot_order: list[str] = []
+        # num -> index in boot_order, kept in sync by every method changing boot_order
+        self.positions: dict[str, int] = {}
+        self.boot_next: str | None = None
+        self.boot_current: str | None = None
+        self.timeout: int | None = None
+        self.new_count = 0
+
+    def __str__(self):
+        return f"next: {self.boot_next} order: {self.boot_order} timeout: {self.timeout}"
+
+    def clear(self):
+        self.__init__()
+
+    def load(self, parsed_efi: ParsedEfibootmgr | None):
+        self.clear()
+        if parsed_efi is not None:
+            self.parsed_efi = parsed_efi
+            # copies, so that edits never change the snapshot they are compared with
+            self.entries = {entry.num: copy.copy(entry) for entry in parsed_efi.entries}
+            self._set_boot_order(parsed_efi.boot_order)
+            self.boot_next = parsed_efi.boot_next
+            self.boot_current = parsed_efi.boot_current
+            self.timeout = parsed_efi.timeout
+
+    def _index_positions(self, start: int = 0):
+        for position in range(start, len(self.boot_order)):
+            self.positions[self.boot_order[position]] = position
+
+    def _set_boot_order(self, boot_order: list[str]):
+        self.boot_order = list(boot_order)
+        self.positions = {}
+        self._index_positions()
+
+    def set_boot_order(self, boot_order: list[str]):
+        self._set_boot_order(boot_order)
+
+    def swap(self, a: int, b: int):
+        self.boot_order[a], self.boot_order[b] = self.boot_order[b], self.boot_order[a]
+        self.positions[self.boot_order[a]] = a
+        self.positions[self.boot_order[b]] = b
+
+    def move(self, num: str, offset: int) -> int | None:
+        """
+        Swaps num with the entry offset positions away in boot order, stopping at the ends.
+        :return: the new position of num or None if it is not in boot order.
+        """
+        position = self.positions.get(num)
+        if position is None:
+            return None
+        new_position = min(max(position + offset, 0), len(self.boot_order) - 1)
+        self.swap(position, new_position)
+        return new_position
+
+    def order_edited(self, base_order: list[str]) -> bool:
+        """
+        :return: True if the entries of base_order still in boot order are not in the same order
+            anymore. Adding and removing entries doesn't count, nor moving one and back.
+        """
+        in_base = set(base_order)
+        return [num for num in self.boot_order if num in in_base] != \
+            [num for num in base_order if num in self.positions]
+
+    def sort_key(self, num: str) -> int:
+        """Entries missing from boot order come last"""
+        return self.positions.get(num, len(self.boot_order))
+
+    def compare_boot_order(self, num1: str, num2: str) -> int:
+        """Sort function putting entries in boot order"""
+        return self.sort_key(num1) - self.sort_key(num2)
+
+    def ordered_entries(self) -> list[ParsedEfibootmgrEntry]:
+        return sorted(self.entries.values(), key=lambda entry: self.sort_key(entry.num))
+
+    def set_active(self, num: str, active: bool):
+        self.entries[num].active = active
+
+    def add(self, label: str, path: str, parameters: str) -> ParsedEfibootmgrEntry:
+        entry = ParsedEfibootmgrEntry(num=f"NEW{self.new_count:d}", active=True, name=label, path=path,
+                                      parameters=parameters)
+        self.new_count += 1
+        self.entries[entry.num] = entry
+        self.positions[entry.num] = len(self.boot_order)
+        self.boot_order.append(entry.num)
+        return entry
+
+    def remove(self, num: str):
+        del self.entries[num]
+        position = self.positions.pop(num, None)
+        if position is not None:
+            del self.boot_order[position]
+            self._index_positions(position)
+        if self.boot_next == num:
+            self.boot_next = None
+
+    def merge(self, remote: ParsedEfibootmgr) -> MergeResult:
+        """
+        Takes in the boot state changed by another program, keeping pending edits: remote becomes
+        the new snapshot and the settings that were not edited take its values. An external change
+        to an edited setting is not applied and is reported as a conflict.
+        """
+        result = MergeResult()
+        base = self.parsed_efi
+        if base is None:
+            self.load(remote)
+            result.added = list(self.entries)
+            result.order_changed = True
+            return result
+
+        base_entries = {entry.num: entry for entry in base.entries}
+        remote_entries = {entry.num: entry for entry in remote.entries}
+        for num in sorted(base_entries.keys() | remote_entries.keys()):
+            base_entry, remote_entry = base_entries.get(num), remote_entries.get(num)
+            if base_entry == remote_entry and base_entry.raw == remote_entry.raw:
+                continue
+            local_entry = self.entries.get(num)
+            if remote_entry is None:
+                if local_entry is not None:
+                    if local_entry.active != base_entry.active:
+                        result.conflicts.append(f"Boot{num} has been deleted")
+                    self.remove(num)
+                result.removed.append(num)
+            elif base_entry is None:
+                self.entries[num] = copy.copy(remote_entry)
+                result.added.append(num)
+            elif local_entry is None:
+                result.conflicts.append(f"Boot{num} has been changed, but you deleted it")
+            else:
+                entry = copy.copy(remote_entry)
+                if local_entry.active != base_entry.active:
+                    entry.active = local_entry.active
+                self.entries[num] = entry
+                result.changed.append(num)
+
+        if remote.boot_order != base.boot_order:
+            if not self.order_edited(base.boot_order):
+                deleted = base_entries.keys() - self.entries.keys()
+                new = [num for num in self.boot_order if num not in base_entries and num not in remote_entries]
+                self._set_boot_order([num for num in remote.boot_order if num not in deleted] + new)
+                result.order_changed = True
+            elif self.boot_order != remote.boot_order:
+                result.conflicts.append("BootOrder has been changed")
+
+        if remote.boot_next != base.boot_next:
+            if self.boot_next == base.boot_next:
+                self.boot_next = remote.boot_next
+                result.boot_next_changed = True
+            elif self.boot_next != remote.boot_next:
+                result.conflicts.append("BootNext has been changed")
+
+        if remote.timeout != base.timeout:
+            if self.timeout == base.timeout:
+                self.timeout = remote.timeout
+                result.timeout_changed = True
+            elif self.timeout != remote.timeout:
+                result.conflicts.append("Timeout has been changed")
+
+        self.boot_current = remote.boot_current
+        self.parsed_efi = remote
+        logging.debug("Merged external changes: %s", result)
+        return result
+
+    def import_state(self, imported: ParsedEfibootmgr):
+        """
+        Makes imported (e.g. exported from another machine, see export.py) the edited state, so
+        that writing pending changes turns NVRAM into it. Entries of imported are matched with
+        those read from NVRAM by number, then by label, loader and parameters: matched entries
+        keep their number, the others become new entries. Entries missing from imported are removed.
+        :raise ValueError: if no boot state has been loaded yet.
+        """
+        if self.parsed_efi is None:
+            raise ValueError("no boot state to import into")
+
+        def key(entry: ParsedEfibootmgrEntry) -> tuple[str, str, str]:
+            return entry.name.strip(), normalize_loader(entry.path), entry.parameters or ''
+
+        base_entries = {entry.num: entry for entry in self.parsed_efi.entries}
+        by_key = {}
+        for entry in self.parsed_efi.entries:
+            by_key.setdefault(key(entry), []).append(entry.num)
+        nums = {entry.num: entry.num for entry in imported.entries
+                if entry.num in base_entries and key(base_entries[entry.num]) == key(entry)}
+        used = set(nums.values())
+        for entry in imported.entries:
+            if entry.num not in nums:
+                num = next((num for num in by_key.get(key(entry), []) if num not in used), None)
+                if num is not None:
+                    nums[entry.num] = num
+                    used.add(num)
+
+        self.entries = {}
+        for entry in imported.entries:
+            if entry.num in nums:
+                kept = copy.copy(base_entries[nums[entry.num]])
+                kept.active = entry.active
+                self.entries[kept.num] = kept
+            else:
+                new = ParsedEfibootmgrEntry(num=f"NEW{self.new_count:d}", active=entry.active, name=entry.name,
+                                            path=entry.path, parameters=entry.parameters, raw=entry.raw,
+                                            partition=entry.partition)
+                self.new_count += 1
+                self.entries[new.num] = new
+                nums[entry.num] = new.num
+        self.set_boot_order([nums[num] for num in imported.boot_order if num in nums])
+        self.boot_next = nums.get(imported.boot_next)
+        if imported.timeout is not None:
+            self.timeout = imported.timeout
+
+    def desired_state(self) -> ParsedEfibootmgr:
+        """:return: the boot state as edited by the user"""
+        return ParsedEfibootmgr(entries=list(self.entries.values()), boot_order=list(self.boot_order),
+                                boot_next=self.boot_next, boot_current=self.boot_current, timeout=self.timeout)
+
+    def changes(self) -> BootChanges:
+        if self.parsed_efi is None:
+            return BootChanges()
+        return diff_boot_states(self.parsed_efi, self.desired_state())
+
+    def pending_changes(self) -> bool:
+        changes = self.changes()
+        logging.debug("%s", changes)
+        return bool(changes)
+
+    def to_writes(self, efibootmgr: Efibootmgr, disk: str | None, part: str | None) -> NvramPlan | None:
+        """
+        :return: the NVRAM writes needed to apply pending changes or None when they can't be written
+            directly to efivarfs and efibootmgr has to be used instead.
+        """
+        if self.parsed_efi is None:
+            return None
+        return plan_direct_writes(efibootmgr, self.parsed_efi, self.changes(), disk, part)
+
+    def to_script(self, disk: str | None, part: str | None, reboot: bool) -> str:
+        return efibootmgr_script(self.changes(), disk, part, reboot)
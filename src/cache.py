@@ -0,0 +1,95 @@
+"""
+Persistent cache of what is expensive to probe and rarely changes, like the ESP location.
+Every value is stored along with a fingerprint of what it was derived from and is discarded as
+soon as that fingerprint changes.
+"""
+import hashlib
+import json
+import logging
+import os
+
+from efiboots.efibootmgr import is_in_flatpak
+from efiboots.esp import ESP_MOUNT_POINTS, PROC_MOUNTINFO
+from efiboots.nvram import DEV_DISK_BY_PARTUUID
+
+
+def cache_dir() -> str:
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'efiboots')
+
+
+def esp_fingerprint(mountinfo: str = PROC_MOUNTINFO, by_partuuid: str = DEV_DISK_BY_PARTUUID) -> str:
+    """Hash of the mounts on the usual ESP mount points and of the partition UUIDs of all disks"""
+    digest = hashlib.sha256()
+    with open(mountinfo, 'rb') as f:
+        for line in f:
+            if line.split(b' ', 5)[4].decode() in ESP_MOUNT_POINTS:
+                # skip the mount ID, it changes on every remount
+                digest.update(line.split(b' ', 1)[1])
+    try:
+        partuuids = sorted(os.listdir(by_partuuid))
+    except FileNotFoundError:
+        partuuids = []
+    for partuuid in partuuids:
+        digest.update(f'{partuuid}>{os.readlink(os.path.join(by_partuuid, partuuid))}\n'.encode())
+    return digest.hexdigest()
+
+
+class SystemCache:
+    """
+    $XDG_CACHE_HOME/efiboots/system.json. It is disabled inside Flatpak, because the sandbox
+    can't see the host files fingerprints are computed from.
+    """
+    log = logging.getLogger('SystemCache')
+
+    def __init__(self, path: str | None = None):
+        self.path = path if path is not None else os.path.join(cache_dir(), 'system.json')
+        self.enabled = not is_in_flatpak()
+        self._data = None
+
+    @property
+    def data(self) -> dict:
+        if self._data is None:
+            try:
+                with open(self.path) as f:
+                    self._data = json.load(f)
+            except (OSError, ValueError) as e:
+                self.log.debug("Cache not loaded: %s", e)
+                self._data = {}
+        return self._data
+
+    def _get(self, key: str, fingerprint: str | None):
+        if not self.enabled or fingerprint is None:
+            return None
+        entry = self.data.get(key)
+        if entry is None or entry.get('fingerprint') != fingerprint:
+            self.log.debug("Cache miss for %s", key)
+            return None
+        self.log.debug("Cache hit for %s: %s", key, entry['value'])
+        return entry['value']
+
+    def _set(self, key: str, fingerprint: str | None, value):
+        if not self.enabled or fingerprint is None:
+            return
+        self.data[key] = {'fingerprint': fingerprint, 'value': value}
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            self.log.warning("Could not write cache %s: %s", self.path, e)
+
+    def _esp_fingerprint(self) -> str | None:
+        try:
+            return esp_fingerprint()
+        except OSError as e:
+            self.log.debug("Can't fingerprint ESP: %s", e)
+            return None
+
+    def get_esp(self) -> tuple[str, str] | None:
+        esp = self._get('esp', self._esp_fingerprint())
+        return tuple(esp) if esp else None
+
+    def set_esp(self, disk: str, part: str):
+        self._set('esp', self._esp_fingerprint(), [disk, part])
@@ -0,0 +1,380 @@
+"""
+Headless command line interface, for scripting boot changes without a display server.
+
+    efiboots show [--json] [--devices]
+    efiboots apply [--dry-run] [--reboot] [--disk DISK --part PART] STATE.json
+    efiboots export [--binary] [FILE]
+    efiboots import [--dry-run] [--reboot] [--disk DISK --part PART] FILE
+    efiboots snapshot save [--label LABEL] [FILE]
+    efiboots snapshot list
+    efiboots snapshot diff FILE
+    efiboots snapshot restore [--dry-run] [--reboot] FILE
+    efiboots snapshot archive [--host HOST] ARCHIVE [FILE...]
+    efiboots snapshot entries ARCHIVE
+    efiboots snapshot hosts ARCHIVE HASH
+    efiboots analyze [--jobs JOBS] [--problems] [--json] DUMPS
+    efiboots check [--disk DISK --part PART]
+
+apply reads a desired state (see desiredstate.py) and only writes what differs from the current
+one. The exit status tells what happened: 0 nothing to change, 2 changes applied (or that would
+be applied with --dry-run), 1 error. snapshot diff and snapshot restore exit the same way.
+
+export prints the complete boot state (see export.py) and import writes what differs from it,
+like apply does, keeping the entries that match and creating the others.
+
+--profile prints how long the external commands, efivarfs accesses and parsing took and
+--profile-output saves every step as JSON or Chrome trace (see profiling.py).
+
+A snapshot of NVRAM (see snapshot.py) is saved before apply and snapshot restore write anything.
+Their writes are read back and rolled back if they didn't go through (see transaction.py); how
+long every step took is printed on stderr.
+Snapshots of many hosts can be gathered in an archive (see archive.py), where hosts lists the
+ones having a load option, given by the hash or a prefix of it printed by entries.
+
+show --devices adds the partition every entry points to: device, disk model and mount point,
+all listed at once (see partitions.py).
+
+check lists the entries whose loader or partition is missing and the duplicate ones (see
+integrity.py). It exits with 2 if it finds any, 0 otherwise.
+
+analyze summarizes efibootmgr -v outputs or exports collected from many hosts, in a directory or
+a tar archive, without touching the local NVRAM (see fleet.py).
+
+This module must not import gi: the GUI is loaded only when no subcommand is given.
+"""
+import argparse
+import json
+import logging
+import subprocess
+import sys
+
+from efiboots import export, fleet
+from efiboots.archive import SnapshotArchive
+from efiboots.bootmodel import BootModel
+from efiboots.cache import SystemCache
+from efiboots.desiredstate import DesiredState
+from efiboots.efibootmgr import Efibootmgr, ParsedEfibootmgr, is_in_flatpak
+from efiboots.efivarfs import Efivarfs
+from efiboots.esp import MultipleEspsError, auto_detect_esp, disk_part_to_device
+from efiboots.integrity import IntegrityChecker
+from efiboots.nvram import BootChanges, diff_boot_states, efibootmgr_script, plan_direct_writes
+from efiboots.partitions import PartitionResolver
+from efiboots.privileged import execute_script_as_root, execute_transaction_as_root
+from efiboots.profiling import profiler
+from efiboots.snapshot import Snapshot, SnapshotStore
+from efiboots.transaction import TransactionError
+
+EXIT_UNCHANGED = 0
+EXIT_ERROR = 1
+EXIT_CHANGED = 2
+
+COMMANDS = ('show', 'apply', 'export', 'import', 'snapshot', 'analyze', 'check')
+
+
+def is_cli(args: list[str]) -> bool:
+    """
+    :return: True if args (without the program name) ask for a subcommand instead of the GUI, after
+        the options of add_global_options() if any.
+    """
+    i = 0
+    while i < len(args) and (args[i] in ('--verbose', '--profile', '--profile-output') or
+                             args[i].startswith('--profile-output=') or args[i].strip('v') == '-'):
+        i += 2 if args[i] == '--profile-output' else 1
+    return i < len(args) and args[i] in COMMANDS
+
+
+def add_global_options(parser: argparse.ArgumentParser, subcommand: bool = False):
+    """
+    Adds the options every command accepts, before or after its name. Those of subcommands have no
+    default, so that they don't override the ones given before the subcommand.
+    """
+    parser.add_argument('-v', '--verbose', action='count', default=argparse.SUPPRESS if subcommand else 0,
+                        help="more logging, repeat for debug")
+    parser.add_argument('--profile', action='store_true', default=argparse.SUPPRESS if subcommand else False,
+                        help="print how long every step took")
+    parser.add_argument('--profile-output', metavar='FILE', default=argparse.SUPPRESS if subcommand else None,
+                        help="save the profiled steps to FILE, in Chrome trace format if it ends with .trace.json")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='efiboots', description="Manage EFI boot entries")
+    add_global_options(parser)
+    global_options = argparse.ArgumentParser(add_help=False)
+    add_global_options(global_options, subcommand=True)
+
+    def add_command(subparsers, name: str, **kwargs) -> argparse.ArgumentParser:
+        return subparsers.add_parser(name, parents=[global_options], **kwargs)
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    show = add_command(subparsers, 'show', help="print the current boot configuration")
+    show.add_argument('--json', action='store_true', help="print it as a desired state accepted by apply")
+    show.add_argument('--devices', action='store_true', help="print the partition every entry points to")
+
+    apply = add_command(subparsers, 'apply', help="apply a desired state file, only changing what differs")
+    apply.add_argument('state', help="JSON desired state file, - for stdin")
+
+    export_parser = add_command(subparsers, 'export', help="print the complete boot state in a stable format")
+    export_parser.add_argument('file', nargs='?', help="file to write, in binary form if it ends with .bin, "
+                                                       "stdout by default")
+    export_parser.add_argument('--binary', action='store_true', help="write the binary form instead of JSON")
+
+    import_parser = add_command(subparsers, 'import', help="write the changes turning the boot state into an export")
+    import_parser.add_argument('file', help="JSON or binary export, - for stdin")
+
+    for write_parser in (apply, import_parser):
+        write_parser.add_argument('--dry-run', '-n', action='store_true',
+                                  help="print the changes without applying them")
+        write_parser.add_argument('--reboot', action='store_true', help="reboot after applying the changes")
+        write_parser.add_argument('--disk', '-d', help="disk device where ESP is located (for example /dev/sda)")
+        write_parser.add_argument('--part', '-p', help="partition number of ESP")
+
+    snapshot = add_command(subparsers, 'snapshot', help="save, compare with and restore snapshots of NVRAM")
+    snapshot_commands = snapshot.add_subparsers(dest='snapshot_command', required=True)
+    save = add_command(snapshot_commands, 'save', help="save the boot variables currently in NVRAM")
+    save.add_argument('file', nargs='?', help="snapshot file, the snapshot directory by default")
+    save.add_argument('--label', default='', help="description stored in the snapshot")
+    add_command(snapshot_commands, 'list', help="list the snapshots in the snapshot directory")
+    diff = add_command(snapshot_commands, 'diff', help="print how NVRAM differs from a snapshot")
+    diff.add_argument('file', help="snapshot file")
+    restore = add_command(snapshot_commands, 'restore', help="write back the variables that differ from a snapshot")
+    restore.add_argument('file', help="snapshot file")
+    restore.add_argument('--dry-run', '-n', action='store_true', help="print the writes without doing them")
+    restore.add_argument('--reboot', action='store_true', help="reboot after restoring")
+    archive = add_command(snapshot_commands, 'archive', help="add snapshots to an archive of many hosts")
+    archive.add_argument('archive', help="archive directory")
+    archive.add_argument('files', nargs='*', help="snapshot files, the current NVRAM by default")
+    archive.add_argument('--host', help="host the snapshots belong to, the one they were taken on by default")
+    entries = add_command(snapshot_commands, 'entries', help="list the distinct load options of an archive")
+    entries.add_argument('archive', help="archive directory")
+    hosts = add_command(snapshot_commands, 'hosts', help="list the hosts of an archive having a load option")
+    hosts.add_argument('archive', help="archive directory")
+    hosts.add_argument('hash', help="hash of the load option or a prefix of it")
+
+    analyze = add_command(subparsers, 'analyze', help="summarize the boot configurations dumped on many hosts")
+    analyze.add_argument('dumps', help="directory or tar archive of efibootmgr -v outputs or exports")
+    analyze.add_argument('--jobs', '-j', type=int, help="number of worker processes, one per CPU by default")
+    analyze.add_argument('--problems', action='store_true',
+                         help="list only the hosts with duplicate loaders, orphaned BootOrder numbers, "
+                              "not booting the first entry or that could not be parsed")
+    analyze.add_argument('--json', action='store_true', help="print the summary as JSON, by column")
+
+    check_parser = add_command(subparsers, 'check', help="find entries with a missing loader or partition and "
+                                                       "duplicate entries")
+    check_parser.add_argument('--disk', '-d', help="disk device where ESP is located, for the entries read from "
+                                                   "efibootmgr output")
+    check_parser.add_argument('--part', '-p', help="partition number of ESP")
+    return parser
+
+
+def format_state(parsed: ParsedEfibootmgr, partitions: PartitionResolver | None = None) -> str:
+    lines = [f"BootCurrent: {parsed.boot_current}", f"BootNext: {parsed.boot_next}",
+             f"Timeout: {parsed.timeout} seconds", f"BootOrder: {','.join(parsed.boot_order)}"]
+    for entry in parsed.entries:
+        line = f"Boot{entry.num}{'*' if entry.active else ' '} {entry.name.strip()}\t{entry.path or ''}" \
+            f"{' ' + entry.parameters if entry.parameters else ''}"
+        if partitions is not None and entry.partition is not None:
+            line += f"\t{partitions.resolve(entry.partition) or entry.partition + ' (not found)'}"
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def show(efibootmgr: Efibootmgr, args: argparse.Namespace) -> int:
+    parsed = efibootmgr.parse(efibootmgr.run())
+    if args.json:
+        print(json.dumps(DesiredState.from_parsed(parsed).to_dict(), indent=4))
+    else:
+        print(format_state(parsed, PartitionResolver() if args.devices else None))
+    return EXIT_UNCHANGED
+
+
+def apply(efibootmgr: Efibootmgr, cache: SystemCache, args: argparse.Namespace) -> int:
+    if args.state == '-':
+        desired = DesiredState.from_dict(json.load(sys.stdin))
+    else:
+        desired = DesiredState.load(args.state)
+    initial = efibootmgr.parse(efibootmgr.run())
+    return write_changes(efibootmgr, cache, initial, diff_boot_states(initial, desired.apply_to(initial)), args,
+                         args.state)
+
+
+def import_state(efibootmgr: Efibootmgr, cache: SystemCache, args: argparse.Namespace) -> int:
+    imported = export.loads(sys.stdin.buffer.read()) if args.file == '-' else export.load(args.file)
+    model = BootModel()
+    model.load(efibootmgr.parse(efibootmgr.run()))
+    model.import_state(imported)
+    return write_changes(efibootmgr, cache, model.parsed_efi, model.changes(), args, args.file)
+
+
+def write_changes(efibootmgr: Efibootmgr, cache: SystemCache, initial: ParsedEfibootmgr, changes: BootChanges,
+                  args: argparse.Namespace, source: str) -> int:
+    """Writes changes as the options of apply say: --dry-run, --reboot, --disk and --part"""
+    if not changes:
+        logging.info("Boot configuration already matches %s", source)
+        if args.reboot and not args.dry_run:
+            execute_script_as_root("reboot\n")
+        return EXIT_UNCHANGED
+
+    disk, part = args.disk, args.part
+    # entries imported along with their load option don't need the ESP
+    if any(entry.raw is None for entry in changes.create) and not (disk and part):
+        disk, part = cache.get_esp() or auto_detect_esp()
+        if not (disk and part):
+            raise ValueError("can't create boot entries, no EFI System Partition found, use --disk and --part")
+        cache.set_esp(disk, part)
+
+    plan = plan_direct_writes(efibootmgr, initial, changes, disk, part)
+    if not args.dry_run:
+        SnapshotStore().capture(Efivarfs(), f"before applying {source}")
+    if plan is not None:
+        print(plan)
+        if not args.dry_run:
+            report = execute_transaction_as_root(plan, args.reboot)
+            print(f"Written and verified: {report.format_timings()}", file=sys.stderr)
+    else:
+        script = efibootmgr_script(changes, disk, part, args.reboot)
+        print(script, end='')
+        if not args.dry_run:
+            execute_script_as_root(script)
+    return EXIT_CHANGED
+
+
+def export_state(efibootmgr: Efibootmgr, args: argparse.Namespace) -> int:
+    parsed = efibootmgr.parse(efibootmgr.run())
+    if args.file:
+        export.save(parsed, args.file, args.binary or None)
+    elif args.binary:
+        sys.stdout.buffer.write(export.dump_binary(parsed))
+    else:
+        print(export.dump_json(parsed, indent=4))
+    return EXIT_UNCHANGED
+
+
+def check(efibootmgr: Efibootmgr, cache: SystemCache, args: argparse.Namespace) -> int:
+    parsed = efibootmgr.parse(efibootmgr.run())
+    disk, part = (args.disk, args.part) if args.disk and args.part else cache.get_esp() or (None, None)
+    checker = IntegrityChecker(esp=disk_part_to_device(disk, part) if disk and part else None)
+    issues = checker.check(parsed)
+    for issue in issues:
+        print(issue)
+    return EXIT_CHANGED if issues else EXIT_UNCHANGED
+
+
+def analyze(args: argparse.Namespace) -> int:
+    summary = fleet.analyze_fleet(args.dumps, args.jobs)
+    if args.json:
+        print(json.dumps(summary.to_dict(), indent=4))
+    else:
+        print(summary.format(args.problems))
+    return EXIT_UNCHANGED
+
+
+def live_snapshot() -> Snapshot:
+    efivarfs = Efivarfs()
+    if not efivarfs.is_available():
+        raise OSError(f"snapshots need efivarfs, {efivarfs.path} is not readable")
+    return Snapshot.capture(efivarfs)
+
+
+def snapshot(args: argparse.Namespace) -> int:
+    store = SnapshotStore()
+    match args.snapshot_command:
+        case 'save':
+            current = live_snapshot()
+            current.label = args.label
+            if args.file:
+                current.save(args.file)
+                print(args.file)
+            else:
+                print(store.add(current))
+        case 'list':
+            for path in store.list():
+                saved = Snapshot.load(path)
+                print(f"{path}\t{saved.host}\t{len(saved.variables)} variables\t{saved.label}")
+        case 'diff':
+            saved = Snapshot.load(args.file)
+            current = live_snapshot()
+            if not saved.diff(current):
+                return EXIT_UNCHANGED
+            print(saved.format_diff(current))
+            return EXIT_CHANGED
+        case 'restore':
+            saved = Snapshot.load(args.file)
+            current = live_snapshot()
+            plan = saved.restore_plan(current)
+            if not plan:
+                logging.info("NVRAM already matches %s", args.file)
+                return EXIT_UNCHANGED
+            print(plan)
+            if not args.dry_run:
+                if is_in_flatpak():
+                    raise OSError("snapshots can't be restored from inside Flatpak")
+                store.add(current)
+                report = execute_transaction_as_root(plan, args.reboot)
+                print(f"Written and verified: {report.format_timings()}", file=sys.stderr)
+            return EXIT_CHANGED
+        case 'archive':
+            archive = SnapshotArchive(args.archive)
+            archived = [Snapshot.load(path) for path in args.files] if args.files else [live_snapshot()]
+            for digest in archive.add_many(archived, args.host):
+                print(digest)
+        case 'entries':
+            archive = SnapshotArchive(args.archive)
+            for digest, hosts in sorted(archive.index.items(), key=lambda item: -len(item[1])):
+                print(f"{digest[:16]}\t{len(hosts)} hosts\t{archive.describe_blob(digest)}")
+        case 'hosts':
+            archive = SnapshotArchive(args.archive)
+            digests = archive.find_blobs(args.hash)
+            if len(digests) != 1:
+                raise ValueError(f"{len(digests)} load options match {args.hash}")
+            print('\n'.join(archive.hosts_with(digests[0])))
+    return EXIT_UNCHANGED
+
+
+def main(argv: list[str]) -> int:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=[logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)])
+    if not (args.profile or args.profile_output):
+        return run_command(args)
+    profiler.enable()
+    try:
+        with profiler.span(args.command):
+            return run_command(args)
+    finally:
+        if args.profile:
+            print(profiler.summary(), file=sys.stderr)
+        if args.profile_output:
+            profiler.dump(args.profile_output)
+
+
+def run_command(args: argparse.Namespace) -> int:
+    cache = SystemCache()
+    try:
+        if args.command == 'snapshot':
+            return snapshot(args)
+        if args.command == 'analyze':
+            return analyze(args)
+        efibootmgr = Efibootmgr.get_instance()
+        match args.command:
+            case 'show':
+                return show(efibootmgr, args)
+            case 'export':
+                return export_state(efibootmgr, args)
+            case 'import':
+                return import_state(efibootmgr, cache, args)
+            case 'check':
+                return check(efibootmgr, cache, args)
+        return apply(efibootmgr, cache, args)
+    except MultipleEspsError as e:
+        print(f"efiboots: more than one ESP found ({', '.join(e.esps)}), use --disk and --part", file=sys.stderr)
+    except subprocess.CalledProcessError as e:
+        print(f"efiboots: {e}\n{e.stderr or ''}", file=sys.stderr)
+    except TransactionError as e:
+        print(f"efiboots: {e}\n{e.report.format_timings()}", file=sys.stderr)
+    except (OSError, ValueError, NotImplementedError) as e:
+        print(f"efiboots: {e}", file=sys.stderr)
+    return EXIT_ERROR
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -2,7 +2,8 @@
 This program was a prototype to try avoid efibootmgr parsing pitfalls by directly
 reading efivars from python thanks to ctypes.
 
-It is not currently used by Efiboots. 
+It is not currently used by Efiboots: see efivarfs.py, loadoption.py and devicepath.py
+for the decoders that grew out of it.
 """
 import sys
 import struct
@@ -241,20 +242,25 @@ def get_timeout() -> int:
     return int.from_bytes(data, 'little')
 
 
-print(f"BootCurrent: Boot{get_boot_current():04X}")
-boot_next = get_boot_next()
-print(f"NextBoot: Boot{boot_next:04X}" if boot_next else "BootNext: None")
-print(f"Timeout: {get_timeout()}")
-print(f"BootOrder: {', '.join(('{:04X}'.format(o) for o in get_boot_order()))}")
-
-variables = [v for v in list_variables() if v.startswith('Boot0')]
-for var in sorted(variables):
-    var_data, var_attr = get_variable_data(var)
-    if var_data:
-        load_opt_attr = get_load_option_attributes(var_data)
-        var_desc, next_field = get_load_option_description(var_data)
-        path, next_field = get_load_option_device_path(var_data, next_field)
-        optional = get_load_option_optional_data(var_data, next_field)
-        if 'active' in load_opt_attr:
-            var += '*'
-        print(f'{var}: "{var_desc}" {path} {optional}')
+def main():
+    print(f"BootCurrent: Boot{get_boot_current():04X}")
+    boot_next = get_boot_next()
+    print(f"NextBoot: Boot{boot_next:04X}" if boot_next else "BootNext: None")
+    print(f"Timeout: {get_timeout()}")
+    print(f"BootOrder: {', '.join(('{:04X}'.format(o) for o in get_boot_order()))}")
+
+    variables = [v for v in list_variables() if v.startswith('Boot0')]
+    for var in sorted(variables):
+        var_data, var_attr = get_variable_data(var)
+        if var_data:
+            load_opt_attr = get_load_option_attributes(var_data)
+            var_desc, next_field = get_load_option_description(var_data)
+            path, next_field = get_load_option_device_path(var_data, next_field)
+            optional = get_load_option_optional_data(var_data, next_field)
+            if 'active' in load_opt_attr:
+                var += '*'
+            print(f'{var}: "{var_desc}" {path} {optional}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Declarative boot configuration, as used by the headless command line (see cli.py).
+
+A desired state is a JSON object where every key is optional and missing keys leave the
+corresponding setting untouched:
+
+    {
+        "create": [{"label": "Arch Linux", "loader": "\\vmlinuz-linux", "parameters": "root=/dev/sda2 rw"}],
+        "delete": ["Windows Boot Manager"],
+        "active": {"0003": false},
+        "boot_order": ["Arch Linux", "0003"],
+        "boot_next": null,
+        "timeout": 3
+    }
+
+Entries are referenced either by their Boot#### number or by their label, so the same file
+can be applied to machines numbering their entries differently. Entries listed in "create" are
+only created if no entry with the same label, loader and parameters exists yet, which makes
+applying the same state twice a no-op. Created entries "boot_order" doesn't list are appended to it.
+"""
+import json
+import re
+from dataclasses import dataclass, field
+
+from efiboots.efibootmgr import ParsedEfibootmgr, ParsedEfibootmgrEntry
+
+num_regex = re.compile(r'^[0-9A-Fa-f]{4}$')
+_unset = object()
+
+
+@dataclass
+class DesiredEntry:
+    label: str
+    loader: str
+    parameters: str = ''
+    active: bool = True
+
+    def matches(self, entry: ParsedEfibootmgrEntry) -> bool:
+        return entry.name.strip() == self.label and normalize_loader(entry.path) == normalize_loader(self.loader) \
+            and (entry.parameters or '') == self.parameters
+
+
+def normalize_loader(path: str | None) -> str:
+    """ESP paths are case insensitive and use backslashes, but / is accepted too"""
+    path = (path or '').replace('/', '\\')
+    return ('\\' + path.lstrip('\\')).casefold()
+
+
+@dataclass
+class DesiredState:
+    create: list[DesiredEntry] = field(default_factory=list)
+    delete: list[str] = field(default_factory=list)
+    active: dict[str, bool] = field(default_factory=dict)
+    boot_order: list[str] | None = None
+    # _unset leaves BootNext as it is, None deletes it
+    boot_next: str | None | object = _unset
+    timeout: int | None = None
+
+    @classmethod
+    def from_dict(cls, state: dict) -> 'DesiredState':
+        """:raise ValueError: if state is malformed."""
+        if not isinstance(state, dict):
+            raise ValueError("desired state must be a JSON object")
+        unknown = set(state) - {'create', 'delete', 'active', 'boot_order', 'boot_next', 'timeout'}
+        if unknown:
+            raise ValueError(f"unknown keys in desired state: {', '.join(sorted(unknown))}")
+        try:
+            create = [DesiredEntry(**entry) for entry in state.get('create', [])]
+        except TypeError as e:
+            raise ValueError(f"invalid entry to create: {e}")
+        timeout = state.get('timeout')
+        if timeout is not None and not (isinstance(timeout, int) and 0 <= timeout <= 0xffff):
+            raise ValueError(f"invalid timeout {timeout!r}")
+        return cls(create=create, delete=list(state.get('delete', [])), active=dict(state.get('active', {})),
+                   boot_order=state.get('boot_order'), boot_next=state.get('boot_next', _unset), timeout=timeout)
+
+    @classmethod
+    def load(cls, path: str) -> 'DesiredState':
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    @classmethod
+    def from_parsed(cls, parsed: ParsedEfibootmgr) -> 'DesiredState':
+        """The state currently set, applying it again changes nothing"""
+        return cls(active={entry.num: entry.active for entry in parsed.entries}, boot_order=list(parsed.boot_order),
+                   boot_next=parsed.boot_next, timeout=parsed.timeout)
+
+    def to_dict(self) -> dict:
+        state = {}
+        if self.create:
+            state['create'] = [vars(entry) for entry in self.create]
+        if self.delete:
+            state['delete'] = self.delete
+        if self.active:
+            state['active'] = self.active
+        if self.boot_order is not None:
+            state['boot_order'] = self.boot_order
+        if self.boot_next is not _unset:
+            state['boot_next'] = self.boot_next
+        if self.timeout is not None:
+            state['timeout'] = self.timeout
+        return state
+
+    def apply_to(self, initial: ParsedEfibootmgr) -> ParsedEfibootmgr:
+        """
+        :return: initial with this state applied. Entries to create get NEW# numbers, like the ones
+            added from the GUI, and can be turned into NVRAM writes with diff_boot_states().
+        :raise ValueError: if an entry reference is unknown or ambiguous.
+        """
+        entries = {entry.num: ParsedEfibootmgrEntry(num=entry.num, active=entry.active, name=entry.name,
+                                                    path=entry.path, parameters=entry.parameters, raw=entry.raw,
+                                                    partition=entry.partition)
+                   for entry in initial.entries}
+        created = []
+        for i, desired in enumerate(self.create):
+            existing = next((entry for entry in entries.values() if desired.matches(entry)), None)
+            if existing is not None:
+                existing.active = desired.active
+                created.append(existing.num)
+            else:
+                entries[f'NEW{i}'] = ParsedEfibootmgrEntry(num=f'NEW{i}', active=desired.active, name=desired.label,
+                                                           path=desired.loader, parameters=desired.parameters)
+                created.append(f'NEW{i}')
+
+        def resolve(ref: str) -> str:
+            if num_regex.match(ref) and ref.upper() in entries:
+                return ref.upper()
+            found = [entry.num for entry in entries.values() if entry.name.strip() == ref]
+            if len(found) > 1:
+                raise ValueError(f"{ref!r} is ambiguous, it matches entries {', '.join(found)}")
+            if not found:
+                raise ValueError(f"no boot entry matches {ref!r}")
+            return found[0]
+
+        for ref, active in self.active.items():
+            entries[resolve(ref)].active = bool(active)
+        deleted = {resolve(ref) for ref in self.delete}
+
+        if self.boot_order is None:
+            boot_order = initial.boot_order
+        else:
+            boot_order = [resolve(ref) for ref in self.boot_order]
+            # created entries boot_order doesn't mention are appended, whether they are created now or
+            # have been by a previous run, so that applying the state again changes nothing
+            boot_order += [num for num in created if num not in boot_order]
+        boot_order = [num for num in boot_order if num not in deleted]
+        if self.boot_next is _unset:
+            boot_next = initial.boot_next
+        else:
+            boot_next = None if self.boot_next is None else resolve(self.boot_next)
+        return ParsedEfibootmgr(entries=[entry for num, entry in entries.items() if num not in deleted],
+                                boot_order=boot_order,
+                                boot_next=None if boot_next in deleted else boot_next,
+                                boot_current=initial.boot_current,
+                                timeout=initial.timeout if self.timeout is None else self.timeout)
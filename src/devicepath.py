@@ -0,0 +1,439 @@
+"""
+Decoder for UEFI device paths (UEFI spec chapter 10).
+
+A device path is a sequence of variable length nodes, each starting with a 4 bytes header
+(type, subtype, length). Nodes are decoded from a memoryview, so payloads are not copied
+until a field is actually converted to a Python value.
+"""
+import ipaddress
+import struct
+import uuid
+from dataclasses import dataclass
+
+HARDWARE_DEVICE_PATH = 0x01
+ACPI_DEVICE_PATH = 0x02
+MESSAGING_DEVICE_PATH = 0x03
+MEDIA_DEVICE_PATH = 0x04
+BBS_DEVICE_PATH = 0x05
+END_DEVICE_PATH = 0x7f
+
+END_INSTANCE_DEVICE_PATH = 0x01
+END_ENTIRE_DEVICE_PATH = 0xff
+
+header_struct = struct.Struct('<BBH')
+
+
+def _guid(data: memoryview) -> uuid.UUID:
+    return uuid.UUID(bytes_le=bytes(data[:16]))
+
+
+@dataclass(frozen=True, slots=True)
+class DevicePathNode:
+    """A node this decoder doesn't know about. It is shown like efibootmgr does."""
+    type: int
+    subtype: int
+    data: memoryview
+
+    @classmethod
+    def decode(cls, type_: int, subtype: int, data: memoryview) -> 'DevicePathNode':
+        return cls(type_, subtype, data)
+
+    def __str__(self):
+        return f'Path({self.type},{self.subtype},{self.data.hex()})'
+
+
+@dataclass(frozen=True, slots=True)
+class Pci(DevicePathNode):
+    function: int
+    device: int
+
+    @classmethod
+    def decode(cls, type_, subtype, data):
+        function, device = struct.unpack_from('<BB', data)
+        return cls(type_, subtype, data, function, device)
+
+    def __str__(self):
+        return f'Pci(0x{self.device:x},0x{self.function:x})'
+
+
+@dataclass(frozen=True, slots=True)
+class Acpi(DevicePathNode):
+    hid: int
+    uid: int
+
+    @classmethod
+    def decode(cls, type_, subtype, data):
+        hid, uid = struct.unpack_from('<II', data)
+        return cls(type_, subtype, data, hid, uid)
+
+    def __str__(self):
+        if self.hid & 0xffff == 0x41d0:
+            pnp = self.hid >> 16
+            if pnp == 0x0a03:
+                return f'PciRoot(0x{self.uid:x})'
+            if pnp == 0x0a08:
+                return f'PcieRoot(0x{self.uid:x})'
+            return f'Acpi(PNP{pnp:04X},0x{self.uid:x})'
+        return f'Acpi(0x{self.hid:08x},0x{self.uid:x})'
+
+
+@dataclass(frozen=True, slots=True)
+class Scsi(DevicePathNode):
+    target: int
+    lun: int
+
+    @classmethod
+    def decode(cls, type_, subtype, data):
+        target, lun = struct.unpack_from('<HH', data)
+        return cls(type_, subtype, data, target, lun)
+
+    def __str__(self):
+        return f'SCSI({self.target},{self.lun})'
+
+
+@dataclass(frozen=True, slots=True)
+class Usb(DevicePathNode):
+    parent_port: int
+    interface: int
+
+    @classmethod
+    def decode(cls, type_, subtype, data):
+        parent_port, interface = struct.unpack_from('<BB', data)
+        return cls(type_, subtype, data, parent_port, interface)
+
+    def __str__(self):
+        return f'USB({self.parent_port},{self.interface})'
+
+
+@dataclass(frozen=True, slots=True)
+class Sata(DevicePathNode):
+    hba_port: int
+    port_multiplier_port: int
+    lun: int
+
+    @classmethod
+    def decode(cls, type_, subtype, data):
+        hba_port, port_multiplier_port, lun = struct.unpack_from('<HHH', data)
+        return cls(type_, subtype, data, hba_port, port_multiplier_port, lun)
+
+    def __str__(self):
+        return f'Sata({self.hba_port},{self.port_multiplier_port},{self.lun})'
+
+
+@dataclass(frozen=True, slots=True)
+class Nvme(DevicePathNode):
+    namespace_id: int
+    eui64: bytes
+
+    @classmethod
+    def decode(cls, type_, subtype, data):
+        namespace_id, eui64 = struct.unpack_from('<I8s', data)
+        return cls(type_, subtype, data, namespace_id, eui64)
+
+    def __str__(self):
+        return f'NVMe(0x{self.namespace_id:x},{self.eui64[::-1].hex("-").upper()})'
+
+
+@dataclass(frozen=True, slots=True)
+class Mac(DevicePathNode):
+    address: bytes
+    if_type: int
+
+    @classmethod
+    def decode(cls, type_, subtype, data):
+        address, if_type = struct.unpack_from('<32sB', data)
+        # Ethernet and IEEE 802 addresses are only 6 bytes long, the rest is padding
+        if if_type in (0, 1):
+            address = address[:6]
+        return cls(type_, subtype, data, address, if_type)
+
+    def __str__(self):
+        return f'MAC({self.address.hex()},0x{self.if_type:x})'
+
+
+@dataclass(frozen=True, slots=True)
+class IPv4(DevicePathNode):
+    local: ipaddress.IPv4Address
+    remote: ipaddress.IPv4Address
+    local_port: int
+    remote_port: int
+    protocol: int
+    static: bool
+    gateway: ipaddress.IPv4Address | None
+    subnet_mask: ipaddress.IPv4Address | None
+
+    @classmethod
+    def decode(cls, type_, subtype, data):
+        local, remote, local_port, remote_port, protocol, static = struct.unpack_from('<4s4sHHHB', data)
+        gateway = subnet_mask = None
+        # gateway and subnet mask were added in UEFI 2.2
+        if len(data) >= 23:
+            gateway, subnet_mask = struct.unpack_from('<4s4s', data, 15)
+            gateway, subnet_mask = ipaddress.IPv4Address(gateway), ipaddress.IPv4Address(subnet_mask)
+        return cls(type_, subtype, data, ipaddress.IPv4Address(local), ipaddress.IPv4Address(remote),
+                   local_port, remote_port, protocol, bool(static), gateway, subnet_mask)
+
+    def __str__(self):
+        origin = 'Static' if self.static else 'DHCP'
+        return f'IPv4({self.remote},{self.protocol},{origin},{self.local})'
+
+
+@dataclass(frozen=True, slots=True)
+class IPv6(DevicePathNode):
+    local: ipaddress.IPv6Address
+    remote: ipaddress.IPv6Address
+    local_port: int
+    remote_port: int
+    protocol: int
+    origin: int
+    prefix_length: int | None
+    gateway: ipaddress.IPv6Address | None
+
+    @classmethod
+    def decode(cls, type_, subtype, data):
+        local, remote, local_port, remote_port, protocol, origin = struct.unpack_from('<16s16sHHHB', data)
+        prefix_length = gateway = None
+        # prefix length and gateway were added in UEFI 2.4
+        if len(data) >= 56:
+            prefix_length, gateway = struct.unpack_from('<B16s', data, 39)
+            gateway = ipaddress.IPv6Address(gateway)
+        return cls(type_, subtype, data, ipaddress.IPv6Address(local), ipaddress.IPv6Address(remote),
+                   local_port, remote_port, protocol, origin, prefix_length, gateway)
+
+    def __str__(self):
+        origin = ('Static', 'StatelessAutoConfigure', 'StatefulAutoConfigure')[self.origin] \
+            if self.origin < 3 else str(self.origin)
+        return f'IPv6({self.remote},{self.protocol},{origin},{self.local})'
+
+
+@dataclass(frozen=True, slots=True)
+class Uri(DevicePathNode):
+    uri: str
+
+    @classmethod
+    def decode(cls, type_, subtype, data):
+        return cls(type_, subtype, data, bytes(data).decode('utf-8', errors='replace'))
+
+    def __str__(self):
+        return f'Uri({self.uri})'
+
+
+@dataclass(frozen=True, slots=True)
+class Vendor(DevicePathNode):
+    guid: uuid.UUID
+    vendor_data: memoryview
+
+    @classmethod
+    def decode(cls, type_, subtype, data):
+        return cls(type_, subtype, data, _guid(data), data[16:])
+
+    def __str__(self):
+        prefix = {HARDWARE_DEVICE_PATH: 'VenHw', MESSAGING_DEVICE_PATH: 'VenMsg', MEDIA_DEVICE_PATH: 'VenMedia'}
+        vendor_data = f',{self.vendor_data.hex()}' if self.vendor_data else ''
+        return f'{prefix.get(self.type, "Ven")}({self.guid}{vendor_data})'
+
+
+@dataclass(frozen=True, slots=True)
+class HardDrive(DevicePathNode):
+    partition_number: int
+    partition_start: int
+    partition_size: int
+    signature: uuid.UUID | int | None
+    partition_format: int
+    signature_type: int
+
+    @classmethod
+    def decode(cls, type_, subtype, data):
+        number, start, size, signature, partition_format, signature_type = struct.unpack_from('<IQQ16sBB', data)
+        if signature_type == 2:
+            signature = uuid.UUID(bytes_le=signature)
+        elif signature_type == 1:
+            signature = int.from_bytes(signature[:4], 'little')
+        else:
+            signature = None
+        return cls(type_, subtype, data, number, start, size, signature, partition_format, signature_type)
+
+    @property
+    def partition_guid(self) -> uuid.UUID | None:
+        return self.signature if isinstance(self.signature, uuid.UUID) else None
+
+    def __str__(self):
+        match self.signature_type:
+            case 2:
+                signature = f'GPT,{self.signature}'
+            case 1:
+                signature = f'MBR,0x{self.signature:x}'
+            case _:
+                signature = f'{self.partition_format},0'
+        return f'HD({self.partition_number},{signature},0x{self.partition_start:x},0x{self.partition_size:x})'
+
+
+@dataclass(frozen=True, slots=True)
+class CdRom(DevicePathNode):
+    boot_entry: int
+    partition_start: int
+    partition_size: int
+
+    @classmethod
+    def decode(cls, type_, subtype, data):
+        boot_entry, start, size = struct.unpack_from('<IQQ', data)
+        return cls(type_, subtype, data, boot_entry, start, size)
+
+    def __str__(self):
+        return f'CDROM({self.boot_entry},0x{self.partition_start:x},0x{self.partition_size:x})'
+
+
+@dataclass(frozen=True, slots=True)
+class FilePath(DevicePathNode):
+    path: str
+
+    @classmethod
+    def decode(cls, type_, subtype, data):
+        return cls(type_, subtype, data, bytes(data).decode('utf-16-le').rstrip('\x00'))
+
+    def __str__(self):
+        return f'File({self.path})'
+
+
+@dataclass(frozen=True, slots=True)
+class FirmwareFile(DevicePathNode):
+    guid: uuid.UUID
+
+    @classmethod
+    def decode(cls, type_, subtype, data):
+        return cls(type_, subtype, data, _guid(data))
+
+    def __str__(self):
+        return f'FvFile({self.guid})'
+
+
+@dataclass(frozen=True, slots=True)
+class FirmwareVolume(DevicePathNode):
+    guid: uuid.UUID
+
+    @classmethod
+    def decode(cls, type_, subtype, data):
+        return cls(type_, subtype, data, _guid(data))
+
+    def __str__(self):
+        return f'FvVol({self.guid})'
+
+
+@dataclass(frozen=True, slots=True)
+class Bbs(DevicePathNode):
+    device_type: int
+    status_flag: int
+    description: str
+
+    @classmethod
+    def decode(cls, type_, subtype, data):
+        device_type, status_flag = struct.unpack_from('<HH', data)
+        description = bytes(data[4:]).split(b'\x00', 1)[0].decode('ascii', errors='replace')
+        return cls(type_, subtype, data, device_type, status_flag, description)
+
+    def __str__(self):
+        return f'BBS({self.device_type},{self.description},0x{self.status_flag:x})'
+
+
+@dataclass(frozen=True, slots=True)
+class End(DevicePathNode):
+    """Terminates either a device path instance or the whole device path"""
+
+    @property
+    def entire(self) -> bool:
+        return self.subtype == END_ENTIRE_DEVICE_PATH
+
+    def __str__(self):
+        return 'EndEntire' if self.entire else 'EndInstance'
+
+
+node_types: dict[tuple[int, int], type[DevicePathNode]] = {
+    (HARDWARE_DEVICE_PATH, 0x01): Pci,
+    (HARDWARE_DEVICE_PATH, 0x04): Vendor,
+    (ACPI_DEVICE_PATH, 0x01): Acpi,
+    (MESSAGING_DEVICE_PATH, 0x02): Scsi,
+    (MESSAGING_DEVICE_PATH, 0x05): Usb,
+    (MESSAGING_DEVICE_PATH, 0x0a): Vendor,
+    (MESSAGING_DEVICE_PATH, 0x0b): Mac,
+    (MESSAGING_DEVICE_PATH, 0x0c): IPv4,
+    (MESSAGING_DEVICE_PATH, 0x0d): IPv6,
+    (MESSAGING_DEVICE_PATH, 0x12): Sata,
+    (MESSAGING_DEVICE_PATH, 0x17): Nvme,
+    (MESSAGING_DEVICE_PATH, 0x18): Uri,
+    (MEDIA_DEVICE_PATH, 0x01): HardDrive,
+    (MEDIA_DEVICE_PATH, 0x02): CdRom,
+    (MEDIA_DEVICE_PATH, 0x03): Vendor,
+    (MEDIA_DEVICE_PATH, 0x04): FilePath,
+    (MEDIA_DEVICE_PATH, 0x06): FirmwareFile,
+    (MEDIA_DEVICE_PATH, 0x07): FirmwareVolume,
+    (BBS_DEVICE_PATH, 0x01): Bbs,
+    (END_DEVICE_PATH, END_INSTANCE_DEVICE_PATH): End,
+    (END_DEVICE_PATH, END_ENTIRE_DEVICE_PATH): End,
+}
+
+
+def parse_device_path(data: bytes | memoryview) -> list[DevicePathNode]:
+    """
+    Decodes every node up to and including the End Entire Device Path node.
+    :raise ValueError: if a node header is truncated or has an invalid length.
+    """
+    view = memoryview(data)
+    nodes = []
+    offset = 0
+    while offset + header_struct.size <= len(view):
+        type_, subtype, length = header_struct.unpack_from(view, offset)
+        if length < header_struct.size or offset + length > len(view):
+            raise ValueError(f"invalid device path node length {length} at offset {offset}")
+        node_type = node_types.get((type_, subtype), DevicePathNode)
+        try:
+            node = node_type.decode(type_, subtype, view[offset + header_struct.size:offset + length])
+        except (struct.error, ValueError):
+            # payload too short for its declared type: keep it undecoded
+            node = DevicePathNode(type_, subtype, view[offset + header_struct.size:offset + length])
+        nodes.append(node)
+        offset += length
+        if isinstance(node, End) and node.entire:
+            break
+    return nodes
+
+
+def split_instances(nodes: list[DevicePathNode]) -> list[list[DevicePathNode]]:
+    """Splits a device path in its instances, dropping End nodes"""
+    instances = [[]]
+    for node in nodes:
+        if isinstance(node, End):
+            if node.entire:
+                break
+            instances.append([])
+        else:
+            instances[-1].append(node)
+    return [instance for instance in instances if instance]
+
+
+def format_device_path(nodes: list[DevicePathNode]) -> str:
+    """Formats a device path the same way efibootmgr -v does, e.g. HD(1,GPT,...)/File(\\EFI\\...)"""
+    return ','.join('/'.join(str(node) for node in instance) for instance in split_instances(nodes))
+
+
+def encode_node(type_: int, subtype: int, payload: bytes = b'') -> bytes:
+    return header_struct.pack(type_, subtype, header_struct.size + len(payload)) + payload
+
+
+def encode_hard_drive(partition_number: int, partition_start: int, partition_size: int,
+                      signature: uuid.UUID | int) -> bytes:
+    """Encodes a HD() node. A UUID signature means a GPT partition, an int an MBR disk signature."""
+    if isinstance(signature, uuid.UUID):
+        signature_bytes, partition_format, signature_type = signature.bytes_le, 2, 2
+    else:
+        signature_bytes, partition_format, signature_type = signature.to_bytes(16, 'little'), 1, 1
+    payload = struct.pack('<IQQ16sBB', partition_number, partition_start, partition_size,
+                          signature_bytes, partition_format, signature_type)
+    return encode_node(MEDIA_DEVICE_PATH, 0x01, payload)
+
+
+def encode_file_path(path: str) -> bytes:
+    return encode_node(MEDIA_DEVICE_PATH, 0x04, (path + '\x00').encode('utf-16-le'))
+
+
+def encode_end() -> bytes:
+    return encode_node(END_DEVICE_PATH, END_ENTIRE_DEVICE_PATH)
@@ -3,10 +3,18 @@ import logging
 import re
 import subprocess
 import os
-from dataclasses import dataclass
+import threading
+import struct
+import tempfile
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass, field
 
+from efiboots.efivarfs import Efivarfs
+from efiboots.loadoption import decode_optional_data, is_ucs2, parse_load_option
+from efiboots.profiling import profiler
 
-@dataclass
+
+@dataclass(slots=True)
 class ParsedEfibootmgrEntry:
     """Stores a single entry parsed from efibootmgr command"""
     num: str
@@ -14,9 +22,12 @@ class ParsedEfibootmgrEntry:
     name: str
     path: str
     parameters: str
+    raw: bytes | None = field(default=None, repr=False, compare=False)
+    # GUID of the GPT partition of the HD() device path node, in lower case
+    partition: str | None = field(default=None, repr=False, compare=False)
 
 
-@dataclass
+@dataclass(slots=True)
 class ParsedEfibootmgr:
     """Stores all information parsed from efibootmgr command"""
     entries: list[ParsedEfibootmgrEntry]
@@ -30,51 +41,242 @@ def is_in_flatpak():
     return "FLATPAK_ID" in os.environ
 
 
-def subprocess_run_wrapper(cmd):
+class OperationCancelled(Exception):
+    """Raised when the user cancels a command before it completes"""
+
+
+def subprocess_run_wrapper(cmd, input=None, cancel: threading.Event | None = None):
+    """
+    Runs cmd (on the host when sandboxed) and returns its standard output.
+    :param input: text sent to the standard input of cmd.
+    :param cancel: when set from another thread, cmd is killed and OperationCancelled is raised.
+    """
+    with profiler.span(f"run {cmd[0]}", command=' '.join(cmd)) as span:
+        stdout = _run(cmd, input, cancel)
+        span.add(bytes=len(stdout or ''), input_bytes=len(input or ''))
+        return stdout
+
+
+def _run(cmd, input, cancel: threading.Event | None):
     if is_in_flatpak():
         cmd = [ "flatpak-spawn", "--host" ] + cmd
         logging.debug("Flatpak sandbox detected. Running: %s", ' '.join(cmd))
     else:
         logging.debug("Running: %s", ' '.join(cmd))
-    return subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+    if cancel is None:
+        return subprocess.run(cmd, check=True, capture_output=True, text=True, input=input).stdout
+
+    with subprocess.Popen(cmd, stdin=subprocess.PIPE if input is not None else None, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, text=True) as process:
+        while True:
+            try:
+                stdout, stderr = process.communicate(input, timeout=0.1)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel.is_set():
+                    process.kill()
+                    process.communicate()
+                    raise OperationCancelled(' '.join(cmd))
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+    return stdout
+
+
+def subprocess_lines(cmd) -> Iterator[str]:
+    """
+    Runs cmd like subprocess_run_wrapper, but yields the lines of its standard output as soon as
+    they are read instead of waiting for it to exit. The span of cmd lasts until the last line
+    is consumed, so it includes the time spent parsing them.
+    """
+    with profiler.span(f"run {cmd[0]}", command=' '.join(cmd)) as span:
+        if is_in_flatpak():
+            cmd = ["flatpak-spawn", "--host"] + cmd
+        logging.debug("Running: %s", ' '.join(cmd))
+        size = 0
+        # stderr goes to a file: a pipe read only at the end would block cmd once it's full of warnings
+        with tempfile.TemporaryFile('w+') as stderr_file:
+            with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file, text=True) as process:
+                for line in process.stdout:
+                    size += len(line)
+                    yield line.rstrip('\n')
+            stderr_file.seek(0)
+            stderr = stderr_file.read()
+        span.add(bytes=size)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd, None, stderr)
+
+
+# efibootmgr -v prints printable ASCII bytes of optional data as they are and any other byte as a dot
+DOTTED_TABLE = bytes(byte if 0x20 <= byte < 0x7f else ord('.') for byte in range(256))
+# Windows BCD objects start with "WINDOWS\0" and a binary header of three 32-bit fields, then
+# comes the UTF-16 text
+WINDOWS_PREFIX = b'WINDOWS'
+WINDOWS_HEADER_SIZE = 20
+
+
+def decode_printed_utf16(printed: bytes) -> str:
+    """
+    Decodes optional data as printed by efibootmgr -v, in ASCII bytes. Optional data made of
+    UTF-16 characters has a dot for the null high byte of every character, so dots at odd offsets
+    are taken as null bytes. The binary header of Windows BCD objects is kept as printed. Anything
+    that is not UTF-16, odd-sized text such as "x.y" included, is returned as printed.
+    """
+    prefix = WINDOWS_HEADER_SIZE if printed.startswith(WINDOWS_PREFIX) else 0
+    utf16 = printed[prefix:]
+    dots = utf16.count(b'.')
+    if not dots or (dots == 1 and utf16.endswith(b'.')) or len(utf16) % 2:
+        return printed.decode('ascii')
+    if not utf16[1::2].strip(b'.'):
+        # every high byte is null, characters are simply every other byte
+        return printed[:prefix].decode('ascii') + utf16[::2].decode('ascii')
+    pairs = bytearray(utf16)
+    pairs[1::2] = pairs[1::2].replace(b'.', b'\0')
+    try:
+        decoded = pairs.decode('utf-16-le')
+    except UnicodeDecodeError as e:
+        logging.warning("Could not decode '%s': %s", printed.decode('ascii'), e)
+        return printed.decode('ascii')
+    return printed[:prefix].decode('ascii') + decoded
+
+
+def decode_dotted_utf16(code: str) -> str:
+    """Decodes UTF-16 optional data printed by efibootmgr -v, see decode_printed_utf16()"""
+    if not code.isascii():
+        # efibootmgr -v only prints ASCII, this is already text
+        return code
+    return decode_printed_utf16(code.encode('ascii'))
+
+
+def decode_dotted_bytes(optional_data: bytes | memoryview) -> str:
+    """:return: optional data decoded the same as once printed by efibootmgr -v and decode_dotted_utf16()"""
+    return decode_printed_utf16(bytes(optional_data).translate(DOTTED_TABLE))
+
+
+def is_dotted_utf16(code: str) -> bool:
+    """:return: True if code can only be UTF-16 text printed with a dot after every character"""
+    return len(code) >= 4 and not code[1::2].strip('.') and bool(code[::2].strip('.'))
+
+
+def is_dotted_optional_data(code: str) -> bool:
+    """:return: True if code looks like dotted UTF-16, after the binary header of Windows BCD objects if any"""
+    return is_dotted_utf16(code[WINDOWS_HEADER_SIZE:] if code.startswith(WINDOWS_PREFIX.decode()) else code)
+
+
+unicode_text_regex = re.compile(r'[^\x20-\x7f]|\w=[^.\s]')
+
+
+def is_unicode_text(code: str) -> bool:
+    """
+    :return: True if code can only be optional data printed as text by efibootmgr --unicode:
+        efibootmgr -v prints anything but ASCII (DEL included) as dots and UTF-16 key=value
+        pairs (e.g. a kernel command line) with dots between the characters.
+    """
+    return not is_dotted_utf16(code) and unicode_text_regex.search(code) is not None
+
+
+@dataclass(frozen=True, slots=True)
+class ParameterFormat:
+    """How a release of efibootmgr prints the optional data of boot entries"""
+    name: str
+    # True when the parameters of an entry could only have been printed in this format
+    detect: Callable[[str], bool]
+    decode: Callable[[str], str]
+
+
+# efibootmgr 17 and earlier, or newer ones when optional data is not UCS-2
+DOTTED_FORMAT = ParameterFormat('dotted UTF-16', is_dotted_utf16, decode_dotted_utf16)
+# efibootmgr 18 and later with --unicode
+UNICODE_FORMAT = ParameterFormat('unicode', is_unicode_text, str)
 
 
 class Efibootmgr(abc.ABC):
-    version_regex = re.compile(r'version ([0-9]+)')
     parse_line_regex = re.compile(r'^Boot([0-9A-F]+)(\*)? (.+)\t(?:.+/File\((.+)\)|.*\))(.*)$')
+    partition_regex = re.compile(r'HD\([0-9a-fA-F]+,GPT,([0-9a-fA-F-]{36}),')
     log = logging.getLogger('Efibootmgr')
-
-    @staticmethod
-    def get_version() -> str:
-        output = subprocess_run_wrapper(["efibootmgr", "--version"])
-        matched = Efibootmgr.version_regex.match(output)
-        version = matched.group(1)
-        Efibootmgr.log.info("efibootmgr version %s detected", version)
-        return version
+    parser_log = logging.getLogger('parser')
+    # tried in order on the parameters of entries until one recognizes the format of the output,
+    # the first one decodes the parameters that look like it (see is_dotted_optional_data) in
+    # outputs none of them recognizes. Empty if parameters are decoded by dispatch_line().
+    parameter_formats: tuple[ParameterFormat, ...] = ()
 
     @staticmethod
     def get_instance() -> 'Efibootmgr':
-        version = Efibootmgr.get_version()
-        match version:
-            case "17":
-                return EfibootmgrV17()
-            case "18":
-                return EfibootmgrV18()
-            case _:
-                raise NotImplementedError(f"efibootmgr version {version} is not supported")
+        efivarfs = Efivarfs()
+        if efivarfs.is_available():
+            Efibootmgr.log.info("efivarfs available at %s, reading EFI variables directly", efivarfs.path)
+            return EfibootmgrEfivarfs(efivarfs)
+        return EfibootmgrText()
 
     @abc.abstractmethod
-    def run(self) -> list[str]:
-        pass
+    def run(self) -> Iterable:
+        """:return: the lines to parse. They can be produced while they are parsed."""
 
-    @staticmethod
-    @abc.abstractmethod
-    def parse_line(line: str) -> tuple[str, object]:
-        pass
+    # efibootmgr prints "Key: value" lines, dispatched on the key with a single lookup
+    variable_parsers = {
+        'BootOrder': ('boot_order', lambda value: [num for num in value.strip().split(',') if num]),
+        'BootNext': ('boot_next', str.strip),
+        'BootCurrent': ('boot_current', str.strip),
+        'Timeout': ('timeout', lambda value: int(value.split()[0])),
+    }
+
+    @classmethod
+    def dispatch_line(cls, line: str) -> tuple[str, object] | None:
+        """
+        Parses a line of efibootmgr output. The parameters of entries are left as printed.
+        :return: key and value or None if the line is not about boot entries (e.g. MirrorMemoryBelow4GB).
+        :raise ValueError: if the value of a known key is malformed.
+        """
+        key, separator, value = line.partition(':')
+        if separator and key in cls.variable_parsers:
+            name, parse_value = cls.variable_parsers[key]
+            return name, parse_value(value)
+        if line.startswith('Boot'):
+            match = cls.parse_line_regex.match(line)
+            if match and match.group(1) and match.group(3):
+                num, active, name, path, params = match.groups()
+                partition = cls.partition_regex.search(line) if 'GPT,' in line else None
+                return 'entry', ParsedEfibootmgrEntry(num=num, active=active is not None, name=name,
+                                                      path=path if path else '', parameters=params,
+                                                      partition=partition.group(1).lower() if partition else None)
+        return None
 
     @classmethod
-    def parse(cls, boot: list[str]) -> ParsedEfibootmgr:
-        parser_logger = logging.getLogger("parser")
+    def detect_format(cls, parameters: str) -> ParameterFormat | None:
+        for parameter_format in cls.parameter_formats:
+            if parameter_format.detect(parameters):
+                return parameter_format
+        return None
+
+    @classmethod
+    def parse_line(cls, line) -> tuple[str, object]:
+        """Parses a single line, the format of parameters is detected from that line alone"""
+        parsed = cls.dispatch_line(line)
+        if parsed is None:
+            raise ValueError("line didn't match", repr(line))
+        key, value = parsed
+        if key == 'entry' and cls.parameter_formats:
+            parameter_format = cls.detect_format(value.parameters)
+            if parameter_format is not None:
+                value.parameters = parameter_format.decode(value.parameters)
+            else:
+                value.parameters = cls.decode_undetected(value.parameters)
+        return parsed
+
+    @classmethod
+    def decode_undetected(cls, parameters: str) -> str:
+        """Decodes parameters of an output whose format is unknown: only if they look dotted, else as printed"""
+        return cls.parameter_formats[0].decode(parameters) if is_dotted_optional_data(parameters) else parameters
+
+    @classmethod
+    @profiler.timed('parse')
+    def parse(cls, boot: Iterable) -> ParsedEfibootmgr:
+        """
+        Parses the lines of boot in a single pass, as they come. The parameters of entries are
+        kept as printed until the format of the output is recognized, then all are decoded. If it
+        never is, only those that look dotted are decoded (see decode_undetected), the others
+        stay as printed: decoding text as dotted UTF-16 garbles it.
+        """
+        debug = cls.parser_log.isEnabledFor(logging.DEBUG)
         parsed_efi = {
             'entries': [],
             'boot_order': [],
@@ -82,110 +284,128 @@ class Efibootmgr(abc.ABC):
             'boot_current': None,
             'timeout': None
         }
+        parameter_format = None
+        undecoded = []
 
         for line in boot:
             try:
-                key, value = cls.parse_line(line)
-                if key == 'entry':
-                    parsed_efi['entries'].append(value)
-                else:
-                    parsed_efi[key] = value
+                parsed = cls.dispatch_line(line)
             except ValueError as e:
-                parser_logger.warning("line didn't match: %s", e.args[1])
+                cls.parser_log.warning("line didn't match: %r: %s", line, e)
+                continue
+            if parsed is None:
+                if debug:
+                    cls.parser_log.debug("Ignored line: %r", line)
+                continue
+            key, value = parsed
+            if debug:
+                cls.parser_log.debug("%s: %s", key, value)
+            if key != 'entry':
+                parsed_efi[key] = value
+                continue
+            parsed_efi['entries'].append(value)
+            if not cls.parameter_formats or not value.parameters:
+                continue
+            if parameter_format is None:
+                parameter_format = cls.detect_format(value.parameters)
+                if parameter_format is None:
+                    undecoded.append(value)
+                    continue
+                cls.parser_log.info("Parameters printed as %s", parameter_format.name)
+                for entry in undecoded:
+                    entry.parameters = parameter_format.decode(entry.parameters)
+                undecoded = []
+            value.parameters = parameter_format.decode(value.parameters)
 
+        for entry in undecoded:
+            entry.parameters = cls.decode_undetected(entry.parameters)
         return ParsedEfibootmgr(**parsed_efi)
 
 
-class EfibootmgrV17(Efibootmgr):
-    def run(self) -> list[str]:
-        output = subprocess_run_wrapper(["efibootmgr", "-v"]).strip().split('\n')
-        logging.debug(repr(output))
-        return output
+class EfibootmgrText(Efibootmgr):
+    """
+    Parses the output of any efibootmgr version: -v makes older ones print device paths and
+    --unicode newer ones print parameters as text. Which of them did is found from the output.
+    """
+    parameter_formats = (DOTTED_FORMAT, UNICODE_FORMAT)
 
-    @staticmethod
-    def decode_params(code: str) -> str:
-        if '.' not in code:
-            return code
-        if code.endswith('.') and code.count('.') == 1:
-            return code
-        if code.startswith('WINDOWS'):
-            return 'WINDOWS' + EfibootmgrV17.decode_params(code[len('WINDOWS'):])
-        try:
-            # Decode as UTF-16 (why efibootmgr displays it like that?)
-            code_bytes = bytearray(code, 'utf-8')
-            for i, byte in enumerate(code_bytes):
-                if i % 2 == 1 and byte == ord('.'):
-                    code_bytes[i] = 0
-            decoded = code_bytes.decode('utf-16')
-            return decoded
-        except UnicodeDecodeError as e:
-            logging.warning("Could not decode '%s': %s", code, e)
-            return code
+    def run(self) -> Iterator[str]:
+        # efibootmgr 17 and earlier print no device path, so no File() nor parameters, without -v.
+        # Newer ones add dp: and data: lines after every entry with -v, dispatch_line() skips them
+        # like any unknown line, which is cheaper than running efibootmgr --version to choose the options.
+        return subprocess_lines(["efibootmgr", "-v", "--unicode"])
 
-    @staticmethod
-    def parse_line(line: str) -> tuple[str, object]:
-        parser_logger = logging.getLogger("parser")
-        match = Efibootmgr.parse_line_regex.match(line)
-
-        if match and match.group(1) and match.group(3):
-            num, active, name, path, params = match.groups()
-            params = EfibootmgrV17.decode_params(params)
-            parsed_entry = ParsedEfibootmgrEntry(num=num, active=active is not None, name=name,
-                                                 path=path if path else '', parameters=params)
-            parser_logger.debug("Entry: %s", parsed_entry)
-            return 'entry', parsed_entry
-        if line.startswith("BootOrder"):
-            parsed = line.split(':')[1].strip().split(',')
-            parser_logger.debug("BootOrder: %s", parsed)
-            return 'boot_order', parsed
-        if line.startswith("BootNext"):
-            parsed = line.split(':')[1].strip()
-            parser_logger.debug("BootNext: %s", parsed)
-            return 'boot_next', parsed
-        if line.startswith("BootCurrent"):
-            parsed = line.split(':')[1].strip()
-            parser_logger.debug("BootCurrent: %s", parsed)
-            return 'boot_current', parsed
-        if line.startswith("Timeout"):
-            parsed = int(line.split(':')[1].split()[0].strip())
-            parser_logger.debug("Timeout: %s", parsed)
-            return 'timeout', parsed
-
-        raise ValueError("line didn't match", repr(line))
-
-
-class EfibootmgrV18(Efibootmgr):
-    def run(self):
-        output = subprocess_run_wrapper(["efibootmgr", "--unicode"]).strip().split('\n')
-        logging.debug(repr(output))
-        return output
 
-    @staticmethod
-    def parse_line(line: str) -> tuple[str, object]:
-        parser_logger = logging.getLogger("parser")
-        match = Efibootmgr.parse_line_regex.match(line)
-
-        if match and match.group(1) and match.group(3):
-            num, active, name, path, params = match.groups()
-            parsed_entry = ParsedEfibootmgrEntry(num=num, active=active is not None, name=name,
-                                                 path=path if path else '', parameters=params)
-            parser_logger.debug("%s", parsed_entry)
-            return 'entry', parsed_entry
-        if line.startswith("BootOrder"):
-            parsed = line.split(':')[1].strip().split(',')
-            parser_logger.debug("BootOrder: %s", parsed)
-            return 'boot_order', parsed
-        if line.startswith("BootNext"):
-            parsed = line.split(':')[1].strip()
-            parser_logger.debug("BootNext: %s", parsed)
-            return 'boot_next', parsed
-        if line.startswith("BootCurrent"):
-            parsed = line.split(':')[1].strip()
-            parser_logger.debug("BootCurrent: %s", parsed)
-            return 'boot_current', parsed
-        if line.startswith("Timeout"):
-            parsed = int(line.split(':')[1].split()[0].strip())
-            parser_logger.debug("Timeout: %s", parsed)
-            return 'timeout', parsed
-
-        raise ValueError("line didn't match", repr(line))
+class EfibootmgrEfivarfs(Efibootmgr):
+    """Reads boot variables straight from efivarfs instead of running and parsing efibootmgr"""
+    def __init__(self, efivarfs: Efivarfs | None = None):
+        self.efivarfs = efivarfs if efivarfs is not None else Efivarfs()
+
+    def run(self) -> list[tuple[str, bytes]]:
+        with profiler.span('read efivarfs') as span:
+            variables = self.efivarfs.read_boot_variables()
+            span.add(variables=len(variables), bytes=sum(len(data) for _, data in variables))
+        return variables
+
+    def read_variables(self, names: set[str]) -> list[tuple[str, bytes | None]]:
+        """:return: name and data of the given variables, data is None for the deleted ones."""
+        with profiler.span('read efivarfs variables', variables=len(names)) as span:
+            # a malformed variable is left out like run() does
+            variables = [(name, self.efivarfs.read_boot_variable(name)) for name in sorted(names)]
+            span.add(bytes=sum(len(data) for _, data in variables if data is not None))
+        return variables
+
+    @classmethod
+    def patch(cls, parsed: ParsedEfibootmgr, variables: list[tuple[str, bytes | None]]) -> ParsedEfibootmgr:
+        """:return: a copy of parsed with only the given variables read again, see read_variables()."""
+        entries = {entry.num: entry for entry in parsed.entries}
+        patched = {'boot_order': parsed.boot_order, 'boot_next': parsed.boot_next,
+                   'boot_current': parsed.boot_current, 'timeout': parsed.timeout}
+        defaults = {'BootOrder': ('boot_order', []), 'BootNext': ('boot_next', None),
+                    'BootCurrent': ('boot_current', None), 'Timeout': ('timeout', None)}
+        for name, data in variables:
+            if data is None:
+                if name in defaults:
+                    key, value = defaults[name]
+                    patched[key] = value
+                else:
+                    entries.pop(name[4:], None)
+                continue
+            try:
+                key, value = cls.parse_line((name, data))
+            except ValueError as e:
+                logging.getLogger("parser").warning("line didn't match: %s", e.args[1])
+                continue
+            if key == 'entry':
+                entries[value.num] = value
+            else:
+                patched[key] = value
+        return ParsedEfibootmgr(entries=sorted(entries.values(), key=lambda entry: entry.num), **patched)
+
+    @classmethod
+    def dispatch_line(cls, line: tuple[str, bytes]) -> tuple[str, object] | None:
+        name, data = line
+        if name.startswith("Boot") and len(name) == 8 and name != "BootNext":
+            try:
+                load_option = parse_load_option(data)
+            except ValueError as e:
+                raise ValueError("invalid load option", f"{name}: {e}")
+            optional_data = load_option.optional_data
+            if is_ucs2(optional_data):
+                params = decode_optional_data(optional_data)
+            else:
+                params = decode_dotted_bytes(optional_data)
+            return 'entry', ParsedEfibootmgrEntry(num=name[4:], active=load_option.active,
+                                                  name=load_option.description, path=load_option.file_path,
+                                                  parameters=params, raw=data, partition=load_option.partition_guid)
+        if name == "BootOrder":
+            if len(data) % 2:
+                raise ValueError("invalid boot order", f"{name}: odd length {len(data)}")
+            return 'boot_order', [f'{num:04X}' for num, in struct.iter_unpack('<H', data)]
+        if name == "BootNext":
+            return 'boot_next', f'{int.from_bytes(data, "little"):04X}'
+        if name == "BootCurrent":
+            return 'boot_current', f'{int.from_bytes(data, "little"):04X}'
+        if name == "Timeout":
+            return 'timeout', int.from_bytes(data, 'little')
+        return None
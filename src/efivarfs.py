@@ -0,0 +1,202 @@
+"""
+Direct access to EFI variables through the efivarfs pseudo file system.
+
+Every file in efivarfs is named <VariableName>-<VendorGUID> and contains the
+variable attributes as a little endian 32 bit integer followed by the raw data.
+
+This module only depends on the standard library because it is also executed as a
+privileged helper (see main()) that applies a whole batch of writes in a single process.
+"""
+import fcntl
+import json
+import logging
+import os
+import re
+import struct
+import subprocess
+import sys
+
+EFIVARFS_PATH = '/sys/firmware/efi/efivars'
+EFI_GLOBAL_VARIABLE = '8be4df61-93ca-11d2-aa0d-00e098032b8c'
+
+EFI_VARIABLE_NON_VOLATILE = 0x00000001
+EFI_VARIABLE_BOOTSERVICE_ACCESS = 0x00000002
+EFI_VARIABLE_RUNTIME_ACCESS = 0x00000004
+DEFAULT_ATTRIBUTES = EFI_VARIABLE_NON_VOLATILE | EFI_VARIABLE_BOOTSERVICE_ACCESS | EFI_VARIABLE_RUNTIME_ACCESS
+
+FS_IOC_GETFLAGS = 0x80086601
+FS_IOC_SETFLAGS = 0x40086602
+FS_IMMUTABLE_FL = 0x00000010
+
+BOOT_VARIABLES = ('BootCurrent', 'BootNext', 'BootOrder', 'Timeout')
+
+boot_entry_regex = re.compile(r'^Boot([0-9A-F]{4})$')
+
+
+class Efivarfs:
+    """Reads EFI variables from an efivarfs mount point (or from a directory mimicking it)"""
+    log = logging.getLogger('Efivarfs')
+
+    def __init__(self, path: str = EFIVARFS_PATH):
+        self.path = path
+
+    def variable_path(self, name: str, guid: str = EFI_GLOBAL_VARIABLE) -> str:
+        return os.path.join(self.path, f'{name}-{guid}')
+
+    def is_available(self) -> bool:
+        return os.access(self.variable_path('BootOrder'), os.R_OK)
+
+    def read(self, name: str, guid: str = EFI_GLOBAL_VARIABLE) -> tuple[bytes, int] | tuple[None, None]:
+        """
+        Reads a single variable.
+        :return: variable data and attributes or (None, None) if the variable doesn't exist.
+        :raise ValueError: if the file is too short to hold the attributes.
+        """
+        try:
+            with open(self.variable_path(name, guid), 'rb') as f:
+                var_data = f.read()
+        except FileNotFoundError:
+            return None, None
+        if len(var_data) < 4:
+            raise ValueError(f"{name} is too short to hold its attributes: {len(var_data)} bytes")
+        attributes, = struct.unpack_from('<I', var_data)
+        return var_data[4:], attributes
+
+    def read_boot_variable(self, name: str) -> bytes | None:
+        """:return: the data of a boot related variable, None if it doesn't exist or is malformed."""
+        try:
+            return self.read(name)[0]
+        except ValueError as e:
+            self.log.warning("Skipping %s", e)
+            return None
+
+    def list_boot_entries(self) -> list[str]:
+        """:return: sorted names of all Boot#### variables in the EFI global namespace."""
+        suffix = '-' + EFI_GLOBAL_VARIABLE
+        names = []
+        with os.scandir(self.path) as it:
+            for dir_entry in it:
+                name = dir_entry.name
+                if name.endswith(suffix) and boot_entry_regex.match(name[:-len(suffix)]):
+                    names.append(name[:-len(suffix)])
+        return sorted(names)
+
+    def read_boot_variables(self) -> list[tuple[str, bytes]]:
+        """:return: name and data of every boot related variable that is set."""
+        names = list(BOOT_VARIABLES) + self.list_boot_entries()
+        variables = []
+        for name in names:
+            data = self.read_boot_variable(name)
+            if data is not None:
+                variables.append((name, data))
+        self.log.debug("Read %d variables from %s", len(variables), self.path)
+        return variables
+
+    @staticmethod
+    def boot_variable_name(file_name: str) -> str | None:
+        """:return: the name of the boot related variable stored in file_name or None."""
+        name, _, guid = file_name.partition('-')
+        if guid == EFI_GLOBAL_VARIABLE and (name in BOOT_VARIABLES or boot_entry_regex.match(name)):
+            return name
+        return None
+
+    def stat_boot_variables(self) -> dict[str, tuple[int, int]]:
+        """:return: modification time and size of every boot related variable, to poll for changes."""
+        stats = {}
+        with os.scandir(self.path) as it:
+            for dir_entry in it:
+                name = self.boot_variable_name(dir_entry.name)
+                if name is not None:
+                    stat = dir_entry.stat()
+                    stats[name] = (stat.st_mtime_ns, stat.st_size)
+        return stats
+
+    def _clear_immutable(self, path: str):
+        """efivarfs protects most variables with the immutable flag, like chattr -i does"""
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        try:
+            flags, = struct.unpack('i', fcntl.ioctl(fd, FS_IOC_GETFLAGS, struct.pack('i', 0)))
+            if flags & FS_IMMUTABLE_FL:
+                fcntl.ioctl(fd, FS_IOC_SETFLAGS, struct.pack('i', flags & ~FS_IMMUTABLE_FL))
+        except OSError as e:
+            self.log.debug("Could not clear immutable flag of %s: %s", path, e)
+        finally:
+            os.close(fd)
+
+    def write(self, name: str, data: bytes, attributes: int = DEFAULT_ATTRIBUTES, guid: str = EFI_GLOBAL_VARIABLE):
+        """Creates or replaces a variable. efivarfs requires attributes and data in a single write."""
+        path = self.variable_path(name, guid)
+        self._clear_immutable(path)
+        self.log.info("Writing %s (%d bytes)", name, len(data))
+        with open(path, 'wb', buffering=0) as f:
+            f.write(struct.pack('<I', attributes) + data)
+
+    def delete(self, name: str, guid: str = EFI_GLOBAL_VARIABLE):
+        path = self.variable_path(name, guid)
+        self._clear_immutable(path)
+        self.log.info("Deleting %s", name)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def apply(self, writes: list[tuple]):
+        """
+        Applies writes in the given order: (name, data) or (name, data, attributes) tuples.
+        None data means the variable has to be deleted.
+        """
+        for name, data, *attributes in writes:
+            if data is None:
+                self.delete(name)
+            else:
+                self.write(name, data, *attributes)
+
+
+def dump_batch(writes: list[tuple], reboot: bool = False) -> str:
+    """Serializes a batch of writes, as accepted by Efivarfs.apply(), for main()"""
+    return json.dumps({
+        'writes': [[name, None if data is None else data.hex(), *attributes] for name, data, *attributes in writes],
+        'reboot': reboot,
+    })
+
+
+def check_write(name: str, attributes: list[int]):
+    """
+    Limits what privileged code writes to the boot variables.
+    :raise ValueError: if name is not a writable boot variable or attributes are not the ones boot
+        variables are defined with.
+    """
+    if not isinstance(name, str) or not boot_entry_regex.match(name) and name not in ('BootOrder', 'BootNext',
+                                                                                      'Timeout'):
+        raise ValueError(f"refusing to write {name}")
+    if len(attributes) > 1 or any(not isinstance(value, int) or value & ~DEFAULT_ATTRIBUTES for value in attributes):
+        raise ValueError(f"refusing to write {name} with attributes {attributes}")
+
+
+def load_batch(batch: str) -> tuple[list[tuple], bool]:
+    decoded = json.loads(batch)
+    writes = []
+    for name, data, *attributes in decoded['writes']:
+        check_write(name, attributes)
+        writes.append((name, None if data is None else bytes.fromhex(data), *attributes))
+    return writes, bool(decoded.get('reboot', False))
+
+
+def main():
+    """
+    Privileged helper entry point: reads a batch produced by dump_batch() from stdin and applies it.
+    Usage: pkexec python3 efivarfs.py [efivarfs path]
+    """
+    logging.basicConfig(level=logging.INFO)
+    efivarfs = Efivarfs(sys.argv[1] if len(sys.argv) > 1 else EFIVARFS_PATH)
+    writes, reboot = load_batch(sys.stdin.read())
+    efivarfs.apply(writes)
+    if reboot:
+        subprocess.run(['reboot'], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+EFI System Partition auto-detection.
+
+All candidates are found in one pass: mounted ESPs come from /proc/self/mountinfo and ESP
+partitions from sysfs and the udev database, without running any process. When those are not
+usable (e.g. inside the Flatpak sandbox, where they describe the sandbox instead of the host),
+findmnt and lsblk are run once each, concurrently.
+"""
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from efiboots.efibootmgr import is_in_flatpak, subprocess_run_wrapper
+from efiboots.profiling import profiler
+
+ESP_MOUNT_POINTS = ('/efi', '/boot/efi', '/boot')
+ESP_PART_TYPES = ('c12a7328-f81f-11d2-ba4b-00a0c93ec93b', '0xef', 'ef')
+
+PROC_MOUNTINFO = '/proc/self/mountinfo'
+SYS_CLASS_BLOCK = '/sys/class/block'
+UDEV_DATA = '/run/udev/data'
+
+device_regex = re.compile(r'^([a-z/]+[0-9a-z]*?)p?([0-9]+)$')
+mountinfo_escape_regex = re.compile(r'\\([0-7]{3})')
+
+
+class MultipleEspsError(Exception):
+    """More than one ESP has been found and the user has to choose one with --disk and --part"""
+    def __init__(self, esps: list[str]):
+        super().__init__(esps)
+        self.esps = esps
+
+
+def device_to_disk_part(device: str) -> tuple[str, str]:
+    try:
+        disk, part = device_regex.match(device).groups()
+        logging.debug("Device path %s split into %s and %s", device, disk, part)
+        return disk, part
+    except AttributeError:
+        raise ValueError("Could not match device " + device)
+
+
+def read_mountinfo(path: str = PROC_MOUNTINFO) -> dict[str, tuple[str, str]]:
+    """:return: mount point -> (source, file system type) of every mount"""
+    mounts = {}
+    with open(path) as f:
+        for line in f:
+            fields, _, fs_fields = line.partition(' - ')
+            mount_point = mountinfo_escape_regex.sub(lambda m: chr(int(m.group(1), 8)), fields.split()[4])
+            fs_type, source = fs_fields.split()[:2]
+            mounts[mount_point] = (source, fs_type)
+    return mounts
+
+
+def read_udev_properties(major_minor: str, udev_data: str = UDEV_DATA) -> dict[str, str]:
+    properties = {}
+    with open(os.path.join(udev_data, f'b{major_minor}')) as f:
+        for line in f:
+            if line.startswith('E:'):
+                key, _, value = line[2:].rstrip('\n').partition('=')
+                properties[key] = value
+    return properties
+
+
+def scan_esp_partitions(sys_class_block: str = SYS_CLASS_BLOCK, udev_data: str = UDEV_DATA) -> list[str]:
+    """
+    Lists the vfat partitions having the ESP partition type, using sysfs and the udev database.
+    :raise OSError: if the udev database is not available.
+    """
+    if not os.path.isdir(udev_data):
+        raise FileNotFoundError(udev_data)
+    esps = []
+    for dir_entry in os.scandir(sys_class_block):
+        if not os.path.exists(os.path.join(dir_entry.path, 'partition')):
+            continue
+        with open(os.path.join(dir_entry.path, 'dev')) as f:
+            major_minor = f.read().strip()
+        try:
+            properties = read_udev_properties(major_minor, udev_data)
+        except FileNotFoundError:
+            continue
+        if properties.get('ID_PART_ENTRY_TYPE', '').lower() in ESP_PART_TYPES and \
+                properties.get('ID_FS_TYPE') == 'vfat':
+            esps.append(os.path.join('/dev', dir_entry.name))
+    return sorted(esps)
+
+
+def disk_part_to_device(disk: str, part: str) -> str:
+    """The opposite of device_to_disk_part(): /dev/nvme0n1 and 1 give /dev/nvme0n1p1"""
+    return f'{disk}p{part}' if disk[-1:].isdigit() else f'{disk}{part}'
+
+
+def scan_with_commands(cancel: threading.Event | None = None) -> tuple[dict[str, tuple[str, str]], list[str]]:
+    """Same as read_mountinfo() and scan_esp_partitions(), but running findmnt and lsblk concurrently"""
+    findmnt_cmd = ['findmnt', '--json', '--list', '--output', 'SOURCE,TARGET,FSTYPE']
+    lsblk_cmd = ['lsblk', '--json', '--paths', '--output', 'NAME,PARTTYPE,FSTYPE']
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        findmnt_future = executor.submit(subprocess_run_wrapper, findmnt_cmd, cancel=cancel)
+        lsblk_future = executor.submit(subprocess_run_wrapper, lsblk_cmd, cancel=cancel)
+
+    mounts = {}
+    try:
+        for filesystem in json.loads(findmnt_future.result())['filesystems']:
+            mounts[filesystem['target']] = (filesystem['source'], filesystem['fstype'])
+    except (FileNotFoundError, subprocess.CalledProcessError) as e:
+        logging.warning("Could not detect ESP with findmnt: %s", e)
+    except (ValueError, KeyError, TypeError) as e:
+        # JSONDecodeError is a ValueError
+        logging.warning("Unexpected findmnt output: %r", e)
+        mounts = {}
+
+    esps = []
+    try:
+        devices = json.loads(lsblk_future.result())['blockdevices']
+        while devices:
+            device = devices.pop()
+            devices.extend(device.get('children', []))
+            if (device.get('parttype') or '').lower() in ESP_PART_TYPES and device.get('fstype') == 'vfat':
+                esps.append(device['name'])
+    except (FileNotFoundError, subprocess.CalledProcessError) as e:
+        logging.warning("Could not detect ESP with lsblk: %s", e)
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logging.warning("Unexpected lsblk output: %r", e)
+        esps = []
+    return mounts, sorted(esps)
+
+
+def scan(cancel: threading.Event | None = None) -> tuple[dict[str, tuple[str, str]], list[str]]:
+    """:return: all the mounts and all the ESP partitions of the system"""
+    if not is_in_flatpak():
+        try:
+            return read_mountinfo(), scan_esp_partitions()
+        except OSError as e:
+            logging.info("Can't scan block devices directly, falling back to findmnt and lsblk: %s", e)
+    return scan_with_commands(cancel)
+
+
+def choose_esp(mounts: dict[str, tuple[str, str]], esps: list[str]) -> tuple[str, str] | tuple[None, None]:
+    """
+    An ESP mounted on /efi, /boot/efi or /boot (in this order) wins. Otherwise there must be
+    exactly one partition with the ESP type.
+    :raise MultipleEspsError: if more than one unmounted ESP is found.
+    """
+    for mount_point in ESP_MOUNT_POINTS:
+        source, fs_type = mounts.get(mount_point, (None, None))
+        if fs_type == 'vfat':
+            logging.debug("ESP mounted on %s: %s", mount_point, source)
+            return device_to_disk_part(source)
+    logging.info("ESP partitions: %s", esps)
+    if len(esps) > 1:
+        raise MultipleEspsError(esps)
+    if esps:
+        return device_to_disk_part(esps[0])
+    return None, None
+
+
+@profiler.timed('detect ESP')
+def auto_detect_esp(cancel: threading.Event | None = None) -> tuple[str, str] | tuple[None, None]:
+    disk, part = choose_esp(*scan(cancel))
+    if disk and part:
+        logging.info("Detected ESP on disk %s part %s", disk, part)
+    else:
+        logging.fatal("Can't auto-detect ESP! All methods failed.")
+    return disk, part
@@ -0,0 +1,222 @@
+"""
+Stable serialization of ParsedEfibootmgr, for inventories and for importing a boot state back
+as pending changes (see BootModel.import_state).
+
+Two forms are supported, both versioned:
+
+JSON, readable and easy to consume from other languages:
+
+    {
+        "schema": "efiboots", "version": 2,
+        "boot_current": "0001", "boot_next": null, "timeout": 1,
+        "boot_order": ["0001", "0003"],
+        "entries": [{"num": "0001", "active": true, "name": "rEFInd Boot Manager",
+                     "path": "\\EFI\\refind\\refind_x64.efi", "parameters": "", "raw": "01000000...",
+                     "partition": "fda4f976-b250-4569-be80-0449804ab7c2"}]
+    }
+
+"raw" is the EFI_LOAD_OPTION in hex, when it was read from efivarfs, and "partition" the GUID of
+the partition the entry points to, if any (version 2).
+
+Binary, compact and fast to load, little endian:
+
+    header   magic, version, flags telling which of BootNext, BootCurrent and Timeout are set,
+             BootNext, BootCurrent, Timeout
+    order    count, then every number as 16 bits
+    entries  count, then for every entry: number, flags (active, raw present, partition present),
+             name, path and parameters as 16 bit length and UTF-8, raw as 32 bit length and bytes,
+             partition GUID as 16 bytes (version 2)
+
+Version 1 exports, without partition GUIDs, are still loaded.
+"""
+import json
+import re
+import struct
+import uuid
+
+from efiboots.efibootmgr import ParsedEfibootmgr, ParsedEfibootmgrEntry
+
+SCHEMA = 'efiboots'
+SCHEMA_VERSION = 2
+
+MAGIC = b'EFBP'
+HEADER = struct.Struct('<4sHHHHH')
+COUNT = struct.Struct('<I')
+ENTRY_HEADER = struct.Struct('<HB')
+TEXT_LENGTH = struct.Struct('<H')
+RAW_LENGTH = struct.Struct('<I')
+
+HAS_BOOT_NEXT = 0x1
+HAS_BOOT_CURRENT = 0x2
+HAS_TIMEOUT = 0x4
+ENTRY_ACTIVE = 0x1
+ENTRY_RAW = 0x2
+ENTRY_PARTITION = 0x4
+GUID_SIZE = 16
+
+num_regex = re.compile(r'^[0-9A-F]{4}$')
+
+
+def check_num(num, what: str) -> str:
+    """:raise ValueError: if num is not a Boot#### number."""
+    if not isinstance(num, str) or not num_regex.match(num):
+        raise ValueError(f"invalid {what}: {num!r}")
+    return num
+
+
+def to_dict(parsed: ParsedEfibootmgr) -> dict:
+    entries = []
+    for entry in parsed.entries:
+        exported = {'num': entry.num, 'active': entry.active, 'name': entry.name, 'path': entry.path or '',
+                    'parameters': entry.parameters or ''}
+        if entry.raw is not None:
+            exported['raw'] = bytes(entry.raw).hex()
+        if entry.partition is not None:
+            exported['partition'] = entry.partition
+        entries.append(exported)
+    return {'schema': SCHEMA, 'version': SCHEMA_VERSION, 'boot_current': parsed.boot_current,
+            'boot_next': parsed.boot_next, 'timeout': parsed.timeout, 'boot_order': list(parsed.boot_order),
+            'entries': entries}
+
+
+def from_dict(exported: dict) -> ParsedEfibootmgr:
+    """:raise ValueError: if exported is not a valid export."""
+    if not isinstance(exported, dict) or exported.get('schema') != SCHEMA:
+        raise ValueError("not an efiboots export")
+    if not isinstance(exported.get('version'), int) or exported['version'] > SCHEMA_VERSION:
+        raise ValueError(f"export version {exported.get('version')} is not supported")
+    try:
+        entries = []
+        for entry in exported['entries']:
+            if not isinstance(entry['active'], bool) or not all(
+                    isinstance(entry[key], str) for key in ('name', 'path', 'parameters')) or \
+                    not isinstance(entry.get('partition', ''), str):
+                raise ValueError(f"invalid entry: {entry!r}")
+            raw = entry.get('raw')
+            entries.append(ParsedEfibootmgrEntry(num=check_num(entry['num'], "entry number"), active=entry['active'],
+                                                 name=entry['name'], path=entry['path'],
+                                                 parameters=entry['parameters'],
+                                                 raw=bytes.fromhex(raw) if raw is not None else None,
+                                                 partition=entry.get('partition')))
+        boot_order = [check_num(num, "BootOrder number") for num in exported['boot_order']]
+        boot_next, boot_current, timeout = exported['boot_next'], exported['boot_current'], exported['timeout']
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"invalid export: {e!r}")
+    if boot_next is not None:
+        check_num(boot_next, "BootNext")
+    if boot_current is not None:
+        check_num(boot_current, "BootCurrent")
+    if timeout is not None and (not isinstance(timeout, int) or not 0 <= timeout <= 0xffff):
+        raise ValueError(f"invalid timeout: {timeout!r}")
+    return ParsedEfibootmgr(entries=entries, boot_order=boot_order, boot_next=boot_next,
+                            boot_current=boot_current, timeout=timeout)
+
+
+def dump_json(parsed: ParsedEfibootmgr, indent: int | None = None) -> str:
+    return json.dumps(to_dict(parsed), indent=indent)
+
+
+def load_json(text: str | bytes) -> ParsedEfibootmgr:
+    return from_dict(json.loads(text))
+
+
+def _pack_text(text: str) -> bytes:
+    encoded = text.encode('utf-8')
+    return TEXT_LENGTH.pack(len(encoded)) + encoded
+
+
+def dump_binary(parsed: ParsedEfibootmgr) -> bytes:
+    """:raise ValueError: if an entry number is not a Boot#### number (e.g. a new entry)."""
+    flags = (HAS_BOOT_NEXT if parsed.boot_next is not None else 0) | \
+            (HAS_BOOT_CURRENT if parsed.boot_current is not None else 0) | \
+            (HAS_TIMEOUT if parsed.timeout is not None else 0)
+    nums = [int(check_num(num, "BootOrder number"), 16) for num in parsed.boot_order]
+    chunks = [HEADER.pack(MAGIC, SCHEMA_VERSION, flags,
+                          int(check_num(parsed.boot_next, "BootNext"), 16) if parsed.boot_next is not None else 0,
+                          int(check_num(parsed.boot_current, "BootCurrent"), 16) if parsed.boot_current is not None
+                          else 0,
+                          parsed.timeout or 0),
+              COUNT.pack(len(nums)), struct.pack(f'<{len(nums)}H', *nums), COUNT.pack(len(parsed.entries))]
+    for entry in parsed.entries:
+        entry_flags = (ENTRY_ACTIVE if entry.active else 0) | (ENTRY_RAW if entry.raw is not None else 0) | \
+                      (ENTRY_PARTITION if entry.partition is not None else 0)
+        chunks += [ENTRY_HEADER.pack(int(check_num(entry.num, "entry number"), 16), entry_flags),
+                   _pack_text(entry.name), _pack_text(entry.path or ''), _pack_text(entry.parameters or '')]
+        if entry.raw is not None:
+            chunks += [RAW_LENGTH.pack(len(entry.raw)), bytes(entry.raw)]
+        if entry.partition is not None:
+            chunks.append(uuid.UUID(entry.partition).bytes)
+    return b''.join(chunks)
+
+
+def load_binary(data: bytes) -> ParsedEfibootmgr:
+    """:raise ValueError: if data is not a valid binary export."""
+    try:
+        magic, version, flags, boot_next, boot_current, timeout = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("not an efiboots binary export")
+        if version > SCHEMA_VERSION:
+            raise ValueError(f"export version {version} is not supported")
+        offset = HEADER.size
+        count, = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        boot_order = [f'{num:04X}' for num in struct.unpack_from(f'<{count}H', data, offset)]
+        offset += 2 * count
+        count, = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+
+        entries = []
+        for _ in range(count):
+            num, entry_flags = ENTRY_HEADER.unpack_from(data, offset)
+            offset += ENTRY_HEADER.size
+            texts = []
+            for _ in range(3):
+                length, = TEXT_LENGTH.unpack_from(data, offset)
+                offset += TEXT_LENGTH.size
+                texts.append(data[offset:offset + length].decode('utf-8'))
+                offset += length
+            raw = None
+            if entry_flags & ENTRY_RAW:
+                length, = RAW_LENGTH.unpack_from(data, offset)
+                offset += RAW_LENGTH.size
+                raw = data[offset:offset + length]
+                offset += length
+            partition = None
+            if entry_flags & ENTRY_PARTITION:
+                partition = str(uuid.UUID(bytes=data[offset:offset + GUID_SIZE]))
+                offset += GUID_SIZE
+            entries.append(ParsedEfibootmgrEntry(num=f'{num:04X}', active=bool(entry_flags & ENTRY_ACTIVE),
+                                                 name=texts[0], path=texts[1], parameters=texts[2], raw=raw,
+                                                 partition=partition))
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ValueError(f"truncated export: {e}")
+    if offset != len(data):
+        raise ValueError("truncated export: unexpected data after the entries")
+    return ParsedEfibootmgr(entries=entries, boot_order=boot_order,
+                            boot_next=f'{boot_next:04X}' if flags & HAS_BOOT_NEXT else None,
+                            boot_current=f'{boot_current:04X}' if flags & HAS_BOOT_CURRENT else None,
+                            timeout=timeout if flags & HAS_TIMEOUT else None)
+
+
+def loads(data: bytes) -> ParsedEfibootmgr:
+    """Loads either form, telling them apart by the binary magic"""
+    if data.startswith(MAGIC):
+        return load_binary(data)
+    return load_json(data)
+
+
+def save(parsed: ParsedEfibootmgr, path: str, binary: bool | None = None):
+    """Saves parsed in binary form or as JSON, by default depending on whether path ends with .bin"""
+    if binary is None:
+        binary = path.endswith('.bin')
+    if binary:
+        data = dump_binary(parsed)
+    else:
+        data = dump_json(parsed, indent=4).encode()
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def load(path: str) -> ParsedEfibootmgr:
+    with open(path, 'rb') as f:
+        return loads(f.read())
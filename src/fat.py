@@ -0,0 +1,157 @@
+"""
+Minimal read-only FAT12/16/32 reader, to list the files of an ESP that is not mounted.
+
+Only what is needed to walk the directory tree is decoded:
+
+    boot sector      BIOS parameter block: sector and cluster sizes, reserved sectors, FATs,
+                     root directory (a fixed area on FAT12/16, a cluster chain on FAT32)
+    FAT              read whole, cluster chains are followed in memory
+    directories      32 byte entries, long file names (VFAT) with their checksum, 8.3 names
+                     otherwise; deleted entries, volume labels, . and .. are skipped
+"""
+import struct
+from typing import BinaryIO
+
+BOOT_SECTOR = struct.Struct('<3x8sHBHBHHxHxxxxxxxxII')
+FAT32_ROOT_CLUSTER = struct.Struct('<I')
+DIR_ENTRY_SIZE = 32
+
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_LONG_NAME = 0x0f
+LAST_LONG_ENTRY = 0x40
+DELETED = 0xe5
+
+FAT12_MAX_CLUSTERS = 4085
+FAT16_MAX_CLUSTERS = 65525
+
+
+def short_name_checksum(name: bytes) -> int:
+    checksum = 0
+    for byte in name:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + byte) & 0xff
+    return checksum
+
+
+def short_name(name: bytes) -> str:
+    if name[0] == 0x05:
+        name = b'\xe5' + name[1:]
+    base, ext = name[:8].rstrip(b' '), name[8:].rstrip(b' ')
+    return (base + b'.' + ext if ext else base).decode('cp437')
+
+
+class FatFileSystem:
+    """Lists the files of the FAT file system read from f, a file or block device opened in binary mode"""
+
+    def __init__(self, f: BinaryIO):
+        self.f = f
+        boot_sector = f.read(512)
+        if len(boot_sector) < 512 or boot_sector[510:512] != b'\x55\xaa':
+            raise ValueError("not a FAT file system: boot sector signature missing")
+        (_, self.bytes_per_sector, self.sectors_per_cluster, reserved_sectors, fats, root_entries,
+         total_sectors, fat_size, total_sectors_32, fat_size_32) = BOOT_SECTOR.unpack_from(boot_sector)
+        if self.bytes_per_sector not in (512, 1024, 2048, 4096) or self.sectors_per_cluster == 0 or fats == 0:
+            raise ValueError("not a FAT file system: invalid BIOS parameter block")
+        fat_size = fat_size or fat_size_32
+        total_sectors = total_sectors or total_sectors_32
+        root_sectors = (root_entries * DIR_ENTRY_SIZE + self.bytes_per_sector - 1) // self.bytes_per_sector
+
+        self.root_offset = (reserved_sectors + fats * fat_size) * self.bytes_per_sector
+        self.root_size = root_sectors * self.bytes_per_sector
+        self.data_offset = self.root_offset + self.root_size
+        self.cluster_size = self.sectors_per_cluster * self.bytes_per_sector
+        self.clusters = (total_sectors - reserved_sectors - fats * fat_size - root_sectors) // self.sectors_per_cluster
+        if self.clusters < FAT12_MAX_CLUSTERS:
+            self.bits = 12
+        elif self.clusters < FAT16_MAX_CLUSTERS:
+            self.bits = 16
+        else:
+            self.bits = 32
+            self.root_cluster, = FAT32_ROOT_CLUSTER.unpack_from(boot_sector, 44)
+
+        f.seek(reserved_sectors * self.bytes_per_sector)
+        self.fat = f.read(fat_size * self.bytes_per_sector)
+
+    def next_cluster(self, cluster: int) -> int | None:
+        """:return: the cluster following cluster in its chain or None at the end of it"""
+        if self.bits == 12:
+            value, = struct.unpack_from('<H', self.fat, cluster + cluster // 2)
+            value = value >> 4 if cluster & 1 else value & 0xfff
+            end = 0xff8
+        elif self.bits == 16:
+            value, = struct.unpack_from('<H', self.fat, cluster * 2)
+            end = 0xfff8
+        else:
+            value = struct.unpack_from('<I', self.fat, cluster * 4)[0] & 0x0fffffff
+            end = 0x0ffffff8
+        return value if 2 <= value < end else None
+
+    def read_chain(self, cluster: int) -> bytes:
+        """:raise ValueError: if the chain loops or leaves the FAT."""
+        chunks = []
+        seen = set()
+        while cluster is not None:
+            if cluster in seen or cluster >= self.clusters + 2:
+                raise ValueError(f"corrupted cluster chain at cluster {cluster}")
+            seen.add(cluster)
+            self.f.seek(self.data_offset + (cluster - 2) * self.cluster_size)
+            chunks.append(self.f.read(self.cluster_size))
+            try:
+                cluster = self.next_cluster(cluster)
+            except struct.error:
+                raise ValueError(f"cluster {cluster} is beyond the FAT")
+        return b''.join(chunks)
+
+    def read_root(self) -> bytes:
+        if self.bits == 32:
+            return self.read_chain(self.root_cluster)
+        self.f.seek(self.root_offset)
+        return self.f.read(self.root_size)
+
+    @staticmethod
+    def entries(directory: bytes) -> list[tuple[str, bool, int]]:
+        """:return: name, whether it is a directory and first cluster of every entry of directory"""
+        entries = []
+        long_name = []
+        checksum = None
+        for offset in range(0, len(directory) - DIR_ENTRY_SIZE + 1, DIR_ENTRY_SIZE):
+            entry = directory[offset:offset + DIR_ENTRY_SIZE]
+            if entry[0] == 0:
+                break
+            if entry[0] == DELETED:
+                long_name = []
+                continue
+            attributes = entry[11]
+            if attributes == ATTR_LONG_NAME:
+                if entry[0] & LAST_LONG_ENTRY:
+                    long_name, checksum = [], entry[13]
+                long_name.insert(0, entry[1:11] + entry[14:26] + entry[28:32])
+                continue
+            name = entry[:11]
+            if long_name and checksum == short_name_checksum(name):
+                text = b''.join(long_name).decode('utf-16-le', 'replace')
+                text = text.split('\x00', 1)[0]
+            else:
+                text = short_name(name)
+            long_name = []
+            if attributes & ATTR_VOLUME_ID or text in ('.', '..'):
+                continue
+            cluster = struct.unpack_from('<H', entry, 20)[0] << 16 | struct.unpack_from('<H', entry, 26)[0]
+            entries.append((text, bool(attributes & ATTR_DIRECTORY), cluster))
+        return entries
+
+    def walk(self) -> list[str]:
+        """:return: the path of every file, like \\EFI\\BOOT\\BOOTX64.EFI"""
+        paths = []
+        pending = [('', self.read_root())]
+        seen = set()
+        while pending:
+            prefix, directory = pending.pop()
+            for name, is_directory, cluster in self.entries(directory):
+                path = f'{prefix}\\{name}'
+                if not is_directory:
+                    paths.append(path)
+                elif cluster >= 2 and cluster not in seen:
+                    seen.add(cluster)
+                    pending.append((path, self.read_chain(cluster)))
+        return sorted(paths)
@@ -0,0 +1,207 @@
+"""
+Offline analysis of boot configurations collected from many hosts.
+
+The input is a directory (searched recursively) or a tar archive, possibly compressed, of dumps:
+the output of `efibootmgr -v` or `efibootmgr -v --unicode`, or exports (see export.py). The host
+of a dump is its file name without extension. Dumps are parsed in parallel by a process pool and
+every host gets one row of the summary, kept in columns:
+
+    host           name of the dump
+    entries        number of boot entries
+    active         number of active entries
+    duplicates     loaders (with their parameters) of more than one entry
+    orphans        BootOrder numbers without an entry
+    current_first  False if the firmware didn't boot the first entry of BootOrder
+    error          why the dump could not be parsed, empty otherwise
+"""
+import contextlib
+import itertools
+import logging
+import os
+import tarfile
+from collections import Counter
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+from efiboots import export
+from efiboots.desiredstate import normalize_loader
+from efiboots.efibootmgr import EfibootmgrText, ParsedEfibootmgr
+
+# dumps sent to a worker at once, large enough to make the cost of pickling them negligible
+CHUNK_SIZE = 512
+
+
+@dataclass(slots=True)
+class HostReport:
+    host: str
+    entries: int = 0
+    active: int = 0
+    duplicates: list[str] = field(default_factory=list)
+    orphans: list[str] = field(default_factory=list)
+    current_first: bool = True
+    error: str = ''
+    # loader of every entry, for FleetSummary.loaders
+    loaders: list[str] = field(default_factory=list)
+
+
+def host_name(path: str) -> str:
+    name = os.path.basename(path)
+    # only the last suffix: web01.example.com.txt is host web01.example.com
+    return os.path.splitext(name)[0] or name
+
+
+def parse_dump(data: bytes) -> ParsedEfibootmgr:
+    """:raise ValueError: if data is neither efibootmgr output nor an export."""
+    if data.startswith(export.MAGIC) or data.lstrip().startswith(b'{'):
+        return export.loads(data)
+    parsed = EfibootmgrText.parse(data.decode('utf-8', 'replace').splitlines())
+    if not parsed.entries and not parsed.boot_order and parsed.boot_current is None:
+        raise ValueError("not an efibootmgr output")
+    return parsed
+
+
+def analyze(host: str, parsed: ParsedEfibootmgr) -> HostReport:
+    report = HostReport(host, entries=len(parsed.entries), active=sum(entry.active for entry in parsed.entries))
+    nums = set()
+    seen = Counter()
+    for entry in parsed.entries:
+        nums.add(entry.num)
+        if entry.path:
+            loader = normalize_loader(entry.path)
+            report.loaders.append(loader)
+            seen[(loader, entry.parameters or '')] += 1
+    report.duplicates = sorted(f"{loader} {parameters}".rstrip()
+                               for (loader, parameters), count in seen.items() if count > 1)
+    report.orphans = [num for num in parsed.boot_order if num not in nums]
+    report.current_first = parsed.boot_current is None or not parsed.boot_order or \
+        parsed.boot_order[0] == parsed.boot_current
+    return report
+
+
+def analyze_dump(host: str, data: bytes) -> HostReport:
+    try:
+        return analyze(host, parse_dump(data))
+    except (ValueError, IndexError) as e:
+        return HostReport(host, error=str(e) or type(e).__name__)
+
+
+def analyze_file(path: str) -> HostReport:
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        return HostReport(host_name(path), error=str(e))
+    return analyze_dump(host_name(path), data)
+
+
+def analyze_files(paths: list[str]) -> list[HostReport]:
+    """Worker task: the dumps are read by the worker, only their paths are sent to it"""
+    return [analyze_file(path) for path in paths]
+
+
+def analyze_dumps(dumps: list[tuple[str, bytes]]) -> list[HostReport]:
+    """Worker task for dumps read from a tar archive"""
+    return [analyze_dump(host, data) for host, data in dumps]
+
+
+def list_dumps(path: str) -> list[str]:
+    """:return: the paths of the files in the directory path and its subdirectories, hidden ones excluded"""
+    paths = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(name for name in dirs if not name.startswith('.'))
+        paths.extend(os.path.join(root, name) for name in sorted(files) if not name.startswith('.'))
+    return paths
+
+
+def read_tar(path: str) -> Iterator[tuple[str, bytes]]:
+    """:return: host and content of every regular file of the tar archive at path"""
+    with tarfile.open(path) as tar:
+        for member in tar:
+            if member.isfile() and not os.path.basename(member.name).startswith('.'):
+                yield host_name(member.name), tar.extractfile(member).read()
+
+
+def chunks(items: Iterable, size: int = CHUNK_SIZE) -> Iterator[list]:
+    iterator = iter(items)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+@dataclass
+class FleetSummary:
+    """One row per host, stored by column"""
+    host: list[str] = field(default_factory=list)
+    entries: list[int] = field(default_factory=list)
+    active: list[int] = field(default_factory=list)
+    duplicates: list[list[str]] = field(default_factory=list)
+    orphans: list[list[str]] = field(default_factory=list)
+    current_first: list[bool] = field(default_factory=list)
+    error: list[str] = field(default_factory=list)
+    # how many hosts have an entry with the loader
+    loaders: Counter = field(default_factory=Counter)
+
+    COLUMNS = ('host', 'entries', 'active', 'duplicates', 'orphans', 'current_first', 'error')
+
+    def __len__(self):
+        return len(self.host)
+
+    def add(self, report: HostReport):
+        for column in self.COLUMNS:
+            getattr(self, column).append(getattr(report, column))
+        self.loaders.update(set(report.loaders))
+
+    def to_dict(self) -> dict:
+        columns = {column: getattr(self, column) for column in self.COLUMNS}
+        return {'hosts': len(self), 'totals': self.totals(), 'columns': columns,
+                'loaders': dict(self.loaders.most_common())}
+
+    def totals(self) -> dict[str, int]:
+        return {
+            'entries': sum(self.entries),
+            'errors': sum(1 for error in self.error if error),
+            'with_duplicates': sum(1 for duplicates in self.duplicates if duplicates),
+            'with_orphans': sum(1 for orphans in self.orphans if orphans),
+            'current_not_first': sum(1 for error, first in zip(self.error, self.current_first)
+                                     if not error and not first),
+        }
+
+    def format(self, only_problems: bool = False) -> str:
+        """
+        :return: a tab separated table of the hosts, followed by the totals.
+        :param only_problems: list only the hosts with duplicates, orphans, an error or not
+            booting the first entry.
+        """
+        lines = ['\t'.join(self.COLUMNS)]
+        for row in zip(*(getattr(self, column) for column in self.COLUMNS)):
+            host, entries, active, duplicates, orphans, current_first, error = row
+            if only_problems and not (duplicates or orphans or error or not current_first):
+                continue
+            lines.append('\t'.join([host, str(entries), str(active), ','.join(duplicates), ','.join(orphans),
+                                    'yes' if current_first else 'no', error]))
+        lines.append('')
+        lines.append(f"hosts: {len(self)}")
+        lines += [f"{name.replace('_', ' ')}: {value}" for name, value in self.totals().items()]
+        return '\n'.join(lines)
+
+
+def analyze_fleet(path: str, jobs: int | None = None) -> FleetSummary:
+    """
+    Analyzes the dumps in the directory or tar archive at path, in jobs processes (one per CPU by
+    default, none if jobs is 1).
+    :raise OSError: if path can't be read.
+    :raise ValueError: if path is neither a directory nor a tar archive.
+    """
+    if os.path.isdir(path):
+        func, work = analyze_files, chunks(list_dumps(path))
+    elif not tarfile.is_tarfile(path):
+        raise ValueError(f"{path} is neither a directory nor a tar archive")
+    else:
+        func, work = analyze_dumps, chunks(read_tar(path))
+    summary = FleetSummary()
+    with ProcessPoolExecutor(max_workers=jobs) if jobs != 1 else contextlib.nullcontext() as executor:
+        for reports in (executor.map(func, work) if executor is not None else map(func, work)):
+            for report in reports:
+                summary.add(report)
+    logging.info("Analyzed %d dumps from %s", len(summary), path)
+    return summary
@@ -0,0 +1,306 @@
+"""
+Privileged D-Bus helper: a system service, started as root by D-Bus activation, that writes the
+boot variables straight to efivarfs for the GUI and the command line.
+
+    bus name    ovh.elinvention.Efiboots.Helper, on the system bus
+    object      /ovh/elinvention/Efiboots/Helper
+    interface   ovh.elinvention.Efiboots.Helper1 (see INTERFACE_XML): one method per edit, like
+                the efibootmgr options, and ApplyBatch for the writes planned by nvram.py
+
+Every client is authorized by polkit once (action ovh.elinvention.Efiboots.write-nvram, which
+keeps the authentication for a while) and then stays authorized until it disconnects from the
+bus, so a GUI session authenticates only once and every save is a single D-Bus call. The helper
+exits after IDLE_TIMEOUT seconds without calls nor authorized clients.
+
+Only Boot####, BootOrder, BootNext and Timeout can be written (see efivarfs.check_write).
+"""
+import logging
+import os
+import subprocess
+import sys
+
+from gi.repository import Gio, GLib
+
+from efiboots.efivarfs import Efivarfs, check_write
+from efiboots.nvram import EfivarfsEditor, NvramPlan, VariableWrite
+from efiboots.profiling import profiler
+
+BUS_NAME = 'ovh.elinvention.Efiboots.Helper'
+OBJECT_PATH = '/ovh/elinvention/Efiboots/Helper'
+INTERFACE = 'ovh.elinvention.Efiboots.Helper1'
+POLKIT_ACTION = 'ovh.elinvention.Efiboots.write-nvram'
+
+ERROR_NOT_AUTHORIZED = f'{INTERFACE}.Error.NotAuthorized'
+ERROR_INVALID_ARGUMENTS = f'{INTERFACE}.Error.InvalidArguments'
+ERROR_FAILED = f'{INTERFACE}.Error.Failed'
+# polkit needs to authenticate the caller but no authentication agent can do it
+ERROR_INTERACTIVE_AUTHORIZATION_REQUIRED = 'org.freedesktop.DBus.Error.InteractiveAuthorizationRequired'
+
+POLKIT_BUS_NAME = 'org.freedesktop.PolicyKit1'
+POLKIT_OBJECT_PATH = '/org/freedesktop/PolicyKit1/Authority'
+POLKIT_INTERFACE = 'org.freedesktop.PolicyKit1.Authority'
+POLKIT_ALLOW_USER_INTERACTION = 0x1
+
+IDLE_TIMEOUT = 300
+
+INTERFACE_XML = f"""
+<node>
+  <interface name="{INTERFACE}">
+    <method name="SetBootOrder">
+      <arg name="boot_order" type="aq" direction="in"/>
+    </method>
+    <method name="SetBootNext">
+      <arg name="num" type="q" direction="in"/>
+    </method>
+    <method name="ClearBootNext"/>
+    <method name="SetActive">
+      <arg name="num" type="q" direction="in"/>
+      <arg name="active" type="b" direction="in"/>
+    </method>
+    <method name="CreateEntry">
+      <arg name="description" type="s" direction="in"/>
+      <arg name="device_path" type="ay" direction="in"/>
+      <arg name="optional_data" type="ay" direction="in"/>
+      <arg name="num" type="q" direction="out"/>
+    </method>
+    <method name="DeleteEntry">
+      <arg name="num" type="q" direction="in"/>
+    </method>
+    <method name="SetTimeout">
+      <arg name="seconds" type="q" direction="in"/>
+    </method>
+    <!-- name, data (empty to delete the variable) and attributes of every write, in order -->
+    <method name="ApplyBatch">
+      <arg name="writes" type="a(sayu)" direction="in"/>
+      <arg name="reboot" type="b" direction="in"/>
+    </method>
+  </interface>
+</node>
+"""
+
+
+class HelperUnavailable(Exception):
+    """The helper is not installed or the system bus is not reachable"""
+
+
+class InteractiveAuthorizationRequired(HelperUnavailable):
+    """
+    polkit wants the user to authenticate and there is no authentication agent (e.g. over SSH):
+    pkexec can still be used, it starts its own text agent.
+    """
+
+
+class HelperService:
+    """Implementation of INTERFACE, running as root"""
+    log = logging.getLogger('HelperService')
+
+    def __init__(self, efivarfs: Efivarfs, loop: GLib.MainLoop):
+        self.efivarfs = efivarfs
+        self.editor = EfivarfsEditor(efivarfs)
+        self.loop = loop
+        self.connection: Gio.DBusConnection | None = None
+        # unique bus names of the clients polkit authorized
+        self.authorized: set[str] = set()
+        # unique bus names of the clients that called and haven't disconnected since: polkit may
+        # answer after a client disconnected, it must not be authorized then
+        self.callers: set[str] = set()
+        self.idle_id: int | None = None
+
+    def on_bus_acquired(self, connection: Gio.DBusConnection, name: str):
+        self.connection = connection
+        interface = Gio.DBusNodeInfo.new_for_xml(INTERFACE_XML).interfaces[0]
+        connection.register_object(OBJECT_PATH, interface, self.on_method_call, None, None)
+        connection.signal_subscribe('org.freedesktop.DBus', 'org.freedesktop.DBus', 'NameOwnerChanged',
+                                    '/org/freedesktop/DBus', None, Gio.DBusSignalFlags.NONE,
+                                    self.on_name_owner_changed)
+        self.reset_idle_timeout()
+
+    def on_name_lost(self, connection: Gio.DBusConnection | None, name: str):
+        self.log.error("Can't own %s on the system bus", name)
+        self.loop.quit()
+
+    def on_name_owner_changed(self, connection: Gio.DBusConnection, sender: str, path: str, interface: str,
+                              signal: str, parameters: GLib.Variant):
+        name, _, new_owner = parameters.unpack()
+        if not new_owner and name in self.callers:
+            self.log.info("%s disconnected", name)
+            self.callers.discard(name)
+            self.authorized.discard(name)
+
+    def reset_idle_timeout(self):
+        if self.idle_id is not None:
+            GLib.source_remove(self.idle_id)
+        self.idle_id = GLib.timeout_add_seconds(IDLE_TIMEOUT, self.on_idle)
+
+    def on_idle(self):
+        if self.authorized:
+            return GLib.SOURCE_CONTINUE
+        self.log.info("No calls for %d seconds, exiting", IDLE_TIMEOUT)
+        self.idle_id = None
+        self.loop.quit()
+        return GLib.SOURCE_REMOVE
+
+    def on_method_call(self, connection: Gio.DBusConnection, sender: str, path: str, interface: str, method: str,
+                       parameters: GLib.Variant, invocation: Gio.DBusMethodInvocation):
+        self.reset_idle_timeout()
+        if sender in self.authorized:
+            self.dispatch(method, parameters.unpack(), invocation)
+            return
+        self.callers.add(sender)
+
+        def on_authorized(authorized: bool, challenge: bool, error: str | None):
+            if authorized:
+                if sender in self.callers:
+                    self.authorized.add(sender)
+                self.dispatch(method, parameters.unpack(), invocation)
+            elif challenge:
+                self.log.warning("%s needs to authenticate to call %s and has no polkit agent", sender, method)
+                invocation.return_dbus_error(ERROR_INTERACTIVE_AUTHORIZATION_REQUIRED,
+                                             "Interactive authentication required")
+            else:
+                self.log.warning("%s not authorized to call %s: %s", sender, method, error or "denied by polkit")
+                invocation.return_dbus_error(ERROR_NOT_AUTHORIZED, error or "Not authorized")
+
+        flags = invocation.get_message().get_flags()
+        self.check_authorization(sender, bool(flags & Gio.DBusMessageFlags.ALLOW_INTERACTIVE_AUTHORIZATION),
+                                 on_authorized)
+
+    def check_authorization(self, sender: str, interactive: bool, callback):
+        """
+        Asks polkit, without blocking the main loop, whether sender may write NVRAM.
+        :param callback: called with authorized, whether polkit wants to authenticate the user, and an error message.
+        """
+        subject = ('system-bus-name', {'name': GLib.Variant('s', sender)})
+        parameters = GLib.Variant('((sa{sv})sa{ss}us)', (subject, POLKIT_ACTION, {},
+                                                         POLKIT_ALLOW_USER_INTERACTION if interactive else 0, ''))
+
+        def on_done(connection: Gio.DBusConnection, result: Gio.AsyncResult):
+            try:
+                (authorized, challenge, _), = connection.call_finish(result).unpack()
+            except GLib.Error as e:
+                callback(False, False, e.message)
+                return
+            callback(authorized, challenge, None)
+
+        self.connection.call(POLKIT_BUS_NAME, POLKIT_OBJECT_PATH, POLKIT_INTERFACE, 'CheckAuthorization',
+                             parameters, GLib.VariantType('((bba{ss}))'), Gio.DBusCallFlags.NONE, GLib.MAXINT,
+                             None, on_done)
+
+    def dispatch(self, method: str, args: tuple, invocation: Gio.DBusMethodInvocation):
+        reboot = False
+        result = None
+        try:
+            match method, args:
+                case 'SetBootOrder', (boot_order,):
+                    plan = self.editor.set_boot_order([f'{num:04X}' for num in boot_order])
+                case 'SetBootNext', (num,):
+                    plan = self.editor.set_boot_next(f'{num:04X}')
+                case 'ClearBootNext', ():
+                    plan = self.editor.set_boot_next(None)
+                case 'SetActive', (num, active):
+                    plan = self.editor.set_active(f'{num:04X}', active)
+                case 'CreateEntry', (description, device_path, optional_data):
+                    num, plan = self.editor.create_entry(description, bytes(device_path), bytes(optional_data))
+                    result = GLib.Variant('(q)', (int(num, 16),))
+                case 'DeleteEntry', (num,):
+                    plan = self.editor.delete_entry(f'{num:04X}')
+                case 'SetTimeout', (seconds,):
+                    plan = self.editor.set_timeout(seconds)
+                case 'ApplyBatch', (writes, reboot):
+                    plan = NvramPlan([VariableWrite(name, bytes(data) or None, attributes)
+                                      for name, data, attributes in writes])
+                case _:
+                    raise ValueError(f"unknown method {method}")
+            self.apply(plan)
+        except ValueError as e:
+            invocation.return_dbus_error(ERROR_INVALID_ARGUMENTS, str(e))
+            return
+        except OSError as e:
+            self.log.error("%s failed: %s", method, e)
+            invocation.return_dbus_error(ERROR_FAILED, str(e))
+            return
+        except Exception as e:
+            # e.g. struct.error from a malformed Boot####: the client waits for an answer without timeout
+            self.log.exception("%s failed", method)
+            invocation.return_dbus_error(ERROR_FAILED, f"{type(e).__name__}: {e}")
+            return
+        invocation.return_value(result)
+        if reboot:
+            # the reply has to reach the client before the system goes down
+            invocation.get_connection().flush_sync(None)
+            subprocess.run(['reboot'], check=False)
+
+    def apply(self, plan: NvramPlan):
+        """:raise ValueError: if plan writes anything else than the boot variables, before writing anything."""
+        writes = [(write.name, write.data, write.attributes) for write in plan.writes]
+        for name, _, attributes in writes:
+            check_write(name, [attributes])
+        self.log.info("Writing to efivarfs: %s", ', '.join(map(str, plan.writes)))
+        self.efivarfs.apply(writes)
+
+
+class HelperClient:
+    """
+    Calls the helper, always on the same bus connection: the helper keeps it authorized until this
+    process exits.
+    """
+    log = logging.getLogger('HelperClient')
+    _instance = None
+
+    @classmethod
+    def get_instance(cls) -> 'HelperClient':
+        """:raise HelperUnavailable: if the system bus can't be reached."""
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        try:
+            self.connection = Gio.bus_get_sync(Gio.BusType.SYSTEM, None)
+        except GLib.Error as e:
+            raise HelperUnavailable(e.message)
+
+    def call(self, method: str, parameters: GLib.Variant | None = None) -> GLib.Variant:
+        """
+        :raise HelperUnavailable: if the helper is not installed.
+        :raise InteractiveAuthorizationRequired: if polkit can't authenticate the user, for lack of an agent.
+        :raise PermissionError: if polkit didn't authorize the call.
+        :raise ValueError: if the helper refused the arguments.
+        :raise OSError: if the helper failed to write.
+        """
+        try:
+            # no timeout: the user may take a while to authenticate
+            return self.connection.call_sync(BUS_NAME, OBJECT_PATH, INTERFACE, method, parameters, None,
+                                             Gio.DBusCallFlags.ALLOW_INTERACTIVE_AUTHORIZATION, GLib.MAXINT, None)
+        except GLib.Error as e:
+            remote_error = Gio.DBusError.get_remote_error(e)
+            Gio.DBusError.strip_remote_error(e)
+            if remote_error in ('org.freedesktop.DBus.Error.ServiceUnknown',
+                                'org.freedesktop.DBus.Error.NameHasNoOwner'):
+                raise HelperUnavailable(e.message)
+            if remote_error == ERROR_INTERACTIVE_AUTHORIZATION_REQUIRED:
+                raise InteractiveAuthorizationRequired(e.message)
+            if remote_error == ERROR_NOT_AUTHORIZED:
+                raise PermissionError(e.message)
+            if remote_error == ERROR_INVALID_ARGUMENTS:
+                raise ValueError(e.message)
+            raise OSError(e.message)
+
+    def apply_batch(self, plan: NvramPlan, reboot: bool):
+        writes = [(write.name, write.data or b'', write.attributes) for write in plan.writes]
+        with profiler.span('write helper', variables=len(writes), bytes=plan.bytes_written):
+            self.call('ApplyBatch', GLib.Variant('(a(sayu)b)', (writes, reboot)))
+
+
+def main() -> int:
+    logging.basicConfig(level=logging.INFO)
+    if os.geteuid() != 0:
+        logging.error("The helper must run as root, it is started by D-Bus")
+        return 1
+    loop = GLib.MainLoop()
+    service = HelperService(Efivarfs(sys.argv[1]) if len(sys.argv) > 1 else Efivarfs(), loop)
+    owner_id = Gio.bus_own_name(Gio.BusType.SYSTEM, BUS_NAME, Gio.BusNameOwnerFlags.NONE, service.on_bus_acquired,
+                                None, service.on_name_lost)
+    loop.run()
+    Gio.bus_unown_name(owner_id)
+    return 0
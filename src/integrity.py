@@ -0,0 +1,148 @@
+"""
+Integrity check of boot entries: finds the ones the firmware can't boot or that are redundant.
+
+Everything is looked up in memory, after reading the system once:
+
+    GUID map     partition GUID -> device of every partition (see partitions.py)
+    ESP index    case insensitive set of the files of every partition an entry points to,
+                 walking its mount point or, when it is not mounted, reading it with fat.py
+
+Entries are checked against them:
+
+    unreachable  the HD() node names a partition that is not on any disk of the system
+    missing      the loader is not on the partition
+    unreadable   the partition is neither mounted nor readable (e.g. not running as root)
+    duplicate    same partition, loader and parameters as an entry before it
+
+Entries without a partition GUID (MBR disks, short form device paths) are looked up on the ESP
+given by the caller, if any. Entries without a loader (network, BBS, firmware applications) are
+not checked.
+"""
+import logging
+import os
+import threading
+from dataclasses import dataclass
+
+from efiboots.desiredstate import normalize_loader
+from efiboots.efibootmgr import ParsedEfibootmgr
+from efiboots.esp import read_mountinfo
+from efiboots.fat import FatFileSystem
+from efiboots.partitions import PartitionResolver
+from efiboots.profiling import profiler
+
+UNREACHABLE = 'unreachable'
+MISSING = 'missing'
+UNREADABLE = 'unreadable'
+DUPLICATE = 'duplicate'
+
+
+@dataclass(frozen=True, slots=True)
+class Issue:
+    num: str
+    kind: str
+    message: str
+
+    def __str__(self):
+        return f"Boot{self.num} {self.kind}: {self.message}"
+
+
+def index_tree(root: str) -> set[str]:
+    """:return: the normalized path (see normalize_loader) of every file under root"""
+    index = set()
+    for directory, _, files in os.walk(root):
+        relative = os.path.relpath(directory, root)
+        prefix = '' if relative == '.' else relative
+        index.update(normalize_loader(os.path.join(prefix, name)) for name in files)
+    return index
+
+
+def index_fat(device: str) -> set[str]:
+    """
+    :return: the normalized path of every file of the FAT file system on device
+    :raise OSError: if device can't be read.
+    :raise ValueError: if it doesn't hold a FAT file system.
+    """
+    with open(device, 'rb') as f:
+        return {normalize_loader(path) for path in FatFileSystem(f).walk()}
+
+
+class IntegrityChecker:
+    log = logging.getLogger('IntegrityChecker')
+
+    def __init__(self, guids: dict[str, str] | None = None, mounts: dict[str, tuple[str, str]] | None = None,
+                 esp: str | None = None):
+        """
+        :param guids: partition GUID -> device, the partitions of the system by default.
+        :param mounts: mount point -> (source, type), the mounts of the system by default.
+        :param esp: device of the ESP the loaders of entries without a partition GUID are on.
+        """
+        self._guids = guids
+        self._mounts = mounts
+        self.esp = esp
+        self.indexes: dict[str, set[str] | OSError | ValueError] = {}
+
+    @property
+    def guids(self) -> dict[str, str]:
+        """:raise OSError: if the partitions of the system can't be listed."""
+        if self._guids is None:
+            # not PartitionResolver().devices(): no partition at all would make every entry unreachable
+            self._guids = {guid: partition.device for guid, partition in PartitionResolver().list().items()}
+        return self._guids
+
+    @property
+    def mount_points(self) -> dict[str, str]:
+        """:return: device -> the mount point it's mounted on"""
+        if self._mounts is None:
+            self._mounts = read_mountinfo()
+        return {source: mount_point for mount_point, (source, _) in sorted(self._mounts.items(), reverse=True)}
+
+    def index(self, device: str) -> set[str] | OSError | ValueError:
+        """:return: the files of device, read once, or the error that prevented reading them"""
+        if device not in self.indexes:
+            mount_point = self.mount_points.get(device)
+            with profiler.span('index ESP', device=device) as span:
+                try:
+                    if mount_point is not None:
+                        self.indexes[device] = index_tree(mount_point)
+                    else:
+                        self.indexes[device] = index_fat(device)
+                    span.add(files=len(self.indexes[device]))
+                except (OSError, ValueError) as e:
+                    self.log.info("Can't list the files of %s: %s", device, e)
+                    self.indexes[device] = e
+        return self.indexes[device]
+
+    def check(self, parsed: ParsedEfibootmgr, cancel: threading.Event | None = None) -> list[Issue]:
+        """
+        :return: the problems of the entries of parsed, in the order of the entries.
+        :raise OSError: if the partitions of the system can't be listed.
+        """
+        issues = []
+        seen = {}
+        for entry in parsed.entries:
+            if cancel is not None and cancel.is_set():
+                break
+            guid, loader = entry.partition, entry.path
+            if not loader:
+                continue
+            key = (guid, normalize_loader(loader), entry.parameters or '')
+            if key in seen:
+                issues.append(Issue(entry.num, DUPLICATE, f"same loader and parameters as Boot{seen[key]}"))
+            else:
+                seen[key] = entry.num
+
+            if guid is not None:
+                device = self.guids.get(guid)
+                if device is None:
+                    issues.append(Issue(entry.num, UNREACHABLE, f"partition {guid} is not on any disk"))
+                    continue
+            elif self.esp is not None:
+                device = self.esp
+            else:
+                continue
+            index = self.index(device)
+            if isinstance(index, (OSError, ValueError)):
+                issues.append(Issue(entry.num, UNREADABLE, f"can't list the files of {device}: {index}"))
+            elif key[1] not in index:
+                issues.append(Issue(entry.num, MISSING, f"{loader} is not on {device}"))
+        return issues
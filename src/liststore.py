@@ -0,0 +1,270 @@
+"""
+List model of the column view: EfibootsListStore mirrors the BootModel being edited as rows that
+GTK binds the columns to (see the column_*_factory.ui files), one EfibootRowModel per visible row.
+"""
+import logging
+from gettext import gettext as _
+from typing import TYPE_CHECKING
+
+import gi
+
+from efiboots.bootmodel import BootModel, MergeResult
+from efiboots.efibootmgr import Efibootmgr, ParsedEfibootmgr, ParsedEfibootmgrEntry
+from efiboots.nvram import NvramPlan
+from efiboots.partitions import PartitionResolver
+from efiboots.profiling import profiler
+
+gi.require_version('Gtk', '4.0')
+from gi.repository import Gtk, Gio, GObject, GLib
+
+if TYPE_CHECKING:
+    from efiboots.window import EfibootsMainWindow
+
+
+class EfibootRowModel(GObject.Object):
+    """
+    GObject view of a BootModel entry, made by EfibootsListStore only for the rows GTK asks for.
+    All the data lives in the entry, the properties just expose it to the column view.
+    """
+    __gtype_name__ = "EfibootRowModel"
+
+    def __init__(self, entry: ParsedEfibootmgrEntry, state: BootModel, partitions: PartitionResolver):
+        super().__init__()
+        self.entry = entry
+        self.state = state
+        self.partitions = partitions
+
+    @GObject.Property(type=bool, default=False)
+    def current(self) -> bool:
+        return self.entry.num == self.state.boot_current
+
+    @GObject.Property(type=str)
+    def num(self) -> str:
+        return self.entry.num
+
+    @GObject.Property(type=str)
+    def name(self) -> str:
+        return self.entry.name
+
+    @GObject.Property(type=str)
+    def path(self) -> str:
+        return self.entry.path or ''
+
+    @GObject.Property(type=str)
+    def parameters(self) -> str:
+        return self.entry.parameters or ''
+
+    @GObject.Property(type=str)
+    def disk(self) -> str:
+        if self.entry.partition is None:
+            return ''
+        partition = self.partitions.resolve(self.entry.partition)
+        return str(partition) if partition is not None else _("Partition %s not found") % self.entry.partition
+
+    @GObject.Property(type=bool, default=True)
+    def active(self) -> bool:
+        return self.entry.active
+
+    @active.setter
+    def active(self, active: bool):
+        self.entry.active = active
+
+    @GObject.Property(type=bool, default=False)
+    def next(self) -> bool:
+        return self.entry.num == self.state.boot_next
+
+    @next.setter
+    def next(self, _next: bool):
+        # BootNext is set by the next_boot action the check buttons are bound to
+        pass
+
+    def __str__(self):
+        return f"EfibootModelRow {'current' if self.current else ''} num{self.num} {self.name} {self.path}" \
+               f" {self.parameters} {'active' if self.active else 'inactive'} {'next' if self.next else ''}"
+
+
+class EfibootsListStore(GObject.Object, Gio.ListModel):
+    """
+    List model of the column view, backed by the entries of the BootModel being edited in boot
+    order. Row objects are created on demand, so only the visible rows ever get one, and are kept
+    across refreshes for the entries that didn't change.
+    """
+    def __init__(self, window: 'EfibootsMainWindow'):
+        super().__init__()
+        self.window = window
+        self._efibootmgr = None
+        self.state = BootModel()
+        # nums of the rows, in the order they are shown
+        self.nums: list[str] = []
+        self.rows: dict[str, EfibootRowModel] = {}
+        # partitions the entries point to, for the Disk column
+        self.partitions = PartitionResolver()
+
+    def __str__(self):
+        return str(self.state)
+
+    def __len__(self):
+        return len(self.nums)
+
+    def do_get_item_type(self):
+        return EfibootRowModel.__gtype__
+
+    def do_get_n_items(self) -> int:
+        return len(self.nums)
+
+    def do_get_item(self, position: int) -> EfibootRowModel | None:
+        if position >= len(self.nums):
+            return None
+        num = self.nums[position]
+        row = self.rows.get(num)
+        if row is None:
+            row = self.rows[num] = EfibootRowModel(self.state.entries[num], self.state, self.partitions)
+        return row
+
+    @property
+    def efibootmgr(self):
+        if self._efibootmgr is None:
+            self._efibootmgr = Efibootmgr.get_instance()
+        return self._efibootmgr
+
+    def move(self, position: int, offset: int) -> int:
+        """
+        Moves the row at position by offset, swapping it with that row in boot order too.
+        :return: the new position of the row.
+        """
+        new_position = min(max(position + offset, 0), len(self.nums) - 1)
+        if position >= len(self.nums) or new_position == position:
+            return position
+        positions = self.state.positions
+        num, other = self.nums[position], self.nums[new_position]
+        if num not in positions or other not in positions:
+            return position
+        self.state.swap(positions[num], positions[other])
+        self.nums[position], self.nums[new_position] = other, num
+        self.items_changed(min(position, new_position), 2, 2)
+        return new_position
+
+    def index_num(self, num):
+        position = self.state.positions.get(num)
+        if position is not None and position < len(self.nums) and self.nums[position] == num:
+            return position
+        # entries missing from boot order
+        return self.nums.index(num) if num in self.state.entries else None
+
+    def replace_all(self, changed: set[str]):
+        """
+        Shows the entries of the BootModel again, dropping the row objects of the changed ones.
+        When the rows stay in the same order only the changed positions are reported to GTK.
+        """
+        for num in changed:
+            self.rows.pop(num, None)
+        nums = [entry.num for entry in self.state.ordered_entries()]
+        if nums == self.nums:
+            for num in changed:
+                position = self.index_num(num)
+                if position is not None:
+                    self.items_changed(position, 1, 1)
+        else:
+            removed = len(self.nums)
+            self.nums = nums
+            self.rows = {num: row for num, row in self.rows.items() if num in self.state.entries}
+            self.items_changed(0, removed, len(nums))
+
+    def clear(self):
+        self.state.clear()
+        self.replace_all(set(self.rows))
+
+    def reload_partitions(self):
+        """Shows the partitions listed again by PartitionResolver.refresh() in the Disk column"""
+        self.replace_all({num for num, entry in self.state.entries.items() if entry.partition is not None})
+
+    def read(self) -> ParsedEfibootmgr:
+        """Reads the boot state. It doesn't touch the store, so it can run in a worker thread."""
+        with profiler.span('read boot state'):
+            parsed = self.efibootmgr.parse(self.efibootmgr.run())
+        # listed again here, in the worker, so that the Disk column never lists them in the UI thread
+        self.partitions.refresh()
+        return parsed
+
+    @profiler.timed('load rows')
+    def load(self, parsed_efi: ParsedEfibootmgr | None):
+        """
+        Replaces the content of the store with the boot state returned by read(). Rows of entries
+        that are the same as before are reused.
+        """
+        previous = {num: (row.entry, row.current, row.next) for num, row in self.rows.items()}
+        self.state.load(parsed_efi)
+        changed = set()
+        for num, (entry, current, next_boot) in previous.items():
+            new_entry = self.state.entries.get(num)
+            if new_entry is not None and new_entry == entry and new_entry.raw == entry.raw \
+                    and current == (num == self.state.boot_current) and next_boot == (num == self.state.boot_next):
+                self.rows[num].entry = new_entry
+            else:
+                changed.add(num)
+        self.replace_all(changed)
+
+        if parsed_efi is not None:
+            self.window.timeout_spin.set_value(self.state.timeout)
+
+    def merge(self, remote: ParsedEfibootmgr) -> MergeResult:
+        """
+        Takes in the boot state changed by another program (see BootModel.merge), updating only
+        the rows that changed instead of rebuilding the whole store.
+        """
+        previous_boot_next = self.state.boot_next
+        result = self.state.merge(remote)
+        changed = set(result.changed) | set(result.removed)
+        if result.boot_next_changed:
+            changed |= {previous_boot_next, self.state.boot_next} - {None}
+        self.replace_all(changed)
+        if result.timeout_changed:
+            self.window.timeout_spin.set_value(self.state.timeout)
+        return result
+
+    def import_state(self, imported: ParsedEfibootmgr):
+        """
+        Shows imported as pending changes over the boot state read from NVRAM (see BootModel.import_state).
+        :raise ValueError: if no boot state has been loaded yet.
+        """
+        self.state.import_state(imported)
+        self.replace_all(set(self.rows))
+        self.window.timeout_spin.set_value(self.state.timeout)
+        self.window.lookup_action("next_boot").set_state(GLib.Variant.new_string(self.state.boot_next or ""))
+
+    def change_boot_next(self, action: Gio.SimpleAction, num_variant: GLib.Variant):
+        num = num_variant.get_string()
+        if self.state.boot_next == num:
+            action.set_state(GLib.Variant.new_string(""))
+            self.state.boot_next = None
+        else:
+            action.set_state(num_variant)
+            self.state.boot_next = num
+        logging.debug("%s changed to %s", action.get_name(), action.get_state())
+
+    def change_active(self, widget: Gtk.Switch, state: bool, row: EfibootRowModel):
+        self.state.set_active(row.num, state)
+        logging.debug("%s", row)
+
+    def add(self, label, path, parameters):
+        entry = self.state.add(label, path, parameters)
+        # after the last entry in boot order, like ordered_entries() does
+        position = sum(1 for num in self.nums if num in self.state.positions)
+        self.nums.insert(position, entry.num)
+        self.items_changed(position, 0, 1)
+
+    def remove(self, position: int):
+        if position < len(self.nums):
+            num = self.nums.pop(position)
+            self.state.remove(num)
+            self.rows.pop(num, None)
+            self.items_changed(position, 1, 0)
+
+    def pending_changes(self) -> bool:
+        return self.state.pending_changes()
+
+    def to_writes(self, disk, part) -> NvramPlan | None:
+        return self.state.to_writes(self.efibootmgr, disk, part)
+
+    def to_script(self, disk, part, reboot):
+        return self.state.to_script(disk, part, reboot)
@@ -0,0 +1,112 @@
+"""
+Decoder for EFI_LOAD_OPTION, the binary format of Boot#### variables (UEFI spec 3.1.3).
+"""
+import struct
+from dataclasses import dataclass
+
+from efiboots.devicepath import DevicePathNode, FilePath, HardDrive, parse_device_path, split_instances, \
+    format_device_path
+
+LOAD_OPTION_ACTIVE = 0x00000001
+LOAD_OPTION_FORCE_RECONNECT = 0x00000002
+LOAD_OPTION_HIDDEN = 0x00000008
+LOAD_OPTION_CATEGORY = 0x00001F00
+
+load_option_header = struct.Struct('<IH')
+
+
+@dataclass(frozen=True, slots=True)
+class LoadOption:
+    """Stores the fields of an EFI_LOAD_OPTION. Optional data is a view on the original buffer."""
+    attributes: int
+    description: str
+    device_path: list[DevicePathNode]
+    optional_data: memoryview
+
+    @property
+    def active(self) -> bool:
+        return bool(self.attributes & LOAD_OPTION_ACTIVE)
+
+    @property
+    def hidden(self) -> bool:
+        return bool(self.attributes & LOAD_OPTION_HIDDEN)
+
+    @property
+    def file_path(self) -> str:
+        """Path of the loader, taken from the first File() node of the first device path instance"""
+        for instance in split_instances(self.device_path)[:1]:
+            for node in instance:
+                if isinstance(node, FilePath):
+                    return node.path
+        return ''
+
+    @property
+    def partition_guid(self) -> str | None:
+        """GUID of the GPT partition of the first device path instance, in lower case"""
+        for instance in split_instances(self.device_path)[:1]:
+            for node in instance:
+                if isinstance(node, HardDrive) and node.partition_guid is not None:
+                    return str(node.partition_guid)
+        return None
+
+    def format_device_path(self) -> str:
+        return format_device_path(self.device_path)
+
+
+def parse_load_option(data: bytes) -> LoadOption:
+    """
+    :raise ValueError: if data is not a well formed EFI_LOAD_OPTION.
+    """
+    view = memoryview(data)
+    try:
+        attributes, file_path_list_length = load_option_header.unpack_from(view)
+    except struct.error as e:
+        raise ValueError(f"load option too short: {e}")
+
+    # Description is a NUL terminated UCS-2 string: look for a NUL on a character boundary
+    desc_end = data.find(b'\x00\x00', load_option_header.size)
+    while desc_end != -1 and desc_end % 2:
+        desc_end = data.find(b'\x00\x00', desc_end + 1)
+    if desc_end == -1:
+        raise ValueError("load option description is not terminated")
+    description = str(view[load_option_header.size:desc_end], 'utf-16-le')
+
+    device_path_start = desc_end + 2
+    device_path_end = device_path_start + file_path_list_length
+    if device_path_end > len(view):
+        raise ValueError("load option device path exceeds variable size")
+    device_path = parse_device_path(view[device_path_start:device_path_end])
+
+    return LoadOption(attributes, description, device_path, view[device_path_end:])
+
+
+def encode_load_option(attributes: int, description: str, device_path: bytes, optional_data: bytes = b'') -> bytes:
+    return (load_option_header.pack(attributes, len(device_path)) + (description + '\x00').encode('utf-16-le') +
+            device_path + optional_data)
+
+
+def set_load_option_active(data: bytes, active: bool) -> bytes:
+    """:return: a copy of the EFI_LOAD_OPTION in data with the LOAD_OPTION_ACTIVE attribute changed."""
+    attributes, = struct.unpack_from('<I', data)
+    if active:
+        attributes |= LOAD_OPTION_ACTIVE
+    else:
+        attributes &= ~LOAD_OPTION_ACTIVE
+    return struct.pack('<I', attributes) + data[4:]
+
+
+def is_ucs2(optional_data: bytes | memoryview) -> bool:
+    """:return: True if optional data looks like a UCS-2 string: every high byte is null"""
+    return len(optional_data) % 2 == 0 and not any(optional_data[1::2])
+
+
+def decode_optional_data(optional_data: bytes | memoryview) -> str:
+    """
+    Optional data is opaque, but usually it is a UCS-2 string (e.g. kernel command line).
+    Anything else is shown the same way efibootmgr -v does: printable ASCII bytes as they are
+    and every other byte as a dot.
+    """
+    optional_data = bytes(optional_data)
+    if is_ucs2(optional_data):
+        return optional_data.decode('utf-16-le').rstrip('\x00')
+    return ''.join(chr(b) if 0x20 <= b < 0x7f else '.' for b in optional_data)
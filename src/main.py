@@ -25,6 +25,8 @@ import sys
 gi.require_version('Gtk', '4.0')
 from gi.repository import Gtk, Gio, GLib
 
+from efiboots.profiling import profiler
+
 
 class EfibootsApplication(Gtk.Application):
     def __init__(self, version: str, *args, **kwargs):
@@ -54,9 +56,28 @@ class EfibootsApplication(Gtk.Application):
             "Partition number of ESP (for example if ESP is on /dev/sda1 you should set this to 1)",
             None,
         )
+        # same profiling options as the command line, see cli.add_global_options()
+        self.add_main_option(
+            "profile",
+            0,
+            GLib.OptionFlags.NONE,
+            GLib.OptionArg.NONE,
+            "Log how long every step took on exit",
+            None,
+        )
+        self.add_main_option(
+            "profile-output",
+            0,
+            GLib.OptionFlags.NONE,
+            GLib.OptionArg.FILENAME,
+            "Save the profiled steps to FILE on exit (Chrome trace format if it ends with .trace.json)",
+            "FILE",
+        )
 
         self.disk = ""
         self.part = ""
+        self.profile = False
+        self.profile_output = None
 
     def resource_path(self, relpath):
         base_path = self.get_resource_base_path()
@@ -99,9 +120,25 @@ class EfibootsApplication(Gtk.Application):
             self.part = options["part"]
             logging.debug("Found part from command line: %s", self.part)
 
+        if "profile" in options:
+            self.profile = True
+            profiler.enable()
+        if "profile-output" in options:
+            # GLib gives filenames as null terminated bytes
+            self.profile_output = bytes(options["profile-output"]).rstrip(b'\0').decode()
+            profiler.enable()
+            logging.debug("Profiling to %s", self.profile_output)
+
         self.activate()
         return 0
 
+    def do_shutdown(self):
+        if self.profile:
+            logging.info("Profile:\n%s", profiler.summary())
+        if self.profile_output:
+            profiler.dump(self.profile_output)
+        Gtk.Application.do_shutdown(self)
+
     def on_quit(self, action, param):
         self.quit()
 
@@ -0,0 +1,338 @@
+"""
+Turns the changes made to the boot entries into the final set of EFI variables to write.
+
+The edited state is compared with the snapshot read from NVRAM (diff_boot_states), so that
+changes cancelling each other never reach the firmware. The resulting variables are handed,
+in a safe order, to the D-Bus helper (see helper.py) or a single privileged process writing
+straight to efivarfs (see efivarfs.main()), or turned into an efibootmgr script when that's not
+possible. EfivarfsEditor plans the single edits of the typed API of the D-Bus helper.
+"""
+import logging
+import os
+import shlex
+import struct
+import uuid
+from dataclasses import dataclass, field
+
+from efiboots.efibootmgr import Efibootmgr, EfibootmgrEfivarfs, ParsedEfibootmgr, ParsedEfibootmgrEntry, is_in_flatpak
+from efiboots.efivarfs import DEFAULT_ATTRIBUTES, Efivarfs
+from efiboots.devicepath import End, encode_hard_drive, encode_file_path, encode_end, parse_device_path
+from efiboots.loadoption import LOAD_OPTION_ACTIVE, encode_load_option, set_load_option_active
+
+SYS_CLASS_BLOCK = '/sys/class/block'
+DEV_DISK_BY_PARTUUID = '/dev/disk/by-partuuid'
+
+
+@dataclass
+class VariableWrite:
+    """A single NVRAM write. data is None when the variable has to be deleted."""
+    name: str
+    data: bytes | None
+    attributes: int = DEFAULT_ATTRIBUTES
+
+    def __str__(self):
+        if self.data is None:
+            return f"delete {self.name}"
+        return f"write {self.name} ({len(self.data)} bytes)"
+
+
+def encode_boot_order(boot_order: list[str]) -> bytes:
+    return struct.pack(f'<{len(boot_order)}H', *(int(num, 16) for num in boot_order))
+
+
+def encode_boot_num(num: str) -> bytes:
+    return struct.pack('<H', int(num, 16))
+
+
+def encode_timeout(timeout: int) -> bytes:
+    return struct.pack('<H', timeout)
+
+
+def free_boot_nums(used: set[str], count: int) -> list[str]:
+    """:return: the lowest count Boot#### numbers not in used"""
+    free = []
+    num = 0
+    while len(free) < count:
+        if num > 0xffff:
+            raise ValueError("no free boot entry number left")
+        if f'{num:04X}' not in used:
+            free.append(f'{num:04X}')
+        num += 1
+    return free
+
+
+def esp_hard_drive(disk: str, part: str) -> bytes:
+    """
+    Builds the HD() device path node of the ESP from sysfs and /dev/disk/by-partuuid, like
+    efibootmgr --disk --part does, without reading the partition table.
+    :raise OSError: if the partition cannot be found.
+    """
+    disk_dir = os.path.join(SYS_CLASS_BLOCK, os.path.basename(disk))
+    with open(os.path.join(disk_dir, 'queue', 'logical_block_size')) as f:
+        sectors_per_block = int(f.read()) // 512
+
+    for dir_entry in os.scandir(disk_dir):
+        partition_file = os.path.join(dir_entry.path, 'partition')
+        if not os.path.isfile(partition_file):
+            continue
+        with open(partition_file) as f:
+            if f.read().strip() != str(part):
+                continue
+        with open(os.path.join(dir_entry.path, 'start')) as f:
+            start = int(f.read()) // sectors_per_block
+        with open(os.path.join(dir_entry.path, 'size')) as f:
+            size = int(f.read()) // sectors_per_block
+        partition_device = os.path.join('/dev', dir_entry.name)
+        break
+    else:
+        raise FileNotFoundError(f"partition {part} of {disk} not found in {disk_dir}")
+
+    for partuuid in os.listdir(DEV_DISK_BY_PARTUUID):
+        if os.path.realpath(os.path.join(DEV_DISK_BY_PARTUUID, partuuid)) == partition_device:
+            break
+    else:
+        raise FileNotFoundError(f"PARTUUID of {partition_device} not found in {DEV_DISK_BY_PARTUUID}")
+
+    if len(partuuid) == 36:
+        signature = uuid.UUID(partuuid)
+    else:
+        # MBR PARTUUIDs are made of the disk signature and the partition number: 1234abcd-01
+        signature = int(partuuid.split('-')[0], 16)
+    return encode_hard_drive(int(part), start, size, signature)
+
+
+def make_load_option(disk: str, part: str, label: str, loader: str, parameters: str, active: bool = True) -> bytes:
+    device_path = esp_hard_drive(disk, part) + encode_file_path(loader) + encode_end()
+    optional_data = (parameters + '\x00').encode('utf-16-le') if parameters else b''
+    return encode_load_option(LOAD_OPTION_ACTIVE if active else 0, label, device_path, optional_data)
+
+
+@dataclass
+class BootChanges:
+    """
+    Canonical difference between two boot states: the smallest set of changes that turns the
+    initial state into the desired one. Changes that cancel each other out never show up here.
+    """
+    create: list[ParsedEfibootmgrEntry] = field(default_factory=list)
+    activate: list[str] = field(default_factory=list)
+    deactivate: list[str] = field(default_factory=list)
+    delete: list[str] = field(default_factory=list)
+    boot_order: list[str] | None = None
+    boot_next: str | None = None
+    delete_boot_next: bool = False
+    timeout: int | None = None
+
+    def __bool__(self):
+        return bool(self.create or self.activate or self.deactivate or self.delete or self.boot_order is not None
+                    or self.boot_next is not None or self.delete_boot_next or self.timeout is not None)
+
+
+@dataclass
+class NvramPlan:
+    """The NVRAM writes needed to apply some BootChanges, in the order they have to be done"""
+    writes: list[VariableWrite]
+
+    def __bool__(self):
+        return bool(self.writes)
+
+    @property
+    def bytes_written(self) -> int:
+        return sum(len(write.data) for write in self.writes if write.data is not None)
+
+    def __str__(self):
+        return '\n'.join(map(str, self.writes))
+
+
+def diff_boot_states(initial: ParsedEfibootmgr, desired: ParsedEfibootmgr) -> BootChanges:
+    """
+    Compares the state read from NVRAM with the edited one.
+    Entries of desired whose number is not in initial are new: they get the lowest free numbers.
+    New entries missing from desired.boot_order are appended to it.
+    """
+    initial_entries = {entry.num: entry for entry in initial.entries}
+    desired_nums = {entry.num for entry in desired.entries}
+    placeholders = [entry.num for entry in desired.entries if entry.num not in initial_entries]
+    new_nums = dict(zip(placeholders, free_boot_nums(set(initial_entries), len(placeholders))))
+    changes = BootChanges()
+
+    for entry in desired.entries:
+        if entry.num in new_nums:
+            changes.create.append(ParsedEfibootmgrEntry(num=new_nums[entry.num], active=entry.active, name=entry.name,
+                                                        path=entry.path, parameters=entry.parameters,
+                                                        raw=entry.raw))
+        elif entry.active != initial_entries[entry.num].active:
+            (changes.activate if entry.active else changes.deactivate).append(entry.num)
+    changes.delete = sorted(num for num in initial_entries if num not in desired_nums)
+
+    deleted = set(changes.delete)
+    boot_order = [new_nums.get(num, num) for num in desired.boot_order if num not in deleted]
+    boot_order += [num for placeholder, num in new_nums.items() if placeholder not in desired.boot_order]
+    if boot_order != initial.boot_order:
+        changes.boot_order = boot_order
+
+    boot_next = None if desired.boot_next in deleted else new_nums.get(desired.boot_next, desired.boot_next)
+    if boot_next != initial.boot_next:
+        if boot_next is None:
+            changes.delete_boot_next = True
+        else:
+            changes.boot_next = boot_next
+
+    if desired.timeout is not None and desired.timeout != initial.timeout:
+        changes.timeout = desired.timeout
+
+    return changes
+
+
+def plan_writes(initial: ParsedEfibootmgr, changes: BootChanges, disk: str, part: str) -> NvramPlan:
+    """
+    Computes the variables to write, in an order that never leaves BootOrder or BootNext
+    pointing to a missing entry: new entries are created first, then existing ones are changed,
+    then BootOrder, BootNext and Timeout are set and finally the removed entries are deleted.
+    :raise ValueError: if the raw load options needed to apply the changes are unavailable.
+    """
+    initial_entries = {entry.num: entry for entry in initial.entries}
+    writes = []
+
+    for entry in changes.create:
+        if entry.raw is not None:
+            # imported with its load option, whose device path doesn't need the ESP
+            data = set_load_option_active(entry.raw, entry.active)
+        else:
+            data = make_load_option(disk, part, entry.name, entry.path, entry.parameters, entry.active)
+        writes.append(VariableWrite(f'Boot{entry.num}', data))
+
+    for num in sorted(changes.activate + changes.deactivate):
+        if initial_entries[num].raw is None:
+            raise ValueError(f"raw load option of Boot{num} is not available")
+        data = set_load_option_active(initial_entries[num].raw, num in changes.activate)
+        writes.append(VariableWrite(f'Boot{num}', data))
+
+    if changes.boot_order is not None:
+        writes.append(VariableWrite('BootOrder', encode_boot_order(changes.boot_order)))
+    if changes.boot_next is not None:
+        writes.append(VariableWrite('BootNext', encode_boot_num(changes.boot_next)))
+    elif changes.delete_boot_next:
+        writes.append(VariableWrite('BootNext', None))
+    if changes.timeout is not None:
+        writes.append(VariableWrite('Timeout', encode_timeout(changes.timeout)))
+
+    for num in changes.delete:
+        writes.append(VariableWrite(f'Boot{num}', None))
+
+    plan = NvramPlan(writes)
+    logging.debug("Planned %d NVRAM writes (%d bytes): %s", len(writes), plan.bytes_written,
+                  ', '.join(map(str, writes)))
+    return plan
+
+
+def plan_direct_writes(efibootmgr: Efibootmgr, initial: ParsedEfibootmgr, changes: BootChanges,
+                       disk: str | None, part: str | None) -> NvramPlan | None:
+    """
+    :return: the NVRAM writes needed to apply changes or None when they can't be written directly
+        to efivarfs and efibootmgr_script() has to be used instead.
+    """
+    if not isinstance(efibootmgr, EfibootmgrEfivarfs) or is_in_flatpak():
+        return None
+    try:
+        return plan_writes(initial, changes, disk, part)
+    except (OSError, ValueError) as e:
+        logging.warning("Can't write EFI variables directly, falling back to efibootmgr: %s", e)
+        return None
+
+
+class EfivarfsEditor:
+    """
+    Plans single edits against the variables currently in efivarfs, with the same effect as the
+    matching efibootmgr options.
+    """
+
+    def __init__(self, efivarfs: Efivarfs):
+        self.efivarfs = efivarfs
+
+    def boot_order(self) -> list[str]:
+        """:raise ValueError: if BootOrder is malformed."""
+        data, _ = self.efivarfs.read('BootOrder')
+        if data is not None and len(data) % 2:
+            raise ValueError(f"BootOrder has an odd length: {len(data)}")
+        return [f'{num:04X}' for num, in struct.iter_unpack('<H', data)] if data else []
+
+    def read_entry(self, num: str) -> tuple[bytes, int]:
+        """:raise ValueError: if Boot<num> doesn't exist."""
+        data, attributes = self.efivarfs.read(f'Boot{num}')
+        if data is None:
+            raise ValueError(f"Boot{num} doesn't exist")
+        return data, attributes
+
+    @staticmethod
+    def set_boot_order(boot_order: list[str]) -> NvramPlan:
+        return NvramPlan([VariableWrite('BootOrder', encode_boot_order(boot_order))])
+
+    def set_boot_next(self, num: str | None) -> NvramPlan:
+        """None deletes BootNext"""
+        if num is None:
+            return NvramPlan([VariableWrite('BootNext', None)])
+        self.read_entry(num)
+        return NvramPlan([VariableWrite('BootNext', encode_boot_num(num))])
+
+    def set_active(self, num: str, active: bool) -> NvramPlan:
+        data, attributes = self.read_entry(num)
+        return NvramPlan([VariableWrite(f'Boot{num}', set_load_option_active(data, active), attributes)])
+
+    def create_entry(self, description: str, device_path: bytes, optional_data: bytes) -> tuple[str, NvramPlan]:
+        """
+        Creates an active entry with the lowest free number, first in BootOrder.
+        :return: its number and the writes.
+        :raise ValueError: if device_path is malformed or no number is left.
+        """
+        nodes = parse_device_path(device_path)
+        if not nodes or not isinstance(nodes[-1], End) or not nodes[-1].entire:
+            raise ValueError("the device path is not terminated by an End Entire Device Path node")
+        data = encode_load_option(LOAD_OPTION_ACTIVE, description, device_path, optional_data)
+        num, = free_boot_nums({name[4:] for name in self.efivarfs.list_boot_entries()}, 1)
+        return num, NvramPlan([VariableWrite(f'Boot{num}', data),
+                               VariableWrite('BootOrder', encode_boot_order([num] + self.boot_order()))])
+
+    def delete_entry(self, num: str) -> NvramPlan:
+        """Deletes Boot<num> after removing it from BootOrder"""
+        self.read_entry(num)
+        writes = []
+        boot_order = self.boot_order()
+        if num in boot_order:
+            boot_order.remove(num)
+            writes.append(VariableWrite('BootOrder', encode_boot_order(boot_order)))
+        writes.append(VariableWrite(f'Boot{num}', None))
+        return NvramPlan(writes)
+
+    @staticmethod
+    def set_timeout(seconds: int) -> NvramPlan:
+        return NvramPlan([VariableWrite('Timeout', encode_timeout(seconds))])
+
+
+def efibootmgr_script(changes: BootChanges, disk: str | None, part: str | None, reboot: bool) -> str:
+    """Same as plan_writes, but with efibootmgr commands for when efivarfs can't be written directly"""
+    # the ESP is only needed to create entries
+    esp = f"--disk {shlex.quote(disk)} --part {shlex.quote(part)} " if disk and part else ''
+    script = ''
+    for entry in changes.create:
+        # the script runs as root and labels can come from desired state or exported files
+        script += f'efibootmgr {esp}--create --bootnum {entry.num} --label {shlex.quote(entry.name)} ' \
+                  f'--loader {shlex.quote(entry.path)} --unicode {shlex.quote(entry.parameters)}\n'
+        if not entry.active:
+            script += f'efibootmgr {esp}--bootnum {entry.num} --inactive\n'
+    for num in changes.activate:
+        script += f'efibootmgr {esp}--bootnum {num} --active\n'
+    for num in changes.deactivate:
+        script += f'efibootmgr {esp}--bootnum {num} --inactive\n'
+    if changes.boot_order is not None:
+        script += f'efibootmgr {esp}--bootorder {",".join(changes.boot_order)}\n'
+    if changes.boot_next is not None:
+        script += f'efibootmgr {esp}--bootnext {changes.boot_next}\n'
+    elif changes.delete_boot_next:
+        script += f'efibootmgr {esp}--delete-bootnext\n'
+    if changes.timeout is not None:
+        script += f'efibootmgr {esp}--timeout {changes.timeout}\n'
+    for num in changes.delete:
+        script += f'efibootmgr {esp}--delete-bootnum --bootnum {num}\n'
+    if reboot:
+        script += "reboot\n"
+    return script
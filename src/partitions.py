@@ -0,0 +1,157 @@
+"""
+Resolves the partition GUIDs of boot entries (the HD() device path node) to the partitions of
+the system: device, disk model and mount point.
+
+All partitions are listed at once, from /dev/disk/by-partuuid, sysfs and /proc/self/mountinfo,
+reading the model of every disk only once, or with a single lsblk run in the Flatpak sandbox.
+The result is kept until refresh() lists them again, in a worker thread on refresh or when udev
+adds or removes partitions, and replaces it at once: resolve() never waits for a listing then.
+"""
+import json
+import logging
+import os
+import subprocess
+import threading
+from dataclasses import dataclass
+
+from efiboots.efibootmgr import is_in_flatpak, subprocess_run_wrapper
+from efiboots.esp import PROC_MOUNTINFO, SYS_CLASS_BLOCK, read_mountinfo
+from efiboots.nvram import DEV_DISK_BY_PARTUUID
+from efiboots.profiling import profiler
+
+
+@dataclass(frozen=True, slots=True)
+class PartitionInfo:
+    device: str
+    disk: str = ''
+    model: str = ''
+    mount_point: str = ''
+
+    def __str__(self):
+        details = ', '.join(detail for detail in (self.model, self.mount_point) if detail)
+        return f'{self.device} ({details})' if details else self.device
+
+
+def read_model(disk: str, sys_class_block: str = SYS_CLASS_BLOCK) -> str:
+    try:
+        with open(os.path.join(sys_class_block, disk, 'device', 'model')) as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
+
+def parent_disk(name: str, sys_class_block: str = SYS_CLASS_BLOCK) -> str:
+    """:return: the name of the disk the partition name is on, e.g. nvme0n1 for nvme0n1p1"""
+    return os.path.basename(os.path.dirname(os.path.realpath(os.path.join(sys_class_block, name))))
+
+
+def read_partitions(by_partuuid: str = DEV_DISK_BY_PARTUUID, sys_class_block: str = SYS_CLASS_BLOCK,
+                    mountinfo: str = PROC_MOUNTINFO) -> dict[str, PartitionInfo]:
+    """
+    :return: partition GUID -> partition, for every partition with a GUID.
+    :raise OSError: if by_partuuid can't be listed.
+    """
+    mount_points = {}
+    # the shortest mount point of a device wins
+    for mount_point, (source, _) in sorted(read_mountinfo(mountinfo).items(), key=lambda item: -len(item[0])):
+        mount_points[source] = mount_point
+    models = {}
+    partitions = {}
+    for partuuid in os.listdir(by_partuuid):
+        device = os.path.realpath(os.path.join(by_partuuid, partuuid))
+        disk = parent_disk(os.path.basename(device), sys_class_block)
+        if disk not in models:
+            models[disk] = read_model(disk, sys_class_block)
+        partitions[partuuid.lower()] = PartitionInfo(device, os.path.join('/dev', disk), models[disk],
+                                                     mount_points.get(device, ''))
+    return partitions
+
+
+def list_partitions(cancel: threading.Event | None = None) -> dict[str, PartitionInfo]:
+    """
+    Same as read_partitions(), but running lsblk.
+    :raise ValueError: if lsblk prints something else than its list of block devices.
+    """
+    output = subprocess_run_wrapper(['lsblk', '--json', '--paths', '--output', 'NAME,PARTUUID,MODEL,MOUNTPOINT'],
+                                    cancel=cancel)
+    partitions = {}
+    try:
+        pending = [(device, None) for device in json.loads(output)['blockdevices']]
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"unexpected lsblk output: {e!r}")
+    while pending:
+        device, disk = pending.pop()
+        children = device.get('children', [])
+        pending.extend((child, disk or device) for child in children)
+        if device.get('partuuid') and disk is not None:
+            partitions[device['partuuid'].lower()] = PartitionInfo(device['name'], disk['name'],
+                                                                   (disk.get('model') or '').strip(),
+                                                                   device.get('mountpoint') or '')
+    return partitions
+
+
+class PartitionResolver:
+    log = logging.getLogger('PartitionResolver')
+
+    def __init__(self, partitions: dict[str, PartitionInfo] | None = None):
+        """:param partitions: the partitions to resolve to, those of the system by default."""
+        self._partitions = partitions
+        self._lock = threading.Lock()
+
+    @property
+    def partitions(self) -> dict[str, PartitionInfo]:
+        """partition GUID -> partition, listed on first use after invalidate()"""
+        with self._lock:
+            if self._partitions is None:
+                partitions = self.list_timed()
+                self._partitions = partitions if partitions is not None else {}
+            return self._partitions
+
+    def list_timed(self) -> dict[str, PartitionInfo] | None:
+        """:return: the partitions of the system, None if they can't be listed."""
+        with profiler.span('list partitions') as span:
+            try:
+                partitions = self.list()
+            except OSError as e:
+                self.log.warning("%s", e)
+                return None
+            span.add(partitions=len(partitions))
+        return partitions
+
+    def list(self) -> dict[str, PartitionInfo]:
+        """:raise OSError: if the partitions of the system can't be listed, neither directly nor with lsblk."""
+        if not is_in_flatpak():
+            try:
+                return read_partitions()
+            except OSError as e:
+                self.log.info("Can't list partitions directly, falling back to lsblk: %s", e)
+        try:
+            return list_partitions()
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            raise OSError(f"Can't list partitions: {e}") from e
+
+    def invalidate(self):
+        with self._lock:
+            self._partitions = None
+
+    def refresh(self) -> dict[str, PartitionInfo]:
+        """
+        Lists the partitions again right away, e.g. in a worker thread before they are needed. They
+        replace the previous ones with a single assignment, other threads never wait for the listing.
+        The previous ones are kept if the partitions can't be listed.
+        """
+        partitions = self.list_timed()
+        if partitions is None:
+            # the previous ones are more likely right than none at all
+            return self.partitions
+        self._partitions = partitions
+        return partitions
+
+    def resolve(self, guid: str | None) -> PartitionInfo | None:
+        if guid is None:
+            return None
+        return self.partitions.get(guid.lower())
+
+    def devices(self) -> dict[str, str]:
+        """:return: partition GUID -> device"""
+        return {guid: partition.device for guid, partition in self.partitions.items()}
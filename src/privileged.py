@@ -0,0 +1,85 @@
+"""
+Runs the writes to EFI NVRAM with elevated privileges: through the D-Bus helper (see helper.py),
+which stays authorized for the whole session, through pkexec when the helper is not installed or,
+when already running as root (e.g. from the command line), in this process.
+
+execute_transaction_as_root() verifies the writes and rolls them back when they fail (see
+transaction.py).
+"""
+import logging
+import os
+import subprocess
+import sys
+import threading
+
+from efiboots import efivarfs
+from efiboots.efibootmgr import is_in_flatpak, subprocess_run_wrapper
+from efiboots.nvram import NvramPlan
+from efiboots.profiling import profiler
+from efiboots.transaction import Transaction, TransactionReport
+
+
+def is_root() -> bool:
+    return os.geteuid() == 0
+
+
+def execute_script_as_root(script, cancel: threading.Event | None = None):
+    if is_root():
+        logging.info("Running command `sh -c %s`", script)
+        subprocess_run_wrapper(["sh", "-c", script], cancel=cancel)
+    else:
+        logging.info("Running command `pkexec sh -c %s`", script)
+        subprocess_run_wrapper(["pkexec", "sh", "-c", script], cancel=cancel)
+
+
+def execute_writes_with_helper(plan: NvramPlan, reboot: bool) -> bool:
+    """:return: False, without writing anything, if the D-Bus helper is not available."""
+    if is_in_flatpak():
+        return False
+    try:
+        from efiboots import helper
+    except ImportError as e:
+        # installed without PyGObject, for the command line only
+        logging.debug("Can't use the D-Bus helper: %s", e)
+        return False
+    try:
+        logging.info("Writing through the D-Bus helper: %s", ', '.join(map(str, plan.writes)))
+        helper.HelperClient.get_instance().apply_batch(plan, reboot)
+    except helper.HelperUnavailable as e:
+        logging.info("Can't write through the D-Bus helper, falling back to pkexec: %s", e)
+        return False
+    return True
+
+
+def execute_writes_as_root(plan: NvramPlan, reboot: bool, cancel: threading.Event | None = None):
+    """Applies all the writes with a single privileged call or process writing straight to efivarfs"""
+    writes = [(write.name, write.data, write.attributes) for write in plan.writes]
+    profiler.count('nvram writes', len(plan.writes))
+    profiler.count('nvram bytes written', plan.bytes_written)
+    if is_root():
+        logging.info("Writing to efivarfs: %s", ', '.join(map(str, plan.writes)))
+        with profiler.span('write efivarfs', variables=len(writes), bytes=plan.bytes_written):
+            efivarfs.Efivarfs().apply(writes)
+        if reboot:
+            subprocess.run(['reboot'], check=True)
+        return
+    if execute_writes_with_helper(plan, reboot):
+        return
+    batch = efivarfs.dump_batch(writes, reboot)
+    logging.info("Running efivarfs helper as root: %s", ', '.join(map(str, plan.writes)))
+    subprocess_run_wrapper(["pkexec", sys.executable, os.path.abspath(efivarfs.__file__)], input=batch, cancel=cancel)
+
+
+def execute_transaction_as_root(plan: NvramPlan, reboot: bool,
+                                cancel: threading.Event | None = None) -> TransactionReport:
+    """
+    Applies plan as a transaction and reboots only once the writes have been verified.
+    :raise TransactionError: if the writes have been rolled back, cancelled ones included.
+    """
+    # the rollback runs even when cancel is set: stopping it would leave NVRAM partly written
+    transaction = Transaction(efivarfs.Efivarfs(), lambda ordered: execute_writes_as_root(ordered, False, cancel),
+                              lambda rollback: execute_writes_as_root(rollback, False))
+    report = transaction.apply(plan)
+    if reboot:
+        execute_writes_as_root(NvramPlan([]), True, cancel)
+    return report
@@ -0,0 +1,187 @@
+"""
+Lightweight instrumentation of the slow steps: external commands (efibootmgr, findmnt, lsblk,
+pkexec, flatpak-spawn), efivarfs reads and writes, parsing and the GUI tasks built on them.
+
+Spans are recorded only once the registry is enabled (--profile or --profile-output, in the GUI
+and the command line alike), otherwise span() returns a shared no-op object and costs a single
+attribute check. Every span has a name, start time and duration in nanoseconds since the
+registry was enabled, the thread it ran on and optional arguments, such as the bytes read or
+written. Counters add up plain values.
+
+The registry can be dumped as JSON:
+
+    {"spans": [{"name": "run efibootmgr", "start": 1200, "duration": 35000000, "thread": 1,
+                "args": {"bytes": 4096}}],
+     "counters": {"efivarfs.bytes_written": 1024}}
+
+or in the Chrome trace event format, to open with chrome://tracing or Perfetto.
+"""
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+
+@dataclass(slots=True)
+class SpanStats:
+    count: int = 0
+    total: int = 0
+    max: int = 0
+    bytes: int = 0
+
+
+class Span:
+    """A timed step, used as a context manager"""
+    __slots__ = ('profiler', 'name', 'start', 'duration', 'thread', 'args')
+
+    def __init__(self, profiler: 'Profiler', name: str, args: dict):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+        self.start = 0
+        self.duration = 0
+        self.thread = threading.get_ident()
+
+    def add(self, **args):
+        """Records more arguments, e.g. the size of the output once it is known"""
+        self.args.update(args)
+
+    def __enter__(self) -> 'Span':
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter_ns() - self.start
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.profiler.record(self)
+
+
+class NullSpan:
+    """What span() returns when profiling is disabled"""
+    __slots__ = ()
+
+    def add(self, **args):
+        pass
+
+    def __enter__(self) -> 'NullSpan':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Profiler:
+    log = logging.getLogger('Profiler')
+
+    def __init__(self):
+        self.enabled = False
+        self.origin = 0
+        self.spans: list[Span] = []
+        self.counters: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        """Starts recording, with times relative to now"""
+        self.clear()
+        self.origin = time.perf_counter_ns()
+        self.enabled = True
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+            self.counters = {}
+
+    def span(self, name: str, **args) -> Span | NullSpan:
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def record(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def count(self, name: str, value: int = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timed(self, name: str):
+        """Decorator recording a span for every call of the decorated function"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def stats(self) -> dict[str, SpanStats]:
+        """:return: count, total and longest duration and bytes of the spans, by name"""
+        stats = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            span_stats = stats.get(span.name)
+            if span_stats is None:
+                span_stats = stats[span.name] = SpanStats()
+            span_stats.count += 1
+            span_stats.total += span.duration
+            span_stats.max = max(span_stats.max, span.duration)
+            span_stats.bytes += span.args.get('bytes', 0)
+        return stats
+
+    def summary(self) -> str:
+        """:return: a table of stats(), slowest first, followed by the counters"""
+        lines = [f"{'span':<36} {'count':>6} {'total ms':>10} {'max ms':>10} {'bytes':>10}"]
+        for name, span_stats in sorted(self.stats().items(), key=lambda item: -item[1].total):
+            lines.append(f"{name:<36} {span_stats.count:>6} {span_stats.total / 1e6:>10.3f} "
+                         f"{span_stats.max / 1e6:>10.3f} {span_stats.bytes:>10}")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name:<36} {value:>6}")
+        return '\n'.join(lines)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = list(self.spans)
+            counters = dict(self.counters)
+        return {
+            'spans': [{'name': span.name, 'start': span.start - self.origin, 'duration': span.duration,
+                       'thread': span.thread, 'args': span.args} for span in spans],
+            'counters': counters,
+        }
+
+    def to_chrome_trace(self) -> dict:
+        """:return: the spans as complete events and the counters as counter events, in microseconds"""
+        exported = self.to_dict()
+        pid = os.getpid()
+        events = [{'name': span['name'], 'ph': 'X', 'ts': span['start'] / 1000, 'dur': span['duration'] / 1000,
+                   'pid': pid, 'tid': span['thread'], 'args': span['args']} for span in exported['spans']]
+        end = max((event['ts'] + event['dur'] for event in events), default=0)
+        events += [{'name': name, 'ph': 'C', 'ts': end, 'pid': pid, 'args': {name: value}}
+                   for name, value in exported['counters'].items()]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, path: str, chrome: bool | None = None):
+        """
+        Writes the recorded spans to path, in the Chrome trace format if chrome is True or, by
+        default, if path ends with .trace.json.
+        """
+        if chrome is None:
+            chrome = path.endswith('.trace.json')
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace() if chrome else self.to_dict(), f)
+        self.log.info("Wrote %d spans to %s", len(self.spans), path)
+
+
+# the registry of the whole process
+profiler = Profiler()
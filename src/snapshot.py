@@ -0,0 +1,261 @@
+"""
+Snapshots of the boot configuration stored in NVRAM, to go back to it after a bad write.
+
+A snapshot holds the raw data and attributes of every Boot####, BootOrder, BootNext and Timeout
+variable, in a compact versioned binary file:
+
+    header     magic, format version, creation time, number of variables
+    label      length and UTF-8 text
+    host       length and UTF-8 text of the host name (since version 2)
+    digest     SHA-256 of the variables section, checked on load
+    variables  sorted by name: name length, name, attributes, data length, data
+
+The digest only depends on the variables, so two snapshots of the same configuration have the
+same digest whenever and wherever they were taken. Restoring a snapshot writes only the
+variables that differ from the live ones.
+"""
+import hashlib
+import logging
+import os
+import socket
+import struct
+import time
+from dataclasses import dataclass, field
+
+from efiboots.efibootmgr import EfibootmgrEfivarfs, ParsedEfibootmgr
+from efiboots.efivarfs import Efivarfs, boot_entry_regex
+from efiboots.loadoption import parse_load_option
+from efiboots.nvram import NvramPlan, VariableWrite
+
+MAGIC = b'EFIBSNAP'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<8sHdI')
+TEXT_LENGTH = struct.Struct('<H')
+VARIABLE_HEADER = struct.Struct('<II')
+DIGEST_SIZE = 32
+
+# BootCurrent is set by the firmware on every boot, it is not part of the configuration
+SNAPSHOT_VARIABLES = ('BootNext', 'BootOrder', 'Timeout')
+SNAPSHOT_SUFFIX = '.efisnap'
+# snapshots taken automatically before writes that are kept
+KEEP_SNAPSHOTS = 50
+
+
+def snapshot_dir() -> str:
+    state_home = os.environ.get('XDG_STATE_HOME') or os.path.expanduser('~/.local/state')
+    return os.path.join(state_home, 'efiboots', 'snapshots')
+
+
+def unpack_text(view: memoryview, offset: int) -> tuple[str, int]:
+    """:return: the UTF-8 text stored with its length at offset and the offset following it"""
+    length, = TEXT_LENGTH.unpack_from(view, offset)
+    offset += TEXT_LENGTH.size
+    return bytes(view[offset:offset + length]).decode('utf-8'), offset + length
+
+
+@dataclass(frozen=True, slots=True)
+class SnapshotVariable:
+    attributes: int
+    data: bytes
+
+
+@dataclass
+class SnapshotDiff:
+    """How the live variables differ from a snapshot"""
+    # variables missing from NVRAM, restoring the snapshot writes them again
+    missing: list[str] = field(default_factory=list)
+    # variables not in the snapshot, restoring it deletes them
+    extra: list[str] = field(default_factory=list)
+    changed: list[str] = field(default_factory=list)
+
+    def __bool__(self):
+        return bool(self.missing or self.extra or self.changed)
+
+
+@dataclass
+class Snapshot:
+    variables: dict[str, SnapshotVariable]
+    created: float = field(default_factory=time.time)
+    label: str = ''
+    host: str = ''
+
+    @classmethod
+    def capture(cls, efivarfs: Efivarfs, label: str = '', names: list[str] | None = None) -> 'Snapshot':
+        """
+        Reads the boot variables currently in NVRAM.
+        :param names: the variables to read, all the boot variables by default.
+        """
+        variables = {}
+        for name in names if names is not None else list(SNAPSHOT_VARIABLES) + efivarfs.list_boot_entries():
+            data, attributes = efivarfs.read(name)
+            if data is not None:
+                variables[name] = SnapshotVariable(attributes, data)
+        return cls(variables, label=label, host=socket.gethostname())
+
+    def encode_variables(self) -> bytes:
+        chunks = []
+        for name in sorted(self.variables):
+            variable = self.variables[name]
+            encoded_name = name.encode('ascii')
+            chunks += [bytes([len(encoded_name)]), encoded_name,
+                       VARIABLE_HEADER.pack(variable.attributes, len(variable.data)), variable.data]
+        return b''.join(chunks)
+
+    @property
+    def digest(self) -> str:
+        """SHA-256 of the variables, identifying the configuration"""
+        return hashlib.sha256(self.encode_variables()).hexdigest()
+
+    def to_bytes(self) -> bytes:
+        variables = self.encode_variables()
+        label = self.label.encode('utf-8')
+        host = self.host.encode('utf-8')
+        return b''.join([HEADER.pack(MAGIC, FORMAT_VERSION, self.created, len(self.variables)),
+                         TEXT_LENGTH.pack(len(label)), label, TEXT_LENGTH.pack(len(host)), host,
+                         hashlib.sha256(variables).digest(), variables])
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'Snapshot':
+        """:raise ValueError: if data is not a valid snapshot."""
+        view = memoryview(data)
+        try:
+            magic, version, created, count = HEADER.unpack_from(view)
+            if magic != MAGIC:
+                raise ValueError("not an efiboots snapshot")
+            if version > FORMAT_VERSION:
+                raise ValueError(f"snapshot format version {version} is not supported")
+            offset = HEADER.size
+            label, offset = unpack_text(view, offset)
+            host = ''
+            if version >= 2:
+                host, offset = unpack_text(view, offset)
+            digest = bytes(view[offset:offset + DIGEST_SIZE])
+            offset += DIGEST_SIZE
+            if hashlib.sha256(view[offset:]).digest() != digest:
+                raise ValueError("snapshot is corrupted, its digest doesn't match")
+
+            variables = {}
+            for _ in range(count):
+                name_length = view[offset]
+                name = bytes(view[offset + 1:offset + 1 + name_length]).decode('ascii')
+                offset += 1 + name_length
+                attributes, length = VARIABLE_HEADER.unpack_from(view, offset)
+                offset += VARIABLE_HEADER.size
+                variables[name] = SnapshotVariable(attributes, bytes(view[offset:offset + length]))
+                offset += length
+        except (struct.error, IndexError, UnicodeDecodeError) as e:
+            raise ValueError(f"truncated snapshot: {e}")
+        if offset != len(view):
+            raise ValueError("unexpected data after the snapshot variables")
+        return cls(variables, created, label, host)
+
+    def save(self, path: str):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.to_bytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'Snapshot':
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+    def to_parsed(self) -> ParsedEfibootmgr:
+        return EfibootmgrEfivarfs.parse((name, variable.data) for name, variable in sorted(self.variables.items()))
+
+    def diff(self, live: 'Snapshot') -> SnapshotDiff:
+        diff = SnapshotDiff()
+        for name in sorted(self.variables.keys() | live.variables.keys()):
+            ours, theirs = self.variables.get(name), live.variables.get(name)
+            if theirs is None:
+                diff.missing.append(name)
+            elif ours is None:
+                diff.extra.append(name)
+            elif ours != theirs:
+                diff.changed.append(name)
+        return diff
+
+    def describe(self, name: str) -> str:
+        """:return: name along with the label of the boot entry it holds"""
+        variable = self.variables.get(name)
+        if variable is not None and boot_entry_regex.match(name):
+            try:
+                return f"{name} ({parse_load_option(variable.data).description})"
+            except ValueError:
+                pass
+        return name
+
+    def format_diff(self, live: 'Snapshot') -> str:
+        """
+        :return: what restoring this snapshot over live would do, one variable per line: + for
+            the ones written back, - for the deleted ones and ~ for the rewritten ones.
+        """
+        diff = self.diff(live)
+        lines = [f"+{self.describe(name)}" for name in diff.missing]
+        lines += [f"-{live.describe(name)}" for name in diff.extra]
+        lines += [f"~{self.describe(name)}" for name in diff.changed]
+        return '\n'.join(lines)
+
+    def restore_plan(self, live: 'Snapshot') -> NvramPlan:
+        """
+        :return: the writes turning live into this snapshot, in the same safe order as
+            plan_writes(): entries first, then BootOrder, BootNext and Timeout, deletions last.
+        """
+        diff = self.diff(live)
+        rewritten = sorted(diff.missing + diff.changed, key=lambda name: (not boot_entry_regex.match(name), name))
+        writes = [VariableWrite(name, self.variables[name].data, self.variables[name].attributes)
+                  for name in rewritten]
+        extra = sorted(diff.extra, key=lambda name: (bool(boot_entry_regex.match(name)), name))
+        writes += [VariableWrite(name, None) for name in extra]
+        return NvramPlan(writes)
+
+
+class SnapshotStore:
+    """A directory of snapshots named after their creation time and digest"""
+    log = logging.getLogger('SnapshotStore')
+
+    def __init__(self, path: str | None = None, keep: int = KEEP_SNAPSHOTS):
+        self.path = path if path is not None else snapshot_dir()
+        self.keep = keep
+
+    def list(self) -> list[str]:
+        """:return: the paths of the snapshots, oldest first"""
+        try:
+            names = sorted(name for name in os.listdir(self.path) if name.endswith(SNAPSHOT_SUFFIX))
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.path, name) for name in names]
+
+    def add(self, snapshot: Snapshot) -> str:
+        """
+        Saves snapshot, unless the latest one holds the same variables, and removes the oldest
+        ones beyond keep.
+        :return: the path of the snapshot holding these variables.
+        """
+        digest = snapshot.digest
+        paths = self.list()
+        if paths and paths[-1].endswith(f'-{digest[:16]}{SNAPSHOT_SUFFIX}'):
+            self.log.info("Boot configuration unchanged since %s", paths[-1])
+            return paths[-1]
+        os.makedirs(self.path, exist_ok=True)
+        created = time.strftime('%Y%m%d-%H%M%S', time.localtime(snapshot.created))
+        path = os.path.join(self.path, f'{created}-{digest[:16]}{SNAPSHOT_SUFFIX}')
+        snapshot.save(path)
+        self.log.info("Saved snapshot of %d variables to %s", len(snapshot.variables), path)
+        for old_path in (paths + [path])[:-self.keep]:
+            os.unlink(old_path)
+        return path
+
+    def capture(self, efivarfs: Efivarfs, label: str = '') -> str | None:
+        """
+        Snapshots the boot configuration before it is written, see add().
+        :return: the snapshot path or None if it could not be taken.
+        """
+        if not efivarfs.is_available():
+            self.log.info("efivarfs not available, no snapshot taken")
+            return None
+        try:
+            return self.add(Snapshot.capture(efivarfs, label))
+        except OSError as e:
+            self.log.warning("Could not snapshot the boot configuration: %s", e)
+            return None
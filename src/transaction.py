@@ -0,0 +1,148 @@
+"""
+Transactional apply of NVRAM writes: either all of them end up in NVRAM or, as far as the
+firmware lets us, none of them.
+
+    snapshot  only the variables the plan touches are read
+    apply     the writes are sorted in dependency order (see order_writes) and handed to the
+              privileged writer all at once
+    verify    the touched variables are read back and compared with what was written
+    rollback  when the apply fails or a variable reads back differently, the variables that
+              differ from the snapshot, and only those, are written back and verified again
+
+Every step is timed: the timings are in the TransactionReport and recorded by the profiler.
+"""
+import logging
+import time
+from collections.abc import Callable
+from dataclasses import dataclass, field
+
+from efiboots.efivarfs import Efivarfs, boot_entry_regex
+from efiboots.nvram import NvramPlan, VariableWrite
+from efiboots.profiling import profiler
+from efiboots.snapshot import Snapshot
+
+
+@dataclass(frozen=True, slots=True)
+class StepTiming:
+    name: str
+    seconds: float
+
+    def __str__(self):
+        return f"{self.name} {self.seconds * 1000:.1f} ms"
+
+
+@dataclass
+class TransactionReport:
+    plan: NvramPlan
+    steps: list[StepTiming] = field(default_factory=list)
+    # variables that didn't read back as written
+    mismatches: list[str] = field(default_factory=list)
+    rollback: NvramPlan | None = None
+    # variables still differing from the snapshot after the rollback
+    rollback_mismatches: list[str] = field(default_factory=list)
+
+    @property
+    def seconds(self) -> float:
+        return sum(step.seconds for step in self.steps)
+
+    def format_timings(self) -> str:
+        return ', '.join(map(str, self.steps)) + f" (total {self.seconds * 1000:.1f} ms)"
+
+
+class TransactionError(Exception):
+    """The writes have been rolled back, or couldn't be: see report.rollback_mismatches"""
+
+    def __init__(self, message: str, report: TransactionReport):
+        super().__init__(message)
+        self.report = report
+
+
+def write_rank(write: VariableWrite) -> int:
+    """
+    Position of write in dependency order: entries are created and changed before BootOrder,
+    BootNext and Timeout point to them and deleted only after those stopped pointing to them.
+    """
+    if boot_entry_regex.match(write.name):
+        return 4 if write.data is None else 0
+    return {'BootOrder': 1, 'BootNext': 2}.get(write.name, 3)
+
+
+def order_writes(plan: NvramPlan) -> NvramPlan:
+    """:return: plan sorted in dependency order, keeping the order of writes of the same rank"""
+    return NvramPlan(sorted(plan.writes, key=write_rank))
+
+
+def verify(efivarfs: Efivarfs, expected: dict[str, bytes | None]) -> list[str]:
+    """:return: the names of the variables whose data is not the expected one (None: deleted)"""
+    return [name for name, data in expected.items() if efivarfs.read(name)[0] != data]
+
+
+class Transaction:
+    log = logging.getLogger('Transaction')
+
+    def __init__(self, efivarfs: Efivarfs, write: Callable[[NvramPlan], None],
+                 rollback_write: Callable[[NvramPlan], None] | None = None):
+        """
+        :param write: applies a plan with the privileges needed, e.g. execute_writes_as_root().
+        :param rollback_write: applies the rollback, write by default. It must not be cancellable
+            as write may be: the rollback runs when write has been cancelled.
+        """
+        self.efivarfs = efivarfs
+        self.write = write
+        self.rollback_write = rollback_write if rollback_write is not None else write
+
+    def step(self, report: TransactionReport, name: str, func: Callable, *args):
+        start = time.perf_counter()
+        try:
+            with profiler.span(f'transaction {name}'):
+                return func(*args)
+        finally:
+            report.steps.append(StepTiming(name, time.perf_counter() - start))
+
+    def apply(self, plan: NvramPlan) -> TransactionReport:
+        """
+        :return: the report of the successful transaction.
+        :raise TransactionError: if the writes didn't read back as written, or write failed or was
+            cancelled after writing some of them, and they have been rolled back.
+        :raise Exception: what write raised when it wrote nothing.
+        """
+        plan = order_writes(plan)
+        report = TransactionReport(plan)
+        names = list(dict.fromkeys(write.name for write in plan.writes))
+        before = self.step(report, 'snapshot', Snapshot.capture, self.efivarfs, '', names)
+        try:
+            self.step(report, 'apply', self.write, plan)
+        except Exception as e:
+            self.rollback(report, before, names)
+            if not report.rollback:
+                raise
+            raise TransactionError(f"{e or type(e).__name__}, "
+                                   f"{'changes rolled back' if not report.rollback_mismatches else 'rollback failed'}",
+                                   report) from e
+        expected = {write.name: write.data for write in plan.writes}
+        report.mismatches = self.step(report, 'verify', verify, self.efivarfs, expected)
+        if report.mismatches:
+            self.log.error("Variables not written as requested: %s", ', '.join(report.mismatches))
+            self.rollback(report, before, names)
+            raise TransactionError(f"{', '.join(report.mismatches)} didn't read back as written, "
+                                   f"{'changes rolled back' if not report.rollback_mismatches else 'rollback failed'}",
+                                   report)
+        self.log.info("Applied %d writes: %s", len(plan.writes), report.format_timings())
+        return report
+
+    def rollback(self, report: TransactionReport, before: Snapshot, names: list[str]):
+        """Writes back the touched variables that differ from before"""
+        live = self.step(report, 'readback', Snapshot.capture, self.efivarfs, '', names)
+        report.rollback = before.restore_plan(live)
+        if not report.rollback:
+            self.log.info("Nothing was written, nothing to roll back")
+            return
+        self.log.warning("Rolling back: %s", ', '.join(map(str, report.rollback.writes)))
+        try:
+            self.step(report, 'rollback', self.rollback_write, report.rollback)
+        except Exception as e:
+            self.log.error("Rollback failed: %s", e)
+        expected = {name: before.variables[name].data if name in before.variables else None for name in names}
+        report.rollback_mismatches = self.step(report, 'verify rollback', verify, self.efivarfs, expected)
+        if report.rollback_mismatches:
+            self.log.error("Rollback incomplete, restore the last snapshot: %s", ', '.join(report.rollback_mismatches))
@@ -1,14 +1,22 @@
 import sys
 import subprocess
-import re
 import logging
 import gi
-import os
+import threading
 
 from typing import Callable
 from gettext import gettext as _
 
-from efiboots.efibootmgr import Efibootmgr
+from efiboots.cache import SystemCache
+from efiboots.esp import MultipleEspsError, auto_detect_esp
+from efiboots.efibootmgr import EfibootmgrEfivarfs, ParsedEfibootmgr, OperationCancelled
+from efiboots.efivarfs import Efivarfs
+from efiboots.liststore import EfibootRowModel, EfibootsListStore
+from efiboots.nvram import DEV_DISK_BY_PARTUUID
+from efiboots.privileged import execute_script_as_root, execute_transaction_as_root
+from efiboots.profiling import profiler
+from efiboots.snapshot import SnapshotStore
+from efiboots.transaction import TransactionError
 
 gi.require_version('Gtk', '4.0')
 from gi.repository import Gtk, Gio, GObject, GLib
@@ -57,311 +65,112 @@ You can either mount your ESP on /boot/efi or pass the ESP block device via --di
 Choose wisely.
 """)
 
-device_regex = re.compile(r'^([a-z/]+[0-9a-z]*?)p?([0-9]+)$')
-
-
-def is_in_flatpak():
-    return "FLATPAK_ID" in os.environ
-
-
-def subprocess_run_wrapper(cmd):
-    if is_in_flatpak():
-        cmd = [ "flatpak-spawn", "--host" ] + cmd
-        logging.debug("Flatpak sandbox detected. Running: %s", ' '.join(cmd))
-    else:
-        logging.debug("Running: %s", ' '.join(cmd))
-    return subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
-
-
-def device_to_disk_part(device: str) -> tuple[str, str]:
-    try:
-        disk, part = device_regex.match(device).groups()
-        logging.debug("Device path %s split into %s and %s", device, disk, part)
-        return disk, part
-    except AttributeError:
-        raise ValueError("Could not match device " + device)
 
+class BackgroundTask:
+    """
+    Runs func(cancel) in a worker thread, so that the GTK main loop keeps running, and then calls
+    either on_done(result) or on_error(exception) on the main loop. Tasks that are not cancellable
+    (e.g. writes to NVRAM, which must not stop halfway) ignore cancel().
+    """
+    def __init__(self, func: Callable, on_done: Callable, on_error: Callable, cancellable: bool = True):
+        self.func = func
+        self.on_done = on_done
+        self.on_error = on_error
+        self.cancellable = cancellable
+        self.cancel_event = threading.Event()
 
-def make_auto_detect_esp_with_findmnt(esp_mount_point) -> Callable:
-    def auto_detect_esp_with_findmnt() -> tuple[str, str] | None:
-        # findmnt --noheadings --output SOURCE --mountpoint /boot/efi
-        cmd = ["findmnt", "--noheadings", "--output", "SOURCE,FSTYPE", "--mountpoint", esp_mount_point]
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
 
+    def cancel(self):
+        if self.cancellable:
+            self.cancel_event.set()
 
+    def _run(self):
         try:
-            findmnt_output = subprocess_run_wrapper(cmd)
-        except (FileNotFoundError, subprocess.CalledProcessError) as e:
-            logging.warning("Could not detect ESP with findmnt: %s", e)
-            return
-        splitted = findmnt_output.strip().split()
-        for source, fstype in zip(splitted[::2], splitted[1::2]):
-            if fstype == 'vfat':
-                disk, part = device_to_disk_part(source)
-                return disk, part
+            result = self.func(self.cancel_event)
+        except Exception as e:
+            GLib.idle_add(self._finish, self.on_error, e)
+        else:
+            GLib.idle_add(self._finish, self.on_done, result)
 
-    return auto_detect_esp_with_findmnt
+    @staticmethod
+    def _finish(callback: Callable, value):
+        callback(value)
+        return GLib.SOURCE_REMOVE
 
 
-def auto_detect_esp_with_lsblk() -> tuple[str, str] | None:
+class EfivarfsMonitor:
     """
-    Finds the ESP by scanning the partition table. It should work with GPT (tested) and MBR (not tested).
-    This method doesn't require the ESP to be mounted.
-    :return: 2 strings that can be passed to efibootmgr --disk and --part argument.
+    Watches efivarfs for boot variables changed by other programs (bootctl, grub-install...) and
+    calls on_change with their names. A Gio.FileMonitor is used when possible, otherwise the
+    modification times are polled.
     """
-    esp_part_types = ('C12A7328-F81F-11D2-BA4B-00A0C93EC93B', 'EF')
-
-    # lsblk --noheadings --pairs --paths --output NAME,PARTTYPE
-    cmd = ['lsblk', '--noheadings', '--pairs', '--paths', '--output', 'NAME,PARTTYPE,FSTYPE']
-
-    logging.debug("Running: %s", ' '.join(cmd))
-    try:
-        res = subprocess_run_wrapper(cmd).strip()
-    except (FileNotFoundError, subprocess.CalledProcessError) as e:
-        logging.warning("Could not detect ESP with lsblk: %s", e)
-        return
-    regex = re.compile('^NAME="(.+)" PARTTYPE="(.+)" FSTYPE="(.+)"$', re.MULTILINE)
-    esps = []
-    for match in regex.finditer(res):
-        name, part_type, fs_type = match.groups()
-        if part_type.upper() in esp_part_types and fs_type == 'vfat':
-            esps.append(name)
-    logging.info(esps)
-    if len(esps) == 0:
-        return None
-    if len(esps) == 1:
-        source = esps[0]
-        disk, part = device_to_disk_part(source)
-    else:
-        logging.warning(many_esps_error_message)
-        def on_response(*args):
-            logging.debug("sys.exit(-1)")
-            sys.exit(-1)
-        error_dialog(None, many_esps_error_message + "\n" + _("Detected ESPs: ") + ', '.join(esps),
-                     _("More than one EFI System Partition detected!"), on_response)
-        return None
-    return disk, part
-
-
-def auto_detect_esp():
-    methods = (make_auto_detect_esp_with_findmnt('/efi'), make_auto_detect_esp_with_findmnt('/boot/efi'),
-               make_auto_detect_esp_with_findmnt('/boot'), auto_detect_esp_with_lsblk)
-    for find_esp_method in methods:
-        result = find_esp_method()
-        if not result:
-            continue
-        disk, part = result
-        logging.info("Detected ESP on disk %s part %s", disk, part)
-        return disk, part
-    logging.fatal("Can't auto-detect ESP! All methods failed.")
-    return None, None
-
-
-def execute_script_as_root(script):
-    logging.info("Running command `pkexec sh -c %s`", script)
-    subprocess_run_wrapper(["pkexec", "sh", "-c", script])
-
-
-class EfibootRowModel(GObject.Object):
-    __gtype_name__ = "EfibootRowModel"
-
-    current = GObject.Property(type=bool, default=False)
-    num = GObject.Property(type=str)
-    name = GObject.Property(type=str)
-    path = GObject.Property(type=str)
-    parameters = GObject.Property(type=str)
-    active = GObject.Property(type=bool, default=True)
-    next = GObject.Property(type=bool, default=False)
-
-    def __init__(self, current: bool, num: str, name: str, path: str, parameters: str, active: bool, next: bool):
-        super().__init__()
-        self.current = current
-        self.num = num
-        self.name = name
-        self.path = path
-        self.parameters = parameters
-        self.active = active
-        self.next = next
-
-        self.radio_buttons_group = Gtk.CheckButton()
-
-    def __str__(self):
-        return f"EfibootModelRow {'current' if self.current else ''} num{self.num} {self.name} {self.path}" \
-               f" {self.parameters} {'active' if self.active else 'inactive'} {'next' if self.next else ''}"
-
-
-class EfibootsListStore(Gio.ListStore):
-    def __init__(self, window: 'EfibootsMainWindow'):
-        self.window = window
-        super().__init__(item_type=EfibootRowModel)
-        self._efibootmgr = None
-
-        self.boot_order = []
-        self.boot_order_initial = []
-        self.boot_next = None
-        self.boot_next_initial = None
-        self.boot_active = set()
-        self.boot_inactive = set()
-        self.boot_add = {}
-        self.boot_remove = set()
-        self.boot_current = None
-        self.timeout = None
-        self.timeout_initial = None
-        self.edit_parameters = set()
-        self.edit_loader = set()
-        self.edit_name = set()
-
-    def __str__(self):
-        return f"next: {self.boot_next} order: {self.boot_order} add: {self.boot_add} rem: {self.boot_remove} " \
-               f"active: {self.boot_active} inactive: {self.boot_inactive} timeout: {self.timeout}"
-
-    @property
-    def efibootmgr(self):
-        if self._efibootmgr is None:
-            self._efibootmgr = Efibootmgr.get_instance()
-        return self._efibootmgr
-
-    def swap(self, a, b):
-        self.boot_order[a], self.boot_order[b] = self.boot_order[b], self.boot_order[a]
-
-    def index_num(self, num):
-        for i, row in enumerate(self):
-            if row.num == num:
-                return i
-
-    def clear(self):
-        self.remove_all()
-        self.boot_order = []
-        self.boot_order_initial = []
-        self.boot_next: str | None = None
-        self.boot_next_initial: str | None = None
-        self.boot_active = set()
-        self.boot_inactive = set()
-        self.boot_add = {}
-        self.boot_remove = set()
-        self.boot_current = None
-        self.timeout = None
-        self.timeout_initial = None
-        self.edit_parameters = set()
-        self.edit_loader = set()
-        self.edit_name = set()
-
-    def refresh(self):
-        self.clear()
-
+    POLL_INTERVAL = 2
+    # efibootmgr and friends write several variables in a row, report them together
+    DEBOUNCE_MS = 250
+
+    def __init__(self, efivarfs: Efivarfs, on_change: Callable[[set[str]], None]):
+        self.efivarfs = efivarfs
+        self.on_change = on_change
+        self.pending: set[str] = set()
+        self.monitor: Gio.FileMonitor | None = None
+        self.poll_id: int | None = None
+        self.debounce_id: int | None = None
+        self.stats: dict[str, tuple[int, int]] = {}
+
+    def start(self):
         try:
-            boot = self.efibootmgr.run()
-        except (FileNotFoundError, subprocess.CalledProcessError) as e:
-            logging.exception("Error running efibootmgr. Please check that it is correctly installed.")
-            error_dialog(transient_for=self.window, title=_("efibootmgr utility not installed!"),
-                         message=_("Please check that the efibootmgr utility is correctly installed, as this program requires its output.") + f"\n{str(e)}",
-                         on_response=lambda *_: sys.exit(-1))
-            return
-        except UnicodeDecodeError as e:
-            logging.exception("Error decoding efibootmgr -v output.")
-            error_dialog(transient_for=self.window, title=_("Error while decoding efibootmgr output."),
-                         message=_("Could not decode efiboomgr output.") + f"\n{e}", on_response=lambda *_: sys.exit(-2))
-            return
-
-        if boot is not None:
-            parsed_efi = self.efibootmgr.parse(boot)
-            for entry in parsed_efi.entries:
-                row = EfibootRowModel(entry.num == parsed_efi.boot_current,
-                                      entry.num,
-                                      entry.name,
-                                      entry.path,
-                                      entry.parameters,
-                                      entry.active,
-                                      entry.num == parsed_efi.boot_next)
-                self.append(row)
-
-            self.boot_order_initial = parsed_efi.boot_order
-            self.boot_order = list(self.boot_order_initial)
-            self.boot_next = self.boot_next_initial = parsed_efi.boot_next
-            self.boot_current = parsed_efi.boot_current
-            self.timeout = self.timeout_initial = parsed_efi.timeout
-            self.window.timeout_spin.set_value(self.timeout)
-
-            self.sort(self.sort_by_boot_order)
-
-    def sort_by_boot_order(self, row1: EfibootRowModel, row2: EfibootRowModel) -> int:
-        row1_index = self.boot_order.index(row1.num)
-        row2_index = self.boot_order.index(row2.num)
-        return row1_index - row2_index
-
-    def change_boot_next(self, action: Gio.SimpleAction, num_variant: GLib.Variant):
-        num = num_variant.get_string()
-        if self.boot_next == num:
-            action.set_state(GLib.Variant.new_string(""))
-            self.boot_next = None
-        else:
-            action.set_state(num_variant)
-            self.boot_next = num
-        logging.debug("%s changed to %s", action.get_name(), action.get_state())
-
-    def change_active(self, widget: Gtk.Switch, state: bool, row: EfibootRowModel):
-        row.active = state
-        num = row.num
-        if row.active:
-            if num in self.boot_inactive:
-                self.boot_inactive.remove(num)
-            else:
-                self.boot_active.add(num)
-        else:
-            if num in self.boot_active:
-                self.boot_active.remove(num)
-            else:
-                self.boot_inactive.add(num)
-
-        logging.debug("%s %s %s", row, self.boot_active, self.boot_inactive)
-
-    def add(self, label, path, parameters):
-        new_num = "NEW{:d}".format(len(self.boot_add))
-        row = EfibootRowModel(False, new_num, label, path, parameters, True, False)
-        self.append(row)
-        self.boot_add[new_num] = (label, path, parameters)
-
-    def remove(self, position: int):
-        item: EfibootRowModel | None = self.get_item(position)
-        if item is not None:
-            num: str = item.num
-            if num.startswith('NEW'):
-                del self.boot_add[num]
-            else:
-                self.boot_remove.add(num)
-                self.boot_order.remove(num)
-            super().remove(position)
-
-    def pending_changes(self):
-        logging.debug("%s", self)
-        return (self.boot_next_initial != self.boot_next or
-                self.boot_order_initial != self.boot_order or self.boot_add or
-                self.boot_remove or self.boot_active or self.boot_inactive
-                or self.timeout != self.timeout_initial
-                )
-
-    def to_script(self, disk, part, reboot):
-        esp = f"--disk {disk} --part {part}"
-        script = ''
-        for entry in self.boot_remove:
-            script += f'efibootmgr {esp} --delete-bootnum --bootnum {entry}\n'
-        for label, loader, params in self.boot_add.values():
-            script += f'efibootmgr {esp} --create --label \'{label}\' --loader \'{loader}\' --unicode \'{params}\'\n'
-        if self.boot_order != self.boot_order_initial:
-            script += f'efibootmgr {esp} --bootorder {",".join(self.boot_order)}\n'
-        if self.boot_next_initial != self.boot_next:
-            if self.boot_next is None:
-                script += f'efibootmgr {esp} --delete-bootnext\n'
-            else:
-                script += f'efibootmgr {esp} --bootnext {self.boot_next}\n'
-        for entry in self.boot_active:
-            script += f'efibootmgr {esp} --bootnum {entry} --active\n'
-        for entry in self.boot_inactive:
-            script += f'efibootmgr {esp} --bootnum {entry} --inactive\n'
-        if self.timeout != self.timeout_initial:
-            script += f'efibootmgr {esp} --timeout {self.timeout}\n'
-        if reboot:
-            script += "reboot\n"
-        return script
+            self.monitor = Gio.File.new_for_path(self.efivarfs.path).monitor_directory(Gio.FileMonitorFlags.NONE,
+                                                                                      None)
+            self.monitor.connect("changed", self.on_file_changed)
+            logging.info("Monitoring %s for changes", self.efivarfs.path)
+        except GLib.Error as e:
+            logging.info("Can't monitor %s, polling it instead: %s", self.efivarfs.path, e.message)
+            self.stats = self.efivarfs.stat_boot_variables()
+            self.poll_id = GLib.timeout_add_seconds(self.POLL_INTERVAL, self.poll)
+
+    def stop(self):
+        if self.monitor is not None:
+            self.monitor.cancel()
+            self.monitor = None
+        for source_id in (self.poll_id, self.debounce_id):
+            if source_id is not None:
+                GLib.source_remove(source_id)
+        self.poll_id = self.debounce_id = None
+        self.pending.clear()
+
+    def on_file_changed(self, monitor: Gio.FileMonitor, file: Gio.File, other_file: Gio.File | None,
+                        event_type: Gio.FileMonitorEvent):
+        if event_type in (Gio.FileMonitorEvent.CHANGES_DONE_HINT, Gio.FileMonitorEvent.CREATED,
+                          Gio.FileMonitorEvent.DELETED, Gio.FileMonitorEvent.CHANGED):
+            name = self.efivarfs.boot_variable_name(file.get_basename())
+            if name is not None:
+                self.queue({name})
+
+    def poll(self):
+        try:
+            stats = self.efivarfs.stat_boot_variables()
+        except OSError as e:
+            logging.warning("Could not poll %s: %s", self.efivarfs.path, e)
+            return GLib.SOURCE_CONTINUE
+        changed = {name for name in stats.keys() | self.stats.keys() if stats.get(name) != self.stats.get(name)}
+        self.stats = stats
+        if changed:
+            self.queue(changed)
+        return GLib.SOURCE_CONTINUE
+
+    def queue(self, names: set[str]):
+        self.pending |= names
+        if self.debounce_id is None:
+            self.debounce_id = GLib.timeout_add(self.DEBOUNCE_MS, self.flush)
+
+    def flush(self):
+        self.debounce_id = None
+        names, self.pending = self.pending, set()
+        logging.debug("Variables changed externally: %s", names)
+        self.on_change(names)
+        return GLib.SOURCE_REMOVE
 
 
 @Gtk.Template(resource_path='/ovh/elinvention/Efiboots/gtk/main.ui')
@@ -379,11 +188,25 @@ class EfibootsMainWindow(Gtk.ApplicationWindow):
 
     timeout_spin: Gtk.SpinButton = Gtk.Template.Child()
 
+    refresh_button: Gtk.Button = Gtk.Template.Child()
+    save_button: Gtk.Button = Gtk.Template.Child()
+    reboot_button: Gtk.Button = Gtk.Template.Child()
+
+    progress_revealer: Gtk.Revealer = Gtk.Template.Child()
+    progress_spinner: Gtk.Spinner = Gtk.Template.Child()
+    progress_label: Gtk.Label = Gtk.Template.Child()
+    cancel_button: Gtk.Button = Gtk.Template.Child()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.APP_VERSION: str = kwargs['application'].APP_VERSION
         self.part: str | None = None
         self.disk: str | None = None
+        self.task: BackgroundTask | None = None
+        self.monitor: EfivarfsMonitor | None = None
+        self.partitions_monitor: Gio.FileMonitor | None = None
+        self.partitions_debounce_id: int | None = None
+        self.cache = SystemCache()
         self.model = EfibootsListStore(self)
         self.selection_model = Gtk.SingleSelection(model=self.model)
         self.column_view.set_model(self.selection_model)
@@ -466,31 +289,184 @@ class EfibootsMainWindow(Gtk.ApplicationWindow):
         about_dialog.present()
 
     def next_boot_handler(self, action: Gio.SimpleAction, state: str):
-        self.model.boot_next = state
+        self.model.state.boot_next = state
+
+    def run_task(self, message: str, func: Callable, on_done: Callable, on_error: Callable,
+                 cancellable: bool = True):
+        """Runs func in the background while showing message, a spinner and, if cancellable, a cancel button"""
+        def finish(callback):
+            def wrapper(value):
+                self.task = None
+                self.set_busy(None)
+                callback(value)
+            return wrapper
+
+        self.task = BackgroundTask(func, finish(on_done), finish(on_error), cancellable)
+        self.set_busy(message, cancellable)
+        self.task.start()
+
+    def set_busy(self, message: str | None, cancellable: bool = True):
+        busy = message is not None
+        if busy:
+            self.progress_label.set_label(message)
+            self.cancel_button.set_visible(cancellable)
+        self.progress_revealer.set_reveal_child(busy)
+        self.progress_spinner.set_spinning(busy)
+        for button in (self.refresh_button, self.save_button, self.reboot_button):
+            button.set_sensitive(not busy)
+
+    def on_read_error(self, e: Exception):
+        if isinstance(e, OperationCancelled):
+            logging.info("Cancelled: %s", e)
+        elif isinstance(e, MultipleEspsError):
+            error_dialog(self, many_esps_error_message + "\n" + _("Detected ESPs: ") + ', '.join(e.esps),
+                         _("More than one EFI System Partition detected!"), lambda *_: sys.exit(-1))
+        elif isinstance(e, (FileNotFoundError, subprocess.CalledProcessError)):
+            logging.error("Error running efibootmgr. Please check that it is correctly installed.", exc_info=e)
+            error_dialog(transient_for=self, title=_("efibootmgr utility not installed!"),
+                         message=_("Please check that the efibootmgr utility is correctly installed, as this program requires its output.") + f"\n{str(e)}",
+                         on_response=lambda *_: sys.exit(-1))
+        elif isinstance(e, UnicodeDecodeError):
+            logging.error("Error decoding efibootmgr -v output.", exc_info=e)
+            error_dialog(transient_for=self, title=_("Error while decoding efibootmgr output."),
+                         message=_("Could not decode efiboomgr output.") + f"\n{e}", on_response=lambda *_: sys.exit(-2))
+        else:
+            raise e
+
+    def on_write_error(self, e: Exception):
+        if isinstance(e, OperationCancelled):
+            logging.info("Cancelled: %s", e)
+        elif isinstance(e, TransactionError):
+            if e.report.rollback_mismatches:
+                message = _("Some changes could not be undone, restore the last snapshot with "
+                            "efiboots snapshot restore:") + "\n" + ', '.join(e.report.rollback_mismatches)
+                # NVRAM is neither what was read nor what was edited anymore
+                self.refresh()
+            else:
+                # NVRAM is back to what was read, the changes are still pending
+                message = _("NVRAM has been restored, your changes have not been saved.")
+            if e.report.mismatches:
+                cause = _("The firmware didn't store these variables as requested:") + "\n" + \
+                        ', '.join(e.report.mismatches)
+            elif isinstance(e.__cause__, OperationCancelled):
+                cause = _("Writing was cancelled after some variables had been written.")
+            else:
+                cause = _("Writing failed after some variables had been written:") + f"\n{e.__cause__}"
+            error_dialog(self, cause + "\n\n" + message, _("Could not write the boot entries"),
+                         lambda d, r: d.close())
+        elif isinstance(e, FileNotFoundError):
+            error_dialog(self, _("The pkexec command from PolKit is "
+                               "required to execute commands with elevated privileges.\n") +
+                               f"{e}", _("pkexec not found"), lambda d, r: d.close())
+        elif isinstance(e, subprocess.CalledProcessError):
+            error_dialog(self, f"{e}\n{e.stderr}", "Error", lambda d, r: d.close())
+        elif isinstance(e, PermissionError):
+            error_dialog(self, str(e), _("Not authorized"), lambda d, r: d.close())
+        elif isinstance(e, (OSError, ValueError)):
+            # from the D-Bus helper
+            error_dialog(self, str(e), _("Could not write the boot entries"), lambda d, r: d.close())
+        else:
+            self.on_read_error(e)
 
     def query_system(self, disk, part):
-        if not (disk and part):
-            disk, part = auto_detect_esp()
-        if not (disk and part):
-            error_dialog(self, _("Could not find an EFI System Partition. Ensure your ESP is mounted on /efi, "
-                               "/boot/efi or /boot, that it has the correct partition type and vfat file system and that "
-                               "either findmnt or lsblk commands are installed (should be by default on most distros)."),
-                         _("Can't auto-detect ESP!"), lambda *_: sys.exit(-1))
+        @profiler.timed('startup')
+        def detect_and_read(cancel: threading.Event):
+            if disk and part:
+                found_disk, found_part = disk, part
+            elif cached := self.cache.get_esp():
+                found_disk, found_part = cached
+                logging.info("Using cached ESP on disk %s part %s", found_disk, found_part)
+            else:
+                found_disk, found_part = auto_detect_esp(cancel)
+                if not (found_disk and found_part):
+                    return None, None, None
+                self.cache.set_esp(found_disk, found_part)
+            return found_disk, found_part, self.model.read()
+
+        def on_done(result):
+            found_disk, found_part, parsed_efi = result
+            if not (found_disk and found_part):
+                error_dialog(self, _("Could not find an EFI System Partition. Ensure your ESP is mounted on /efi, "
+                                   "/boot/efi or /boot, that it has the correct partition type and vfat file system and that "
+                                   "either findmnt or lsblk commands are installed (should be by default on most distros)."),
+                             _("Can't auto-detect ESP!"), lambda *_: sys.exit(-1))
+                return
+            self.disk, self.part = found_disk, found_part
+            self.model.load(parsed_efi)
+            if isinstance(self.model.efibootmgr, EfibootmgrEfivarfs) and self.monitor is None:
+                self.monitor = EfivarfsMonitor(self.model.efibootmgr.efivarfs, self.on_nvram_changed)
+                self.monitor.start()
+            if self.partitions_monitor is None:
+                self.watch_partitions()
+
+        self.run_task(_("Detecting EFI System Partition and reading boot entries…"), detect_and_read, on_done,
+                      self.on_read_error)
+
+    def on_nvram_changed(self, names: set[str]):
+        """Reads again only the variables changed by another program and patches the affected rows"""
+        if self.task is not None or self.model.state.parsed_efi is None:
+            # the running task reads everything again when it's done
             return
-        self.disk, self.part = disk, part
-        self.model.refresh()
+        efibootmgr: EfibootmgrEfivarfs = self.model.efibootmgr
+
+        def on_done(variables):
+            if self.task is not None or self.model.state.parsed_efi is None:
+                return
+            result = self.model.merge(efibootmgr.patch(self.model.state.parsed_efi, variables))
+            if result.boot_next_changed:
+                self.lookup_action("next_boot").set_state(GLib.Variant.new_string(self.model.state.boot_next or ""))
+            if result.conflicts:
+                def on_response(dialog, response):
+                    if response == Gtk.ResponseType.YES:
+                        self.refresh()
+                    dialog.close()
+
+                yes_no_dialog(self, _("Boot entries changed by another program"),
+                              _("These changes conflict with the ones you haven't saved yet:") + "\n\n" +
+                              "\n".join(result.conflicts) + "\n\n" +
+                              _("Do you want to discard your changes and reload?"), on_response)
+
+        BackgroundTask(lambda cancel: efibootmgr.read_variables(names), on_done,
+                       lambda e: logging.warning("Could not read changed variables: %s", e)).start()
+
+    def watch_partitions(self):
+        """Lists the partitions again when udev adds or removes some, e.g. when a USB stick is plugged"""
+        try:
+            self.partitions_monitor = Gio.File.new_for_path(DEV_DISK_BY_PARTUUID).monitor_directory(
+                Gio.FileMonitorFlags.NONE, None)
+        except GLib.Error as e:
+            logging.info("Can't monitor %s: %s", DEV_DISK_BY_PARTUUID, e.message)
+            return
+        self.partitions_monitor.connect("changed", self.on_partitions_changed)
+
+    def on_partitions_changed(self, monitor: Gio.FileMonitor, file: Gio.File, other_file: Gio.File | None,
+                              event_type: Gio.FileMonitorEvent):
+        if event_type not in (Gio.FileMonitorEvent.CREATED, Gio.FileMonitorEvent.DELETED):
+            return
+        # all the partitions of a disk appear at once, list them only once. The Disk column keeps
+        # showing the previous ones until the worker has listed them all again.
+        if self.partitions_debounce_id is None:
+            self.partitions_debounce_id = GLib.timeout_add(EfivarfsMonitor.DEBOUNCE_MS, self.reload_partitions)
+
+    def reload_partitions(self):
+        self.partitions_debounce_id = None
+        BackgroundTask(lambda cancel: self.model.partitions.refresh(), lambda _: self.model.reload_partitions(),
+                       lambda e: logging.warning("Could not list partitions: %s", e)).start()
+        return GLib.SOURCE_REMOVE
+
+    def refresh(self):
+        self.run_task(_("Reading boot entries…"), lambda cancel: self.model.read(), self.model.load,
+                      self.on_read_error)
 
     @Gtk.Template.Callback()
     def on_clicked_up(self, _: Gtk.Button):
         index = self.selection_model.get_selected()
-        self.model.swap(index, max(index - 1, 0))
-        self.model.sort(self.model.sort_by_boot_order)
+        self.selection_model.set_selected(self.model.move(index, -1))
 
     @Gtk.Template.Callback()
     def on_clicked_down(self, _: Gtk.Button):
         index = self.selection_model.get_selected()
-        self.model.swap(index, min(index + 1, len(self.model) - 1))
-        self.model.sort(self.model.sort_by_boot_order)
+        self.selection_model.set_selected(self.model.move(index, 1))
 
     @Gtk.Template.Callback()
     def on_clicked_add(self, __: Gtk.Button):
@@ -547,24 +523,33 @@ class EfibootsMainWindow(Gtk.ApplicationWindow):
     @Gtk.Template.Callback()
     def on_clicked_save(self, button: Gtk.Button):
         if self.model.pending_changes():
-            script = self.model.to_script(self.disk, self.part, button.get_buildable_id() == "reboot_button")
+            reboot = button.get_buildable_id() == "reboot_button"
+            plan = self.model.to_writes(self.disk, self.part)
+            if plan is not None:
+                description = _("The following EFI variables will be written ({} bytes):").format(plan.bytes_written) + \
+                              "\n\n" + str(plan) + ("\nreboot" if reboot else "")
+                execute = lambda: execute_transaction_as_root(plan, reboot)
+            else:
+                script = self.model.to_script(self.disk, self.part, reboot)
+                description = _("The following commands will be run:") + "\n\n" + script
+                execute = lambda: execute_script_as_root(script)
+
+            def execute_and_read(cancel: threading.Event) -> ParsedEfibootmgr:
+                with profiler.span('save'):
+                    with profiler.span('snapshot'):
+                        SnapshotStore().capture(Efivarfs(), "before saving changes")
+                    execute()
+                    return self.model.read()
 
             def on_response(dialog, response):
                 if response == Gtk.ResponseType.YES:
-                    try:
-                        execute_script_as_root(script)
-                        self.model.refresh()
-                    except FileNotFoundError as e:
-                        error_dialog(self, _("The pkexec command from PolKit is "
-                                           "required to execute commands with elevated privileges.\n") +
-                                           f"{e}", _("pkexec not found"), lambda d, r: d.close())
-                    except subprocess.CalledProcessError as e:
-                        error_dialog(self, f"{e}\n{e.stderr.decode()}", "Error", lambda d, r: d.close())
+                    # killing pkexec halfway would leave NVRAM partly written
+                    self.run_task(_("Writing changes to EFI NVRAM…"), execute_and_read, self.model.load,
+                                  self.on_write_error, cancellable=False)
                 dialog.close()
 
             yes_no_dialog(self, _("Are you sure you want to continue?"),
-                          _("Your changes are about to be written to EFI NVRAM.") + "\n" +
-                          _("The following commands will be run:") + "\n\n" + script,
+                          _("Your changes are about to be written to EFI NVRAM.") + "\n" + description,
                           on_response)
 
     @Gtk.Template.Callback()
@@ -574,14 +559,8 @@ class EfibootsMainWindow(Gtk.ApplicationWindow):
         else:
             def on_response(response_dialog, response):
                 if response == Gtk.ResponseType.YES:
-                    try:
-                        execute_script_as_root("reboot\n")
-                    except FileNotFoundError as e:
-                        error_dialog(self, _("The pkexec command from PolKit is "
-                                           "required to execute commands with elevated privileges.")
-                                           + f"\n{e}", _("pkexec not found"), lambda d, r: d.close())
-                    except subprocess.CalledProcessError as e:
-                        error_dialog(self, f"{e}\n{e.stderr.decode()}", "Error", lambda d, r: d.close())
+                    self.run_task(_("Rebooting…"), lambda cancel: execute_script_as_root("reboot\n"),
+                                  lambda _: None, self.on_write_error, cancellable=False)
                 response_dialog.close()
 
             yes_no_dialog(self, _("Are you sure you want to reboot?"),
@@ -600,11 +579,17 @@ class EfibootsMainWindow(Gtk.ApplicationWindow):
     def on_clicked_reset(self, _: Gtk.Button):
         def on_response(dialog, response):
             if response == Gtk.ResponseType.YES:
-                self.model.refresh()
+                self.refresh()
             dialog.close()
 
         if not self.discard_warning(on_response, self):
-            self.model.refresh()
+            self.refresh()
+
+    @Gtk.Template.Callback()
+    def on_clicked_cancel(self, button: Gtk.Button):
+        if self.task is not None and self.task.cancellable:
+            self.progress_label.set_label(_("Cancelling…"))
+            self.task.cancel()
 
     @Gtk.Template.Callback()
     def on_clicked_about(self, _: Gtk.Button):
@@ -613,7 +598,7 @@ class EfibootsMainWindow(Gtk.ApplicationWindow):
 
     @Gtk.Template.Callback()
     def on_value_changed_timeout(self, spin: Gtk.SpinButton):
-        self.model.timeout = spin.get_value_as_int()
+        self.model.state.timeout = spin.get_value_as_int()
 
     # @Gtk.Template.Callback()
     # def on_toggled_active(self, check: Gtk.CheckButton, checked_row: EfibootRowModel):
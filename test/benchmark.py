@@ -0,0 +1,234 @@
+"""
+Benchmarks for parsing, diffing and script generation with many boot entries.
+
+Synthetic `efibootmgr -v` / `efibootmgr --unicode` outputs and efivarfs trees are generated with
+the entry kinds found in myinput.test, including the long UTF-16 optional data blobs.
+
+    python3 test/benchmark.py [--sizes 10,100,1000,10000] [--output results.json] [--compare old.json]
+
+Results are written as JSON so that runs on different commits can be compared with --compare.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from functools import cmp_to_key
+from pathlib import Path
+
+from efiboots import export
+from efiboots.bootmodel import BootModel
+from efiboots.devicepath import encode_end, encode_file_path, encode_hard_drive, encode_node
+from efiboots.efibootmgr import EfibootmgrEfivarfs, EfibootmgrText, decode_dotted_bytes, decode_dotted_utf16
+from efiboots.efivarfs import DEFAULT_ATTRIBUTES, Efivarfs
+from efiboots.loadoption import LOAD_OPTION_ACTIVE, encode_load_option
+
+test_dir = Path(__file__).resolve().parent
+
+ESP_GUID = 'fda4f976-b250-4569-be80-0449804ab7c2'
+ESP_TEXT = f'HD(1,GPT,{ESP_GUID},0x800,0x40000)'
+ESP_NODE = encode_hard_drive(1, 0x800, 0x40000, uuid.UUID(ESP_GUID))
+WINDOWS_DATA = b'WINDOWS\x00\x01\x00\x00\x00\x88\x00\x00\x00x\x00\x00\x00' + \
+               'BCDOBJECT={9dea862c-5cdd-4e70-acc1-f32b344d4795}'.encode('utf-16-le') + b'\x00\x00o' + b'\x00' * 17
+LINUX_PARAMETERS = 'root=LABEL=root rw initrd=\\intel-ucode.img initrd=\\initramfs-linux.img ' \
+                   'zswap.enabled=0 nowatchdog loglevel=3 rd.udev.log_priority=3 quiet splash'
+
+
+def dotted(data: bytes) -> str:
+    """Optional data as printed by efibootmgr -v: printable ASCII and dots"""
+    return ''.join(chr(byte) if 0x20 <= byte < 0x7f else '.' for byte in data)
+
+
+def synthetic_entries(count: int) -> list[tuple[int, bool, str, bytes, str, bytes]]:
+    """:return: num, active, label, device path, its text form and optional data of count entries"""
+    entries = []
+    for num in range(count):
+        match num % 5:
+            case 0:
+                entries.append((num, True, f'SATA{num} : Samsung SSD 850 PRO 25',
+                                encode_node(0x05, 0x01, struct.pack('<HH', 17, 0) + b'\x00') + encode_end(),
+                                'BBS(17,,0x0)', b''))
+            case 1:
+                loader = f'\\EFI\\refind{num}\\refind_x64.efi'
+                entries.append((num, True, f'rEFInd Boot Manager {num}', ESP_NODE + encode_file_path(loader) +
+                                encode_end(), f'{ESP_TEXT}/File({loader})', b''))
+            case 2:
+                loader = '\\EFI\\Microsoft\\Boot\\bootmgfw.efi'
+                entries.append((num, True, f'Windows Boot Manager {num}', ESP_NODE + encode_file_path(loader) +
+                                encode_end(), f'{ESP_TEXT}/File({loader})', WINDOWS_DATA))
+            case 3:
+                loader = f'\\vmlinuz-linux{num}'
+                entries.append((num, num % 2 == 0, f'Linux {num}', ESP_NODE + encode_file_path(loader) + encode_end(),
+                                f'{ESP_TEXT}/File({loader})', (LINUX_PARAMETERS + '\x00').encode('utf-16-le')))
+            case 4:
+                guid = '5023b95c-db26-429b-a648-bd47664c8012'
+                entries.append((num, False, f'UEFI: Built-in EFI Shell {num}',
+                                encode_node(0x04, 0x03, uuid.UUID(guid).bytes_le) + encode_end(),
+                                f'VenMedia({guid})', b'AMBO'))
+    return entries
+
+
+def boot_order(count: int) -> list[int]:
+    order = list(range(count))
+    random.Random(count).shuffle(order)
+    return order
+
+
+def efibootmgr_output(count: int, unicode: bool) -> list[str]:
+    """:return: lines printed by efibootmgr -v or, if unicode, by efibootmgr --unicode"""
+    lines = ['BootCurrent: 0001', 'Timeout: 1 seconds', 'BootOrder: ' + ','.join(f'{num:04X}' for num in boot_order(count))]
+    for num, active, label, _, device_path, optional_data in synthetic_entries(count):
+        if unicode and optional_data.endswith(b'\x00\x00'):
+            parameters = optional_data.decode('utf-16-le', errors='replace').rstrip('\x00')
+        else:
+            parameters = dotted(optional_data)
+        lines.append(f'Boot{num:04X}{"*" if active else " "} {label}\t{device_path}{parameters}')
+    return lines
+
+
+def write_efivarfs(path: str, count: int):
+    def write(name: str, data: bytes):
+        with open(os.path.join(path, f'{name}-8be4df61-93ca-11d2-aa0d-00e098032b8c'), 'wb') as f:
+            f.write(struct.pack('<I', DEFAULT_ATTRIBUTES) + data)
+
+    write('BootCurrent', struct.pack('<H', 1))
+    write('Timeout', struct.pack('<H', 1))
+    order = boot_order(count)
+    write('BootOrder', struct.pack(f'<{len(order)}H', *order))
+    for num, active, label, device_path, _, optional_data in synthetic_entries(count):
+        write(f'Boot{num:04X}', encode_load_option(LOAD_OPTION_ACTIVE if active else 0, label, device_path,
+                                                   optional_data))
+
+
+def edit(model: BootModel):
+    """Typical edits: the order is reversed, a tenth of the entries toggled and one added"""
+    model.set_boot_order(model.boot_order[::-1])
+    for i, entry in enumerate(list(model.entries.values())):
+        if i % 10 == 0:
+            model.set_active(entry.num, not entry.active)
+    model.add('New entry', '\\EFI\\new\\grubx64.efi', 'quiet')
+
+
+def measure(func, repeat: int, budget: float) -> list[float]:
+    """Runs func up to repeat times, stopping early once budget seconds have been spent"""
+    timings = []
+    start = time.perf_counter()
+    while len(timings) < repeat and (not timings or time.perf_counter() - start < budget):
+        before = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - before)
+    return timings
+
+
+def run_benchmarks(sizes: list[int], repeat: int, budget: float) -> list[dict]:
+    results = []
+
+    def bench(name: str, count: int, func):
+        timings = measure(func, repeat, budget)
+        result = {'name': name, 'entries': count, 'runs': len(timings),
+                  'best': min(timings), 'mean': sum(timings) / len(timings)}
+        print(f"{name:<36} {count:>6} entries: best {result['best'] * 1000:10.3f} ms "
+              f"mean {result['mean'] * 1000:10.3f} ms ({len(timings)} runs)", file=sys.stderr)
+        results.append(result)
+
+    for count in sizes:
+        optional_data = [entry[5] for entry in synthetic_entries(count)]
+        printed = [dotted(data) for data in optional_data]
+        bench('decode_dotted_utf16', count, lambda: [decode_dotted_utf16(code) for code in printed])
+        bench('decode_dotted_bytes', count, lambda: [decode_dotted_bytes(data) for data in optional_data])
+
+        dotted_lines = efibootmgr_output(count, unicode=False)
+        unicode_lines = efibootmgr_output(count, unicode=True)
+        bench('EfibootmgrText.parse dotted', count, lambda: EfibootmgrText.parse(dotted_lines))
+        bench('EfibootmgrText.parse_line dotted', count,
+              lambda: [EfibootmgrText.parse_line(line) for line in dotted_lines])
+        bench('EfibootmgrText.parse unicode', count, lambda: EfibootmgrText.parse(unicode_lines))
+        bench('EfibootmgrText.parse_line unicode', count,
+              lambda: [EfibootmgrText.parse_line(line) for line in unicode_lines])
+
+        efivars_dir = tempfile.mkdtemp()
+        try:
+            write_efivarfs(efivars_dir, count)
+            efibootmgr = EfibootmgrEfivarfs(Efivarfs(efivars_dir))
+            bench('EfibootmgrEfivarfs.run', count, efibootmgr.run)
+            variables = efibootmgr.run()
+            bench('EfibootmgrEfivarfs.parse', count, lambda: EfibootmgrEfivarfs.parse(variables))
+            parsed = efibootmgr.parse(variables)
+        finally:
+            shutil.rmtree(efivars_dir)
+
+        json_export, binary_export = export.dump_json(parsed), export.dump_binary(parsed)
+        bench('export.dump_json', count, lambda: export.dump_json(parsed))
+        bench('export.load_json', count, lambda: export.load_json(json_export))
+        bench('export.dump_binary', count, lambda: export.dump_binary(parsed))
+        bench('export.load_binary', count, lambda: export.load_binary(binary_export))
+
+        model = BootModel()
+        bench('BootModel.load', count, lambda: model.load(parsed))
+        model.load(parsed)
+        bench('BootModel.sort', count, lambda: sorted(model.entries, key=cmp_to_key(model.compare_boot_order)))
+        bench('BootModel.ordered_entries', count, model.ordered_entries)
+        bench('BootModel.move', count, lambda: [model.move(num, -1) for num in parsed.boot_order[:100]])
+        edit(model)
+        bench('BootModel.changes', count, model.changes)
+        bench('BootModel.to_script', count, lambda: model.to_script('/dev/sda', '1', False))
+    return results
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=test_dir, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list[dict], baseline: dict):
+    old = {(result['name'], result['entries']): result['best'] for result in baseline['results']}
+    print(f"compared with {baseline.get('revision')}:", file=sys.stderr)
+    for result in results:
+        key = (result['name'], result['entries'])
+        if key in old:
+            print(f"{result['name']:<36} {result['entries']:>6} entries: {old[key] / result['best']:8.2f}x",
+                  file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10,100,1000,10000', help="comma separated numbers of entries")
+    parser.add_argument('--repeat', type=int, default=20, help="maximum runs of each benchmark")
+    parser.add_argument('--budget', type=float, default=2.0, help="seconds after which a benchmark stops repeating")
+    parser.add_argument('--output', '-o', help="JSON file to write the results to, stdout by default")
+    parser.add_argument('--compare', help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+    # the Windows blobs are not UTF-16 and every one of them would log a warning
+    logging.disable(logging.WARNING)
+
+    results = run_benchmarks([int(size) for size in args.sizes.split(',')], args.repeat, args.budget)
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,39 @@
+import copy
 import unittest
 import logging
+import shlex
+import shutil
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+import os
+from unittest import mock
 
 from pathlib import Path
 
-import efiboots
+from efiboots.efibootmgr import EfibootmgrEfivarfs, EfibootmgrText, OperationCancelled, ParsedEfibootmgr, \
+    ParsedEfibootmgrEntry, decode_dotted_bytes, decode_dotted_utf16, subprocess_lines, \
+    subprocess_run_wrapper
+from efiboots.efivarfs import Efivarfs, check_write
+from efiboots import cache, devicepath, esp, export, fat, fleet, partitions
+from efiboots.bootmodel import BootModel
+from efiboots.desiredstate import DesiredState
+from efiboots.loadoption import decode_optional_data, parse_load_option, set_load_option_active
+from efiboots.nvram import EfivarfsEditor, NvramPlan, VariableWrite, diff_boot_states, efibootmgr_script, \
+    encode_boot_num, encode_boot_order, encode_timeout, plan_writes
+from efiboots.snapshot import Snapshot, SnapshotStore, SnapshotVariable
+from efiboots.archive import SnapshotArchive, blob_hash
+from efiboots.profiling import Profiler, profiler
+from efiboots.transaction import Transaction, TransactionError
+try:
+    from gi.repository import Gio, GLib
+    from efiboots import helper, liststore
+except (ImportError, ValueError):
+    # PyGObject and GTK 4 are only needed by the GUI and the D-Bus helper
+    helper = liststore = None
+from efiboots.integrity import DUPLICATE, MISSING, UNREACHABLE, UNREADABLE, IntegrityChecker
 
 logging.basicConfig(level=0)
 test_dir = Path(__file__).resolve().parent
@@ -11,51 +41,1215 @@ test_dir = Path(__file__).resolve().parent
 
 class TestDeviceToDiskPart(unittest.TestCase):
     def test_device_to_disk_part(self):
-        self.assertTupleEqual(efiboots.device_to_disk_part('/dev/sda1'), ('/dev/sda', '1'))
-        self.assertTupleEqual(efiboots.device_to_disk_part('/dev/sdc13'), ('/dev/sdc', '13'))
-        self.assertTupleEqual(efiboots.device_to_disk_part('/dev/sdp3'), ('/dev/sdp', '3'))
-        self.assertTupleEqual(efiboots.device_to_disk_part('/dev/sdp10'), ('/dev/sdp', '10'))
-        self.assertTupleEqual(efiboots.device_to_disk_part('/dev/mmcblk1p2'), ('/dev/mmcblk1', '2'))
-        self.assertTupleEqual(efiboots.device_to_disk_part('/dev/nvme0n1p1'), ('/dev/nvme0n1', '1'))
+        self.assertTupleEqual(esp.device_to_disk_part('/dev/sda1'), ('/dev/sda', '1'))
+        self.assertTupleEqual(esp.device_to_disk_part('/dev/sdc13'), ('/dev/sdc', '13'))
+        self.assertTupleEqual(esp.device_to_disk_part('/dev/sdp3'), ('/dev/sdp', '3'))
+        self.assertTupleEqual(esp.device_to_disk_part('/dev/sdp10'), ('/dev/sdp', '10'))
+        self.assertTupleEqual(esp.device_to_disk_part('/dev/mmcblk1p2'), ('/dev/mmcblk1', '2'))
+        self.assertTupleEqual(esp.device_to_disk_part('/dev/nvme0n1p1'), ('/dev/nvme0n1', '1'))
 
 
 class TestEfibootmgrDecode(unittest.TestCase):
     def test_decode(self):
-        decoded = efiboots.try_decode_efibootmgr('B.C.D.O.B.J.E.C.T.=.{.9.d.e.a.8.6.2.c.-.5.c.d.d.-.4.e.7.0.-.a.c.c.1.-.f.3.2.b.3.4.4.d.4.7.9.5.}.')
+        decoded = decode_dotted_utf16('B.C.D.O.B.J.E.C.T.=.{.9.d.e.a.8.6.2.c.-.5.c.d.d.-.4.e.7.0.-.a.c.c.1.-.f.3.2.b.3.4.4.d.4.7.9.5.}.')
         expected = 'BCDOBJECT={9dea862c-5cdd-4e70-acc1-f32b344d4795}'
         self.assertEqual(decoded, expected)
 
+    def test_decode_odd_length(self):
+        # UTF-16 is made of pairs of bytes, dots in odd-sized text are plain dots
+        self.assertEqual(decode_dotted_utf16('x.y'), 'x.y')
+        self.assertEqual(decode_dotted_utf16('a.b.c'), 'a.b.c')
+        self.assertEqual(decode_dotted_utf16('q.u.i.e.t'), 'q.u.i.e.t')
+        self.assertEqual(decode_dotted_utf16('q.u.i.e.t.'), 'quiet')
+        self.assertEqual(decode_dotted_utf16('A.B.\u00e9.C'), 'A.B.\u00e9.C')
+        self.assertEqual(decode_dotted_utf16('..\u4e2d.x'), '..\u4e2d.x')
+
+    def test_decode_windows(self):
+        data = (b'WINDOWS\x00\x01\x00\x00\x00\x88\x00\x00\x00x\x00\x00\x00' +
+                'BCDOBJECT={9dea862c-5cdd-4e70-acc1-f32b344d4795}'.encode('utf-16-le') + b'\x00\x00o' + b'\x00' * 17)
+        expected = 'WINDOWS.........x...BCDOBJECT={9dea862c-5cdd-4e70-acc1-f32b344d4795}.o' + '.' * 8
+        self.assertEqual(decode_dotted_bytes(data), expected)
+        self.assertEqual(decode_dotted_utf16(decode_optional_data(data)), expected)
+
 
 class TestParser(unittest.TestCase):
     def test_efibootmgr_entries_parsing(self):
-        key, value = efiboots.parse_efibootmgr_line('Boot0000* SATA1 : Samsung SSD 850 PRO 25\tBBS(17,,0x0)')
+        key, value = EfibootmgrText.parse_line('Boot0000* SATA1 : Samsung SSD 850 PRO 25\tBBS(17,,0x0)')
         self.assertEqual(key, 'entry')
-        self.assertDictEqual(value, {'num': '0000', 'active': True,
-                                     'name': 'SATA1 : Samsung SSD 850 PRO 25',
-                                     'path': '', 'parameters': ''})
-        key, value = efiboots.parse_efibootmgr_line('Boot0001* rEFInd Boot Manager\tHD(1,GPT,fda4f976-b250-4569-be80-0449804ab7c2,0x800,0x40000)/File(\EFI\refind\refind_x64.efi)')
+        self.assertEqual(value, ParsedEfibootmgrEntry(num='0000', active=True,
+                                                      name='SATA1 : Samsung SSD 850 PRO 25',
+                                                      path='', parameters=''))
+        key, value = EfibootmgrText.parse_line('Boot0001* rEFInd Boot Manager\tHD(1,GPT,fda4f976-b250-4569-be80-0449804ab7c2,0x800,0x40000)/File(\\EFI\refind\refind_x64.efi)')
         self.assertEqual(key, 'entry')
-        self.assertDictEqual(value, {'num': '0001', 'active': True,
-                                     'name': 'rEFInd Boot Manager',
-                                     'path': '\\EFI\refind\refind_x64.efi',
-                                     'parameters': ''})
-        key, value = efiboots.parse_efibootmgr_line('Boot0004  linux-surface (reboot=pci)	HD(1,GPT,8b824cbb-3248-4aeb-8ca0-3073b5a41bc4,0x800,0x82000)/File(\\vmlinuz-linux-surface)r.o.o.t.=.L.A.B.E.L.=.r.o.o.t. .i.n.i.t.r.d.=.i.n.t.e.l.-.u.c.o.d.e...i.m.g. .i.n.i.t.r.d.=.i.n.i.t.r.a.m.f.s.-.l.i.n.u.x.-.s.u.r.f.a.c.e...i.m.g. .z.s.w.a.p...e.n.a.b.l.e.d.=.0. .r.e.b.o.o.t.=.p.c.i.')
+        self.assertEqual(value, ParsedEfibootmgrEntry(num='0001', active=True,
+                                                      name='rEFInd Boot Manager',
+                                                      path='\\EFI\refind\refind_x64.efi',
+                                                      parameters=''))
+        key, value = EfibootmgrText.parse_line('Boot0004  linux-surface (reboot=pci)	HD(1,GPT,8b824cbb-3248-4aeb-8ca0-3073b5a41bc4,0x800,0x82000)/File(\\vmlinuz-linux-surface)r.o.o.t.=.L.A.B.E.L.=.r.o.o.t. .i.n.i.t.r.d.=.i.n.t.e.l.-.u.c.o.d.e...i.m.g. .i.n.i.t.r.d.=.i.n.i.t.r.a.m.f.s.-.l.i.n.u.x.-.s.u.r.f.a.c.e...i.m.g. .z.s.w.a.p...e.n.a.b.l.e.d.=.0. .r.e.b.o.o.t.=.p.c.i.')
         self.assertEqual(key, 'entry')
-        self.assertDictEqual(value, {'num': '0004', 'active': False, 'name': ' linux-surface (reboot=pci)',
-                                    'path': '\\vmlinuz-linux-surface',
-                                    'parameters': 'root=LABEL=root initrd=intel-ucode.img initrd=initramfs-linux-surface.img zswap.enabled=0 reboot=pci'})
+        self.assertEqual(value, ParsedEfibootmgrEntry(num='0004', active=False, name=' linux-surface (reboot=pci)',
+                                                      path='\\vmlinuz-linux-surface',
+                                                      parameters='root=LABEL=root initrd=intel-ucode.img initrd=initramfs-linux-surface.img zswap.enabled=0 reboot=pci'))
 
     def test_efibootmgr_bootcurrent_parsing(self):
-        key, value = efiboots.parse_efibootmgr_line('BootCurrent: 0001')
+        key, value = EfibootmgrText.parse_line('BootCurrent: 0001')
         self.assertEqual(key, 'boot_current')
         self.assertEqual(value, '0001')
 
     def test_efibootmgr_timeout_parsing(self):
-        key, value = efiboots.parse_efibootmgr_line('Timeout: 1 seconds')
+        key, value = EfibootmgrText.parse_line('Timeout: 1 seconds')
         self.assertEqual(key, 'timeout')
         self.assertEqual(value, 1)
 
     def test_efibootmgr_bootorder_parsing(self):
-        key, value = efiboots.parse_efibootmgr_line('BootOrder: 0001,0003,0005,0000,0002,0004')
+        key, value = EfibootmgrText.parse_line('BootOrder: 0001,0003,0005,0000,0002,0004')
         self.assertEqual(key, 'boot_order')
         self.assertListEqual(value, ['0001', '0003', '0005', '0000', '0002', '0004'])
+
+    def test_extra_lines(self):
+        lines = (test_dir / 'myinput.test').read_text().splitlines()
+        expected = EfibootmgrText.parse(lines)
+        extra = ['MirroredPercentageAbove4G: 0.00', 'MirrorMemoryBelow4GB: false', '', 'BootNext: 0003']
+        parsed = EfibootmgrText.parse(line for line in lines[:3] + extra + lines[3:])
+        self.assertEqual(parsed.boot_next, '0003')
+        self.assertListEqual(parsed.entries, expected.entries)
+        with self.assertRaises(ValueError):
+            EfibootmgrText.parse_line('MirrorMemoryBelow4GB: false')
+
+    def test_format_detection(self):
+        path = 'HD(1,GPT,8b824cbb-3248-4aeb-8ca0-3073b5a41bc4,0x800,0x82000)/File(\\vmlinuz-linux)'
+        parameters = 'root=LABEL=root initrd=\\intel-ucode.img quiet'
+        dotted = ''.join(char + '.' for char in parameters)
+        # the format is only known from the second entry, the first one is decoded once it is
+        lines = ['BootOrder: 0000,0001', 'Boot0000* Shell\tVenMedia(5023b95c-db26-429b-a648-bd47664c8012)AMBO.a.b',
+                 f'Boot0001* Linux\t{path}{{}}', '      dp: 04 01 2a 00 01 00 00 00', '      data: 72 00 6f 00']
+        v17 = EfibootmgrText.parse(line.format(dotted) for line in lines)
+        v19 = EfibootmgrText.parse(line.format(parameters) for line in lines)
+        self.assertEqual(v17.entries[1].parameters, parameters)
+        self.assertEqual(v19.entries[1].parameters, parameters)
+        self.assertEqual(v19.entries[0].parameters, 'AMBO.a.b')
+        self.assertEqual(v17.entries[0].parameters, decode_dotted_utf16('AMBO.a.b'))
+        self.assertListEqual(v19.boot_order, ['0000', '0001'])
+
+    def test_format_not_detected(self):
+        # efibootmgr --unicode output where no entry has key=value parameters
+        lines = ['BootOrder: 0000,0001',
+                 'Boot0000* Fedora\tHD(1,GPT,8b824cbb-3248-4aeb-8ca0-3073b5a41bc4,0x800,0x82000)'
+                 '/File(\\EFI\\fedora\\shimx64.efi)\\EFI\\fedora\\grubx64.efi',
+                 'Boot0001* Shell\tVenMedia(5023b95c-db26-429b-a648-bd47664c8012)AMBO.a.b']
+        parsed = EfibootmgrText.parse(lines)
+        self.assertEqual(parsed.entries[0].parameters, '\\EFI\\fedora\\grubx64.efi')
+        self.assertEqual(parsed.entries[1].parameters, 'AMBO.a.b')
+        self.assertEqual(EfibootmgrText.parse_line(lines[1])[1].parameters, '\\EFI\\fedora\\grubx64.efi')
+
+
+    def test_subprocess_lines(self):
+        # more warnings than a pipe can hold while the output is still being read
+        script = "import sys; sys.stderr.write('w' * 1000000); print('BootCurrent: 0001'); sys.exit(3)"
+        lines = subprocess_lines([sys.executable, '-c', script])
+        self.assertEqual(next(lines), 'BootCurrent: 0001')
+        with self.assertRaises(subprocess.CalledProcessError) as raised:
+            next(lines)
+        self.assertEqual((raised.exception.returncode, len(raised.exception.stderr)), (3, 1000000))
+
+
+class TestEfivarfs(unittest.TestCase):
+    def setUp(self):
+        self.efibootmgr = EfibootmgrEfivarfs(Efivarfs(str(test_dir / 'efivars')))
+
+    def test_list_boot_entries(self):
+        self.assertListEqual(self.efibootmgr.efivarfs.list_boot_entries(),
+                             ['Boot0000', 'Boot0001', 'Boot0002', 'Boot0003', 'Boot0004', 'Boot0005', 'Boot0007'])
+
+    def test_efivarfs_matches_efibootmgr(self):
+        parsed = self.efibootmgr.parse(self.efibootmgr.run())
+        expected = EfibootmgrText.parse((test_dir / 'myinput.test').read_text().strip().split('\n'))
+        self.assertListEqual(parsed.boot_order, expected.boot_order)
+        self.assertEqual(parsed.boot_current, expected.boot_current)
+        self.assertEqual(parsed.boot_next, expected.boot_next)
+        self.assertEqual(parsed.timeout, expected.timeout)
+        self.assertEqual(len(parsed.entries), len(expected.entries))
+        for entry, expected_entry in zip(parsed.entries, expected.entries):
+            self.assertEqual(entry.num, expected_entry.num)
+            self.assertEqual(entry.active, expected_entry.active)
+            # efibootmgr separates the name of inactive entries with two spaces
+            self.assertEqual(entry.name, expected_entry.name.lstrip(' '))
+            self.assertEqual(entry.path, expected_entry.path)
+            # the captured dump has a raw DEL byte in the tail of the Windows BCD blob
+            self.assertEqual(entry.parameters.rstrip('.\x7f'), expected_entry.parameters.rstrip('.\x7f'))
+
+
+    def test_malformed_variables(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        shutil.copytree(test_dir / 'efivars', tmp, dirs_exist_ok=True)
+        efivarfs = Efivarfs(tmp)
+        expected = self.efibootmgr.parse(self.efibootmgr.run())
+        Path(efivarfs.variable_path('BootOrder')).write_bytes(b'\x07\x00\x00\x00\x01\x00\x07')
+        Path(efivarfs.variable_path('Timeout')).write_bytes(b'\x07\x00')
+        with self.assertRaises(ValueError):
+            efivarfs.read('Timeout')
+        with self.assertRaises(ValueError):
+            EfivarfsEditor(efivarfs).boot_order()
+        # both are skipped, the entries are still read
+        efibootmgr = EfibootmgrEfivarfs(efivarfs)
+        parsed = efibootmgr.parse(efibootmgr.run())
+        self.assertListEqual(parsed.boot_order, [])
+        self.assertIsNone(parsed.timeout)
+        self.assertListEqual(parsed.entries, expected.entries)
+        self.assertIsNone(EfibootmgrEfivarfs.patch(expected, efibootmgr.read_variables({'Timeout'})).timeout)
+
+
+def device_path_node(node_type: int, subtype: int, payload: bytes) -> bytes:
+    return struct.pack('<BBH', node_type, subtype, len(payload) + 4) + payload
+
+
+class TestDevicePath(unittest.TestCase):
+    def test_nvme_disk(self):
+        data = (device_path_node(2, 1, struct.pack('<II', 0x0a0341d0, 0)) +
+                device_path_node(1, 1, struct.pack('<BB', 0, 0x1d)) +
+                device_path_node(3, 0x17, struct.pack('<I8s', 1, bytes(range(8)))) +
+                device_path_node(4, 1, struct.pack('<IQQ16sBB', 1, 0x800, 0x100000,
+                                                   bytes.fromhex('76f9a4fd50b26945be800449804ab7c2'), 2, 2)) +
+                device_path_node(4, 4, '\\EFI\\BOOT\\BOOTX64.EFI\0'.encode('utf-16-le')) +
+                device_path_node(0x7f, 0xff, b''))
+        nodes = devicepath.parse_device_path(data)
+        self.assertListEqual([type(node) for node in nodes],
+                             [devicepath.Acpi, devicepath.Pci, devicepath.Nvme, devicepath.HardDrive,
+                              devicepath.FilePath, devicepath.End])
+        self.assertEqual(str(nodes[3].partition_guid), 'fda4f976-b250-4569-be80-0449804ab7c2')
+        self.assertEqual(devicepath.format_device_path(nodes),
+                         'PciRoot(0x0)/Pci(0x1d,0x0)/NVMe(0x1,07-06-05-04-03-02-01-00)/'
+                         'HD(1,GPT,fda4f976-b250-4569-be80-0449804ab7c2,0x800,0x100000)/File(\\EFI\\BOOT\\BOOTX64.EFI)')
+
+    def test_network_instances(self):
+        mac = device_path_node(3, 0x0b, bytes.fromhex('525400123456') + bytes(26) + b'\x01')
+        ipv4 = device_path_node(3, 0x0c, bytes(4) + bytes(4) + struct.pack('<HHHB', 0, 0, 6, 0) + bytes(8))
+        ipv6 = device_path_node(3, 0x0d, bytes(32) + struct.pack('<HHHBB', 0, 0, 6, 0, 64) + bytes(16))
+        uri = device_path_node(3, 0x18, b'http://boot.example/ipxe.efi')
+        data = (mac + ipv4 + uri + device_path_node(0x7f, 0x01, b'') +
+                mac + ipv6 + uri + device_path_node(0x7f, 0xff, b''))
+        nodes = devicepath.parse_device_path(data)
+        self.assertFalse(nodes[3].entire)
+        self.assertTrue(nodes[-1].entire)
+        instances = devicepath.split_instances(nodes)
+        self.assertEqual(len(instances), 2)
+        self.assertEqual(instances[0][1].protocol, 6)
+        self.assertEqual(instances[1][1].prefix_length, 64)
+        self.assertEqual(instances[1][2].uri, 'http://boot.example/ipxe.efi')
+        self.assertEqual(str(instances[0][0]), 'MAC(525400123456,0x1)')
+
+    def test_load_option(self):
+        data = (test_dir / 'efivars' / 'Boot0003-8be4df61-93ca-11d2-aa0d-00e098032b8c').read_bytes()[4:]
+        load_option = parse_load_option(data)
+        self.assertTrue(load_option.active)
+        self.assertEqual(load_option.description, 'Windows Boot Manager')
+        self.assertEqual(load_option.file_path, '\\EFI\\Microsoft\\Boot\\bootmgfw.efi')
+        self.assertTrue(bytes(load_option.optional_data).startswith(b'WINDOWS\x00'))
+
+
+class EfivarsTestCase(unittest.TestCase):
+    """Reads a writable copy of the efivars fixture"""
+    def setUp(self):
+        self.efivars_dir = tempfile.mkdtemp()
+        shutil.copytree(test_dir / 'efivars', self.efivars_dir, dirs_exist_ok=True)
+        self.efibootmgr = EfibootmgrEfivarfs(Efivarfs(self.efivars_dir))
+        self.parsed = self.efibootmgr.parse(self.efibootmgr.run())
+
+    def tearDown(self):
+        shutil.rmtree(self.efivars_dir)
+
+    def desired(self, active=None, remove=(), **changes) -> ParsedEfibootmgr:
+        desired = copy.deepcopy(self.parsed)
+        desired.entries = [entry for entry in desired.entries if entry.num not in remove]
+        for entry in desired.entries:
+            entry.active = (active or {}).get(entry.num, entry.active)
+        desired.boot_order = [num for num in desired.boot_order if num not in remove]
+        for key, value in changes.items():
+            setattr(desired, key, value)
+        return desired
+
+    def plan(self, **changes) -> NvramPlan:
+        return plan_writes(self.parsed, diff_boot_states(self.parsed, self.desired(**changes)), '/dev/sda', '1')
+
+
+class TestNvramWrites(EfivarsTestCase):
+    def test_no_changes(self):
+        self.assertFalse(diff_boot_states(self.parsed, self.desired()))
+        self.assertFalse(self.plan(active={'0004': False, '0001': True}))
+
+    def test_write_order(self):
+        plan = self.plan(boot_order=['0007', '0001', '0003', '0005', '0000', '0004'],
+                         timeout=5, active={'0004': True}, remove={'0002'})
+        self.assertListEqual([write.name for write in plan.writes], ['Boot0004', 'BootOrder', 'Timeout', 'Boot0002'])
+        self.assertEqual(plan.writes[1].data, encode_boot_order(['0007', '0001', '0003', '0005', '0000', '0004']))
+        self.assertIsNone(plan.writes[-1].data)
+        self.assertEqual(plan.bytes_written, len(plan.writes[0].data) + 12 + 2)
+
+    def test_apply(self):
+        plan = self.plan(boot_next='0003', active={'0001': False}, remove={'0005'})
+        self.efibootmgr.efivarfs.apply([(write.name, write.data) for write in plan.writes])
+        parsed = self.efibootmgr.parse(self.efibootmgr.run())
+        self.assertEqual(parsed.boot_next, '0003')
+        self.assertListEqual(parsed.boot_order, ['0001', '0007', '0003', '0000', '0002', '0004'])
+        self.assertNotIn('0005', [entry.num for entry in parsed.entries])
+        self.assertFalse(next(entry for entry in parsed.entries if entry.num == '0001').active)
+        # once applied, the same changes don't need any further write
+        self.parsed = parsed
+        self.assertFalse(self.plan(boot_next='0003', active={'0001': False}))
+
+    def test_delete_boot_next(self):
+        self.parsed.boot_next = '0002'
+        changes = diff_boot_states(self.parsed, self.desired(remove={'0002'}))
+        self.assertTrue(changes.delete_boot_next)
+        self.assertListEqual(changes.delete, ['0002'])
+
+    def test_create(self):
+        desired = self.desired()
+        desired.entries.append(ParsedEfibootmgrEntry(num='NEW0', active=False, name='Linux', path='\\vmlinuz',
+                                                     parameters='quiet'))
+        changes = diff_boot_states(self.parsed, desired)
+        self.assertEqual(changes.create[0].num, '0006')
+        self.assertListEqual(changes.boot_order, self.parsed.boot_order + ['0006'])
+        script = efibootmgr_script(changes, '/dev/sda', '1', False)
+        self.assertListEqual(script.splitlines(), [
+            "efibootmgr --disk /dev/sda --part 1 --create --bootnum 0006 --label Linux --loader '\\vmlinuz' "
+            "--unicode quiet",
+            "efibootmgr --disk /dev/sda --part 1 --bootnum 0006 --inactive",
+            "efibootmgr --disk /dev/sda --part 1 --bootorder 0001,0007,0003,0005,0000,0002,0004,0006",
+        ])
+
+        # labels and parameters with quotes stay single arguments
+        changes.create[0].name = "a'; touch pwned #"
+        changes.create[0].parameters = "root='/dev/sda2' quiet"
+        command = efibootmgr_script(changes, '/dev/sda', '1', False).splitlines()[0]
+        self.assertListEqual(shlex.split(command)[8:], ['--label', "a'; touch pwned #", '--loader', '\\vmlinuz',
+                                                        '--unicode', "root='/dev/sda2' quiet"])
+
+
+class TestEfivarfsEditor(EfivarsTestCase):
+    def test_editor(self):
+        efivarfs = self.efibootmgr.efivarfs
+        editor = EfivarfsEditor(efivarfs)
+
+        def apply(plan: NvramPlan):
+            for write in plan.writes:
+                check_write(write.name, [write.attributes])
+            efivarfs.apply([(write.name, write.data, write.attributes) for write in plan.writes])
+            return self.efibootmgr.parse(self.efibootmgr.run())
+
+        boot0001, _ = efivarfs.read('Boot0001')
+        device_path = b''.join(devicepath.encode_node(node.type, node.subtype, bytes(node.data))
+                               for node in parse_load_option(boot0001).device_path)
+        num, plan = editor.create_entry('Copy', device_path, b'')
+        self.assertEqual(num, '0006')
+        parsed = apply(plan)
+        self.assertListEqual(parsed.boot_order, ['0006', '0001', '0007', '0003', '0005', '0000', '0002', '0004'])
+        self.assertEqual(parsed.entries[6].path, parsed.entries[1].path)
+
+        parsed = apply(editor.set_active('0006', False))
+        self.assertFalse(parsed.entries[6].active)
+        parsed = apply(editor.delete_entry('0006'))
+        self.assertEqual(parsed.boot_order, self.parsed.boot_order)
+        self.assertEqual(len(parsed.entries), len(self.parsed.entries))
+        self.assertEqual(apply(editor.set_boot_next('0003')).boot_next, '0003')
+        self.assertIsNone(apply(editor.set_boot_next(None)).boot_next)
+        self.assertEqual(apply(editor.set_timeout(3)).timeout, 3)
+        self.assertListEqual(apply(editor.set_boot_order(['0003', '0001'])).boot_order, ['0003', '0001'])
+
+        for edit in (lambda: editor.set_active('0006', True), lambda: editor.set_boot_next('0009'),
+                     lambda: editor.create_entry('Broken', b'\x04\x01', b'')):
+            with self.assertRaises(ValueError):
+                edit()
+        for name, attributes in (('Lang', []), ('Boot0001', [0x40]), ('BootCurrent', [])):
+            with self.assertRaises(ValueError):
+                check_write(name, attributes)
+
+
+class TestDesiredState(EfivarsTestCase):
+    def test_apply_to(self):
+        state = DesiredState.from_dict({
+            'create': [{'label': 'Arch Linux', 'loader': '/vmlinuz-linux', 'parameters': 'rw'},
+                       {'label': 'Manjaro', 'loader': '\\efi\\manjaro\\grubx64.efi', 'active': False}],
+            'delete': ['UEFI OS'],
+            'boot_order': ['Arch Linux', 'Windows Boot Manager', '0001'],
+            'boot_next': '0003',
+            'timeout': 3,
+        })
+        changes = diff_boot_states(self.parsed, state.apply_to(self.parsed))
+        self.assertListEqual([entry.name for entry in changes.create], ['Arch Linux'])
+        self.assertListEqual(changes.deactivate, ['0007'])
+        self.assertListEqual(changes.delete, ['0005'])
+        # Manjaro already exists and is not placed by boot_order
+        self.assertListEqual(changes.boot_order, ['0006', '0003', '0001', '0007'])
+        self.assertEqual(changes.boot_next, '0003')
+        self.assertEqual(changes.timeout, 3)
+
+        # applying the state again, once Arch Linux has been created as 0006, changes nothing
+        applied = state.apply_to(self.parsed)
+        for entry in applied.entries:
+            entry.num = '0006' if entry.num == 'NEW0' else entry.num
+        applied.boot_order = changes.boot_order
+        state.delete = []
+        self.assertFalse(diff_boot_states(applied, state.apply_to(applied)))
+        state = DesiredState.from_dict({'create': [{'label': 'Arch Linux', 'loader': '/vmlinuz-linux'}],
+                                        'boot_order': ['0003', '0001']})
+        self.assertListEqual(diff_boot_states(self.parsed, state.apply_to(self.parsed)).boot_order,
+                             ['0003', '0001', '0006'])
+        applied = state.apply_to(self.parsed)
+        applied.entries[-1].num = '0006'
+        applied.boot_order = ['0003', '0001', '0006']
+        self.assertFalse(diff_boot_states(applied, state.apply_to(applied)))
+
+        self.assertFalse(diff_boot_states(self.parsed, DesiredState.from_parsed(self.parsed).apply_to(self.parsed)))
+        with self.assertRaises(ValueError):
+            DesiredState.from_dict({'boot_order': ['Nonexistent']}).apply_to(self.parsed)
+        with self.assertRaises(ValueError):
+            DesiredState.from_dict({'bootorder': []})
+
+
+class TestBootModel(EfivarsTestCase):
+    def test_pending_changes(self):
+        model = BootModel()
+        model.load(self.parsed)
+        self.assertFalse(model.pending_changes())
+        entry = model.add('Linux', '\\vmlinuz', '')
+        model.set_active('0004', True)
+        model.swap(0, 1)
+        self.assertTrue(model.pending_changes())
+        model.remove(entry.num)
+        model.set_active('0004', False)
+        model.swap(0, 1)
+        self.assertFalse(model.pending_changes())
+        # the snapshot is never modified by edits
+        self.assertFalse(next(entry for entry in self.parsed.entries if entry.num == '0004').active)
+
+    def test_positions(self):
+        model = BootModel()
+        model.load(self.parsed)
+        self.assertEqual(model.move('0007', -1), 0)
+        self.assertEqual(model.move('0007', -1), 0)
+        self.assertEqual(model.move('0004', 1), 6)
+        entry = model.add('Linux', '\\vmlinuz', '')
+        model.remove('0003')
+        self.assertListEqual([entry.num for entry in model.ordered_entries()],
+                             ['0007', '0001', '0005', '0000', '0002', '0004', entry.num])
+        self.assertDictEqual(model.positions, {num: i for i, num in enumerate(model.boot_order)})
+
+    def test_merge_external_changes(self):
+        model = BootModel()
+        model.load(self.parsed)
+        model.set_active('0004', True)
+        model.remove('0002')
+        stats = self.efibootmgr.efivarfs.stat_boot_variables()
+
+        # another program changes the timeout, deletes two entries and reorders the others
+        plan = self.plan(timeout=9, remove={'0000', '0004'}, boot_order=['0007', '0001', '0003', '0005', '0002'])
+        self.efibootmgr.efivarfs.apply([(write.name, write.data) for write in plan.writes])
+        new_stats = self.efibootmgr.efivarfs.stat_boot_variables()
+        changed = {name for name in stats.keys() | new_stats.keys() if stats.get(name) != new_stats.get(name)}
+        self.assertTrue({'Timeout', 'Boot0000', 'Boot0004', 'BootOrder'} <= changed)
+        self.assertEqual(Efivarfs.boot_variable_name('Lang-8be4df61-93ca-11d2-aa0d-00e098032b8c'), None)
+
+        remote = EfibootmgrEfivarfs.patch(self.parsed, self.efibootmgr.read_variables(changed))
+        self.assertEqual(remote, self.efibootmgr.parse(self.efibootmgr.run()))
+        result = model.merge(remote)
+        self.assertListEqual(result.removed, ['0000', '0004'])
+        self.assertListEqual(result.conflicts, ['Boot0004 has been deleted'])
+        self.assertTrue(result.order_changed and result.timeout_changed)
+        self.assertListEqual(model.boot_order, ['0007', '0001', '0003', '0005'])
+        # the pending deletion of Boot0002 is all that's left to write
+        changes = model.changes()
+        self.assertListEqual(changes.delete, ['0002'])
+        self.assertListEqual(changes.boot_order, ['0007', '0001', '0003', '0005'])
+        self.assertIsNone(changes.timeout)
+
+    def test_merge_boot_order(self):
+        remote = copy.deepcopy(self.parsed)
+        remote.boot_order = ['0007', '0001', '0003', '0005', '0000', '0002', '0004']
+        model = BootModel()
+        model.load(self.parsed)
+        # moving an entry and back is no edit
+        model.move('0003', 1)
+        model.move('0003', -1)
+        result = model.merge(remote)
+        self.assertFalse(result.conflicts)
+        self.assertTrue(result.order_changed)
+        self.assertListEqual(model.boot_order, remote.boot_order)
+
+        model.load(self.parsed)
+        model.move('0003', 1)
+        self.assertListEqual(model.merge(remote).conflicts, ["BootOrder has been changed"])
+        self.assertListEqual(model.boot_order, ['0001', '0007', '0005', '0003', '0000', '0002', '0004'])
+
+
+class TestCommandLine(unittest.TestCase):
+    def test_global_options(self):
+        from efiboots import cli
+        parser = cli.build_parser()
+        for args in (['--profile', 'show'], ['show', '--profile'], ['-vv', 'snapshot', 'list', '--profile'],
+                     ['--profile-output', 'out.json', 'check', '--profile']):
+            self.assertTrue(cli.is_cli(args))
+            self.assertTrue(parser.parse_args(args).profile)
+        parsed = parser.parse_args(['-vv', '--profile-output=out.json', 'show', '--json'])
+        self.assertEqual((parsed.verbose, parsed.profile, parsed.profile_output), (2, False, 'out.json'))
+        # options of the GUI, the profiling ones are the same
+        for args in ([], ['--profile', '--profile-output', 'out.json'], ['--profile-output', 'show'],
+                     ['-d', '/dev/sda', 'show']):
+            self.assertFalse(cli.is_cli(args))
+
+    def test_no_gtk_import(self):
+        # in a new interpreter, as this module imports gi for the GUI tests
+        subprocess.run([sys.executable, '-c', "import sys, efiboots.cli; assert 'gi' not in sys.modules"],
+                       env={**os.environ, 'PYTHONPATH': os.pathsep.join(sys.path)}, check=True)
+
+
+class TestEspDetection(unittest.TestCase):
+    def test_read_mountinfo(self):
+        with tempfile.NamedTemporaryFile('w') as mountinfo:
+            mountinfo.write('26 1 259:2 / / rw,relatime shared:1 - ext4 /dev/nvme0n1p2 rw\n'
+                            '45 26 259:1 / /boot/efi rw,relatime shared:28 - vfat /dev/nvme0n1p1 rw,fmask=0022\n'
+                            '46 26 8:1 / /mnt/my\\040disk rw,relatime shared:29 - vfat /dev/sda1 rw\n')
+            mountinfo.flush()
+            mounts = esp.read_mountinfo(mountinfo.name)
+        self.assertTupleEqual(mounts['/boot/efi'], ('/dev/nvme0n1p1', 'vfat'))
+        self.assertTupleEqual(mounts['/mnt/my disk'], ('/dev/sda1', 'vfat'))
+
+    def test_choose_esp(self):
+        mounts = {'/': ('/dev/sda2', 'ext4'), '/boot': ('/dev/sda3', 'ext4'), '/boot/efi': ('/dev/sda1', 'vfat')}
+        self.assertTupleEqual(esp.choose_esp(mounts, ['/dev/sda1', '/dev/sdb1']), ('/dev/sda', '1'))
+        self.assertTupleEqual(esp.choose_esp({}, ['/dev/mmcblk0p1']), ('/dev/mmcblk0', '1'))
+        self.assertTupleEqual(esp.choose_esp({}, []), (None, None))
+        with self.assertRaises(esp.MultipleEspsError):
+            esp.choose_esp({'/boot': ('/dev/sda3', 'ext4')}, ['/dev/sda1', '/dev/sdb1'])
+
+    def test_scan_with_commands(self):
+        outputs = {'findmnt': '{"filesystems": [{"source": "/dev/sda1", "target": "/boot/efi", "fstype": "vfat"}]}',
+                   'lsblk': '{"blockdevices": [{"name": "/dev/sda", "children": [{"name": "/dev/sda1", "fstype": '
+                            '"vfat", "parttype": "c12a7328-f81f-11d2-ba4b-00a0c93ec93b"}]}]}'}
+        with mock.patch.object(esp, 'subprocess_run_wrapper', side_effect=lambda cmd, cancel: outputs[cmd[0]]):
+            self.assertTupleEqual(esp.scan_with_commands(), ({'/boot/efi': ('/dev/sda1', 'vfat')}, ['/dev/sda1']))
+            # unexpected outputs are taken as no ESP found
+            outputs = {'findmnt': 'findmnt: unknown column', 'lsblk': '{"devices": []}'}
+            self.assertTupleEqual(esp.scan_with_commands(), ({}, []))
+
+
+class TestSystemCache(unittest.TestCase):
+    def test_esp_fingerprint(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            mountinfo = os.path.join(tmp, 'mountinfo')
+            by_partuuid = os.path.join(tmp, 'by-partuuid')
+            os.mkdir(by_partuuid)
+            os.symlink('../../sda1', os.path.join(by_partuuid, '1234abcd-01'))
+            Path(mountinfo).write_text('45 26 8:1 / /boot/efi rw - vfat /dev/sda1 rw\n')
+            fingerprint = cache.esp_fingerprint(mountinfo, by_partuuid)
+
+            Path(mountinfo).write_text('47 26 8:1 / /boot/efi rw - vfat /dev/sda1 rw\n'
+                                       '46 26 8:17 / /mnt/usb rw - vfat /dev/sdb1 rw\n')
+            self.assertEqual(cache.esp_fingerprint(mountinfo, by_partuuid), fingerprint)
+
+            os.symlink('../../sdb1', os.path.join(by_partuuid, '5678abcd-01'))
+            self.assertNotEqual(cache.esp_fingerprint(mountinfo, by_partuuid), fingerprint)
+
+    def test_invalidation(self):
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(cache, 'esp_fingerprint', return_value='a'):
+            path = os.path.join(tmp, 'efiboots', 'system.json')
+            system_cache = cache.SystemCache(path)
+            system_cache.enabled = True
+            system_cache.set_esp('/dev/sda', '1')
+
+            reloaded = cache.SystemCache(path)
+            reloaded.enabled = True
+            self.assertTupleEqual(reloaded.get_esp(), ('/dev/sda', '1'))
+
+            cache.esp_fingerprint.return_value = 'b'
+            self.assertIsNone(reloaded.get_esp())
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.efivars_dir = tempfile.mkdtemp()
+        shutil.copytree(test_dir / 'efivars', self.efivars_dir, dirs_exist_ok=True)
+        self.efivarfs = Efivarfs(self.efivars_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.efivars_dir)
+
+    def test_round_trip(self):
+        taken = Snapshot.capture(self.efivarfs, label='before rollout')
+        self.assertNotIn('BootCurrent', taken.variables)
+        self.assertIn('Boot0007', taken.variables)
+        loaded = Snapshot.from_bytes(taken.to_bytes())
+        self.assertEqual(loaded, taken)
+        self.assertEqual(loaded.digest, Snapshot.capture(self.efivarfs).digest)
+        self.assertListEqual(loaded.to_parsed().boot_order, EfibootmgrEfivarfs(self.efivarfs).parse(
+            self.efivarfs.read_boot_variables()).boot_order)
+
+        data = bytearray(taken.to_bytes())
+        data[-1] ^= 0xff
+        with self.assertRaises(ValueError):
+            Snapshot.from_bytes(bytes(data))
+        with self.assertRaises(ValueError):
+            Snapshot.from_bytes(taken.to_bytes()[:-3])
+
+    def test_restore(self):
+        taken = Snapshot.capture(self.efivarfs)
+        boot0001, _ = self.efivarfs.read('Boot0001')
+        self.efivarfs.apply([('Boot0001', set_load_option_active(boot0001, False)), ('Boot0005', None),
+                             ('Boot0009', boot0001), ('BootNext', encode_boot_num('0003'))])
+        live = Snapshot.capture(self.efivarfs)
+        self.assertEqual(taken.format_diff(live).splitlines(),
+                         ['+Boot0005 (UEFI OS)', '-Boot0009 (rEFInd Boot Manager)', '-BootNext',
+                          '~Boot0001 (rEFInd Boot Manager)'])
+
+        plan = taken.restore_plan(live)
+        self.assertListEqual([str(write) for write in plan.writes],
+                             [f'write Boot0001 ({len(boot0001)} bytes)',
+                              f'write Boot0005 ({len(taken.variables["Boot0005"].data)} bytes)',
+                              'delete BootNext', 'delete Boot0009'])
+        self.efivarfs.apply([(write.name, write.data, write.attributes) for write in plan.writes])
+        self.assertFalse(taken.diff(Snapshot.capture(self.efivarfs)))
+
+    def test_store(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SnapshotStore(tmp, keep=2)
+            first = store.capture(self.efivarfs)
+            self.assertEqual(store.capture(self.efivarfs), first)
+            self.efivarfs.apply([('Timeout', encode_timeout(7))])
+            second = store.add(Snapshot.capture(self.efivarfs))
+            self.efivarfs.apply([('Timeout', encode_timeout(8))])
+            third = store.add(Snapshot.capture(self.efivarfs, 'third'))
+            self.assertListEqual(store.list(), sorted([second, third]))
+            self.assertEqual(Snapshot.load(third).label, 'third')
+
+
+class TestTransaction(unittest.TestCase):
+    def setUp(self):
+        self.efivars_dir = tempfile.mkdtemp()
+        shutil.copytree(test_dir / 'efivars', self.efivars_dir, dirs_exist_ok=True)
+        self.efivarfs = Efivarfs(self.efivars_dir)
+        boot0001, _ = self.efivarfs.read('Boot0001')
+        # deliberately out of dependency order
+        self.plan = NvramPlan([VariableWrite('Boot0005', None), VariableWrite('BootOrder', encode_boot_order(['0009'])),
+                               VariableWrite('Boot0009', boot0001), VariableWrite('Timeout', encode_timeout(5))])
+        self.before = Snapshot.capture(self.efivarfs)
+        self.written = []
+
+    def tearDown(self):
+        shutil.rmtree(self.efivars_dir)
+
+    def write(self, plan: NvramPlan):
+        self.written.append([write.name for write in plan.writes])
+        self.efivarfs.apply([(write.name, write.data, write.attributes) for write in plan.writes])
+
+    def test_apply(self):
+        report = Transaction(self.efivarfs, self.write).apply(self.plan)
+        self.assertListEqual(self.written, [['Boot0009', 'BootOrder', 'Timeout', 'Boot0005']])
+        self.assertListEqual([step.name for step in report.steps], ['snapshot', 'apply', 'verify'])
+        self.assertFalse(report.mismatches)
+        self.assertEqual(Snapshot.capture(self.efivarfs).to_parsed().boot_order, ['0009'])
+
+    def test_rollback(self):
+        def write_wrong_timeout(plan: NvramPlan):
+            first = not self.written
+            self.write(plan)
+            if first:
+                self.efivarfs.write('Timeout', encode_timeout(7))
+
+        with self.assertRaises(TransactionError) as raised:
+            Transaction(self.efivarfs, write_wrong_timeout).apply(self.plan)
+        report = raised.exception.report
+        self.assertListEqual(report.mismatches, ['Timeout'])
+        # BootOrder and Timeout are rewritten, Boot0005 recreated and Boot0009 deleted
+        self.assertListEqual(self.written[1], ['Boot0005', 'BootOrder', 'Timeout', 'Boot0009'])
+        self.assertListEqual(report.rollback_mismatches, [])
+        self.assertListEqual([step.name for step in report.steps],
+                             ['snapshot', 'apply', 'verify', 'readback', 'rollback', 'verify rollback'])
+        self.assertFalse(Snapshot.capture(self.efivarfs).diff(self.before))
+
+    def test_failed_write(self):
+        def write_first(plan: NvramPlan):
+            self.write(NvramPlan(plan.writes[:1]))
+            raise OSError("write failed")
+
+        with self.assertRaises(TransactionError) as raised:
+            Transaction(self.efivarfs, write_first).apply(self.plan)
+        self.assertIsInstance(raised.exception.__cause__, OSError)
+        self.assertListEqual(raised.exception.report.rollback_mismatches, [])
+        # only the variable written before the failure is deleted again
+        self.assertListEqual(self.written, [['Boot0009'], ['Boot0009']])
+        self.assertFalse(Snapshot.capture(self.efivarfs).diff(self.before))
+
+    def test_cancelled_write(self):
+        def cancelled(plan: NvramPlan):
+            self.write(NvramPlan(plan.writes[:2]))
+            raise OperationCancelled("pkexec killed")
+
+        def rollback(plan: NvramPlan):
+            self.written.append(['rollback'] + [write.name for write in plan.writes])
+            self.efivarfs.apply([(write.name, write.data, write.attributes) for write in plan.writes])
+
+        with self.assertRaises(TransactionError) as raised:
+            Transaction(self.efivarfs, cancelled, rollback).apply(self.plan)
+        self.assertIsInstance(raised.exception.__cause__, OperationCancelled)
+        self.assertListEqual(self.written, [['Boot0009', 'BootOrder'], ['rollback', 'BootOrder', 'Boot0009']])
+        self.assertFalse(Snapshot.capture(self.efivarfs).diff(self.before))
+
+    def test_nothing_written(self):
+        def refused(plan: NvramPlan):
+            raise PermissionError("not authorized")
+
+        with self.assertRaises(PermissionError):
+            Transaction(self.efivarfs, refused).apply(self.plan)
+
+
+class FakeInvocation:
+    """Records the answer of the helper to a method call"""
+    def __init__(self):
+        self.error = None
+        self.value = None
+        self.answered = False
+
+    def get_message(self):
+        return self
+
+    def get_flags(self):
+        return Gio.DBusMessageFlags.ALLOW_INTERACTIVE_AUTHORIZATION
+
+    def return_dbus_error(self, name: str, message: str):
+        self.error = name
+        self.answered = True
+
+    def return_value(self, value):
+        self.value = value
+        self.answered = True
+
+
+@unittest.skipIf(helper is None, "PyGObject is not installed")
+class TestHelper(unittest.TestCase):
+    def setUp(self):
+        self.efivars_dir = tempfile.mkdtemp()
+        shutil.copytree(test_dir / 'efivars', self.efivars_dir, dirs_exist_ok=True)
+        self.efivarfs = Efivarfs(self.efivars_dir)
+        self.service = helper.HelperService(self.efivarfs, None)
+        # polkit callbacks, answered by the tests
+        self.polkit = []
+        self.service.check_authorization = lambda sender, interactive, callback: self.polkit.append(callback)
+
+    def tearDown(self):
+        if self.service.idle_id is not None:
+            GLib.source_remove(self.service.idle_id)
+        shutil.rmtree(self.efivars_dir)
+
+    def call(self, sender: str, method: str, parameters=None) -> FakeInvocation:
+        invocation = FakeInvocation()
+        self.service.on_method_call(None, sender, helper.OBJECT_PATH, helper.INTERFACE, method,
+                                    parameters if parameters is not None else GLib.Variant('()', ()), invocation)
+        return invocation
+
+    def disconnect(self, sender: str):
+        self.service.on_name_owner_changed(None, 'org.freedesktop.DBus', '/org/freedesktop/DBus',
+                                           'org.freedesktop.DBus', 'NameOwnerChanged',
+                                           GLib.Variant('(sss)', (sender, sender, '')))
+
+    def test_authorization_cached(self):
+        invocation = self.call(':1.5', 'SetTimeout', GLib.Variant('(q)', (4,)))
+        self.assertFalse(invocation.answered)
+        self.polkit.pop()(True, False, None)
+        self.assertTrue(invocation.answered)
+        self.assertIsNone(invocation.error)
+        self.assertEqual(self.efivarfs.read('Timeout')[0], encode_timeout(4))
+
+        self.assertIsNone(self.call(':1.5', 'SetTimeout', GLib.Variant('(q)', (6,))).error)
+        self.assertFalse(self.polkit)
+        self.assertEqual(self.efivarfs.read('Timeout')[0], encode_timeout(6))
+        # another client is authorized on its own
+        self.assertFalse(self.call(':1.6', 'ClearBootNext').answered)
+        self.assertEqual(len(self.polkit), 1)
+
+    def test_not_authorized(self):
+        invocation = self.call(':1.5', 'SetTimeout', GLib.Variant('(q)', (4,)))
+        self.polkit.pop()(False, False, None)
+        self.assertEqual(invocation.error, helper.ERROR_NOT_AUTHORIZED)
+        invocation = self.call(':1.5', 'SetTimeout', GLib.Variant('(q)', (4,)))
+        self.polkit.pop()(False, True, None)
+        self.assertEqual(invocation.error, helper.ERROR_INTERACTIVE_AUTHORIZATION_REQUIRED)
+        self.assertEqual(self.efivarfs.read('Timeout')[0], encode_timeout(1))
+        self.assertFalse(self.service.authorized)
+
+    def test_disconnect(self):
+        self.call(':1.5', 'ClearBootNext')
+        self.polkit.pop()(True, False, None)
+        self.assertSetEqual(self.service.authorized, {':1.5'})
+        self.disconnect(':1.5')
+        self.assertFalse(self.service.authorized)
+        self.call(':1.5', 'ClearBootNext')
+        self.assertEqual(len(self.polkit), 1)
+
+        # polkit answers after the client disconnected
+        self.disconnect(':1.5')
+        self.polkit.pop()(True, False, None)
+        self.assertFalse(self.service.authorized)
+
+    def test_apply_batch_refuses_other_variables(self):
+        boot0001, _ = self.efivarfs.read('Boot0001')
+        writes = [('Boot0009', boot0001, 7), ('PK', b'key', 7)]
+        invocation = self.call(':1.5', 'ApplyBatch', GLib.Variant('(a(sayu)b)', (writes, False)))
+        self.polkit.pop()(True, False, None)
+        self.assertEqual(invocation.error, helper.ERROR_INVALID_ARGUMENTS)
+        self.assertIsNone(self.efivarfs.read('Boot0009')[0])
+
+    def test_unexpected_error(self):
+        self.efivarfs.write('Boot0001', b'\x01')
+        invocation = self.call(':1.5', 'SetActive', GLib.Variant('(qb)', (1, False)))
+        self.polkit.pop()(True, False, None)
+        self.assertEqual(invocation.error, helper.ERROR_FAILED)
+
+    def test_client_errors(self):
+        client = helper.HelperClient.__new__(helper.HelperClient)
+        client.connection = mock.Mock()
+        for error, exception in (('org.freedesktop.DBus.Error.ServiceUnknown', helper.HelperUnavailable),
+                                 (helper.ERROR_INTERACTIVE_AUTHORIZATION_REQUIRED,
+                                  helper.InteractiveAuthorizationRequired),
+                                 (helper.ERROR_NOT_AUTHORIZED, PermissionError),
+                                 (helper.ERROR_INVALID_ARGUMENTS, ValueError),
+                                 (helper.ERROR_FAILED, OSError)):
+            client.connection.call_sync.side_effect = Gio.DBusError.new_for_dbus_error(error, "message")
+            with self.assertRaises(exception):
+                client.call('ClearBootNext')
+
+
+@unittest.skipIf(liststore is None, "PyGObject or GTK 4 is not installed")
+class TestListStore(unittest.TestCase):
+    def setUp(self):
+        efibootmgr = EfibootmgrEfivarfs(Efivarfs(str(test_dir / 'efivars')))
+        self.parsed = efibootmgr.parse(efibootmgr.run())
+        self.store = liststore.EfibootsListStore(mock.Mock())
+        self.changes = []
+        self.store.connect('items-changed', lambda store, position, removed, added:
+                           self.changes.append((position, removed, added)))
+        self.store.load(self.parsed)
+
+    def rows(self) -> list:
+        return [self.store.get_item(position) for position in range(self.store.get_n_items())]
+
+    def test_rows_on_demand(self):
+        self.assertListEqual(self.changes, [(0, 0, 7)])
+        self.assertFalse(self.store.rows)
+        row = self.store.get_item(1)
+        self.assertEqual(row.num, '0007')
+        self.assertIs(self.store.get_item(1), row)
+        self.assertListEqual(list(self.store.rows), ['0007'])
+        self.assertIsNone(self.store.get_item(7))
+
+    def test_move_and_remove(self):
+        rows = self.rows()
+        self.assertEqual(self.store.move(1, 1), 2)
+        self.assertEqual(self.changes[-1], (1, 2, 2))
+        self.assertListEqual(self.rows(), [rows[0], rows[2], rows[1]] + rows[3:])
+        self.assertListEqual(self.store.state.boot_order, ['0001', '0003', '0007', '0005', '0000', '0002', '0004'])
+        # already the first one
+        self.assertEqual(self.store.move(0, -1), 0)
+        self.assertEqual(len(self.changes), 2)
+
+        self.store.remove(3)
+        self.assertEqual(self.changes[-1], (3, 1, 0))
+        self.assertNotIn('0005', self.store.rows)
+        self.assertListEqual(self.rows(), [rows[0], rows[2], rows[1]] + rows[4:])
+
+    def test_reload(self):
+        rows = self.rows()
+        changed = copy.deepcopy(self.parsed)
+        changed.entries[2].active = not changed.entries[2].active
+        self.store.load(changed)
+        # same order: only the row of the changed entry is reported and made again
+        self.assertEqual(self.changes[-1], (self.store.index_num(changed.entries[2].num), 1, 1))
+        reloaded = self.rows()
+        self.assertListEqual([new is old for new, old in zip(reloaded, rows)],
+                             [row.num != changed.entries[2].num for row in rows])
+
+        changed.entries.pop(0)
+        changed.boot_order = [num for num in changed.boot_order if num != self.parsed.entries[0].num]
+        self.store.load(changed)
+        self.assertEqual(self.changes[-1], (0, 7, 6))
+        # the row of the deleted entry is dropped, the others are reused
+        self.assertNotIn(self.parsed.entries[0].num, self.store.rows)
+        self.assertTrue(all(row in reloaded for row in self.rows()))
+
+    def test_disk(self):
+        guid = 'fda4f976-b250-4569-be80-0449804ab7c2'
+        self.store.partitions = partitions.PartitionResolver({guid: partitions.PartitionInfo('/dev/sda1', '/dev/sda')})
+        self.assertEqual(self.store.get_item(0).disk, '/dev/sda1')
+        self.assertEqual(self.store.get_item(4).disk, '')
+        self.store.partitions._partitions = {}
+        self.assertEqual(self.store.get_item(0).disk, f"Partition {guid} not found")
+        # only the rows of the entries on a partition are reported
+        del self.changes[:]
+        self.store.reload_partitions()
+        self.assertListEqual(sorted(self.changes), [(0, 1, 1), (1, 1, 1), (2, 1, 1), (3, 1, 1)])
+
+    def test_merge(self):
+        rows = self.rows()
+        remote = copy.deepcopy(self.parsed)
+        remote.entries[1].name = 'rEFInd'
+        result = self.store.merge(remote)
+        self.assertListEqual(result.changed, ['0001'])
+        self.assertEqual(self.changes[-1], (0, 1, 1))
+        self.assertIsNot(self.store.get_item(0), rows[0])
+        self.assertEqual(self.store.get_item(0).name, 'rEFInd')
+        self.assertListEqual(self.rows()[1:], rows[1:])
+
+        remote = copy.deepcopy(remote)
+        remote.boot_order = list(reversed(remote.boot_order))
+        self.store.merge(remote)
+        self.assertEqual(self.changes[-1], (0, 7, 7))
+        self.assertListEqual([row.num for row in self.rows()], remote.boot_order)
+
+
+class TestSnapshotArchive(unittest.TestCase):
+    def test_deduplication(self):
+        taken = Snapshot.capture(Efivarfs(str(test_dir / 'efivars')))
+        with tempfile.TemporaryDirectory() as tmp:
+            archive = SnapshotArchive(tmp)
+            snapshots = [Snapshot(dict(taken.variables, Timeout=SnapshotVariable(7, encode_timeout(i % 5))),
+                                  label=f'rollout {i}', host=f'host{i:02d}') for i in range(20)]
+            digests = archive.add_many(snapshots)
+            self.assertEqual(len(set(digests)), 5)
+            self.assertEqual(archive.add(snapshots[-1]), digests[-1])
+            self.assertEqual(len(archive.history('host19')), 1)
+
+            entries = [name for name in taken.variables if name.startswith('Boot0')]
+            self.assertEqual(len(archive.index), len(entries))
+            self.assertEqual(sum(len(files) for _, _, files in os.walk(os.path.join(tmp, 'blobs'))), len(entries))
+            self.assertEqual(sum(len(files) for _, _, files in os.walk(os.path.join(tmp, 'configs'))), 5)
+            self.assertListEqual(archive.hosts(), [f'host{i:02d}' for i in range(20)])
+            self.assertEqual(archive.latest('host07'), snapshots[7])
+
+            digest = blob_hash(taken.variables['Boot0003'].data)
+            self.assertListEqual(archive.find_blobs(digest[:8]), [digest])
+            self.assertListEqual(archive.hosts_with(digest), archive.hosts())
+            self.assertEqual(archive.describe_blob(digest), 'Windows Boot Manager\t\\EFI\\Microsoft\\Boot\\bootmgfw.efi')
+            index = archive.index
+            archive.rebuild_index()
+            self.assertDictEqual(archive.index, index)
+
+            with open(archive.blob_path(digest), 'ab') as f:
+                f.write(b'\x00')
+            with self.assertRaises(ValueError):
+                archive.latest('host00')
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.efibootmgr = EfibootmgrEfivarfs(Efivarfs(str(test_dir / 'efivars')))
+        self.parsed = self.efibootmgr.parse(self.efibootmgr.run())
+
+    def test_round_trip(self):
+        self.assertEqual(export.load_json(export.dump_json(self.parsed)), self.parsed)
+        self.assertEqual(export.loads(export.dump_binary(self.parsed)), self.parsed)
+        loaded = export.loads(export.dump_json(self.parsed).encode())
+        self.assertListEqual([entry.raw for entry in loaded.entries], [entry.raw for entry in self.parsed.entries])
+        self.assertListEqual([entry.partition for entry in loaded.entries],
+                             [entry.partition for entry in self.parsed.entries])
+        self.parsed.boot_next = None
+        self.parsed.timeout = None
+        self.assertEqual(export.load_binary(export.dump_binary(self.parsed)), self.parsed)
+
+    def test_invalid(self):
+        exported = export.to_dict(self.parsed)
+        for broken in ({**exported, 'version': export.SCHEMA_VERSION + 1}, {**exported, 'boot_order': ['1']},
+                       {**exported, 'timeout': -1}, {**exported, 'entries': [{'num': '0001'}]}, []):
+            with self.assertRaises(ValueError):
+                export.from_dict(broken)
+        with self.assertRaises(ValueError):
+            export.load_binary(export.dump_binary(self.parsed)[:-1])
+        with self.assertRaises(ValueError):
+            export.loads(b'{}')
+
+    def test_import_state(self):
+        imported = copy.deepcopy(self.parsed)
+        refind = next(entry for entry in imported.entries if entry.num == '0001')
+        # the same entry under another number on the machine it was exported from
+        refind.num = '0010'
+        imported.entries.append(ParsedEfibootmgrEntry(num='0011', active=True, name='Other', path='\\other.efi',
+                                                      parameters='', raw=refind.raw))
+        imported.entries = [entry for entry in imported.entries if entry.num != '0002']
+        imported.boot_order = ['0011', '0010', '0007']
+        imported.boot_next = '0011'
+
+        model = BootModel()
+        model.load(self.parsed)
+        model.import_state(imported)
+        self.assertListEqual(model.boot_order, ['NEW0', '0001', '0007'])
+        changes = model.changes()
+        self.assertEqual(changes.create[0].num, '0006')
+        self.assertListEqual(changes.delete, ['0002'])
+        self.assertEqual(changes.boot_next, '0006')
+        plan = plan_writes(self.parsed, changes, None, None)
+        self.assertEqual(plan.writes[0].data, refind.raw)
+
+        model.import_state(self.parsed)
+        self.assertFalse(model.pending_changes())
+
+
+class TestProfiler(unittest.TestCase):
+    def tearDown(self):
+        profiler.enabled = False
+        profiler.clear()
+
+    def test_disabled(self):
+        disabled = Profiler()
+        with disabled.span('parse') as span:
+            span.add(bytes=1)
+        disabled.count('writes')
+        self.assertListEqual(disabled.spans, [])
+        self.assertDictEqual(disabled.counters, {})
+
+    def test_spans(self):
+        profiler.enable()
+        efibootmgr = EfibootmgrEfivarfs(Efivarfs(str(test_dir / 'efivars')))
+        efibootmgr.parse(efibootmgr.run())
+        self.assertEqual(subprocess_run_wrapper(['echo', 'efiboots']), 'efiboots\n')
+        with self.assertRaises(ValueError):
+            with profiler.span('failing'):
+                raise ValueError()
+        profiler.count('writes', 2)
+        profiler.count('writes')
+
+        stats = profiler.stats()
+        self.assertListEqual(sorted(stats), ['failing', 'parse', 'read efivarfs', 'run echo'])
+        self.assertEqual(stats['run echo'].bytes, len('efiboots\n'))
+        self.assertEqual(stats['read efivarfs'].bytes, sum(
+            len(data) for _, data in efibootmgr.efivarfs.read_boot_variables()))
+        exported = profiler.to_dict()
+        self.assertDictEqual(exported['counters'], {'writes': 3})
+        self.assertEqual(exported['spans'][-1]['args'], {'error': 'ValueError'})
+
+        trace = profiler.to_chrome_trace()['traceEvents']
+        self.assertListEqual([event['ph'] for event in trace], ['X'] * 4 + ['C'])
+        self.assertTrue(all(event['dur'] >= 0 for event in trace[:4]))
+        self.assertIn('read efivarfs', profiler.summary())
+
+
+class TestFleet(unittest.TestCase):
+    def test_analyze(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            dumps = os.path.join(tmp, 'dumps')
+            os.makedirs(os.path.join(dumps, 'rack1'))
+            for name in ('myinput', 'input5', 'mycraftedinput2'):
+                shutil.copy(test_dir / f'{name}.test', os.path.join(dumps, 'rack1', f'{name}.txt'))
+            efibootmgr = EfibootmgrEfivarfs(Efivarfs(str(test_dir / 'efivars')))
+            parsed = efibootmgr.parse(efibootmgr.run())
+            parsed.entries.append(copy.copy(parsed.entries[1]))
+            parsed.entries[-1].num = '0010'
+            export.save(parsed, os.path.join(dumps, 'exported.bin'))
+            Path(dumps, 'garbage.txt').write_text("not a dump\n")
+
+            summary = fleet.analyze_fleet(dumps, jobs=1)
+            self.assertListEqual(summary.host, ['exported', 'garbage', 'input5', 'mycraftedinput2', 'myinput'])
+            self.assertListEqual(summary.entries, [8, 0, 9, 7, 7])
+            self.assertListEqual(summary.duplicates, [['\\efi\\refind\\refind_x64.efi'], [], [], [], []])
+            self.assertListEqual(summary.orphans, [[], [], [], ['000A'], []])
+            self.assertListEqual(summary.current_first, [True, True, False, True, True])
+            self.assertListEqual([bool(error) for error in summary.error], [False, True, False, False, False])
+            self.assertDictEqual(summary.totals(), {'entries': 31, 'errors': 1, 'with_duplicates': 1,
+                                                    'with_orphans': 1, 'current_not_first': 1})
+            self.assertEqual(summary.loaders['\\efi\\refind\\refind_x64.efi'], 3)
+            problems = summary.format(only_problems=True).splitlines()
+            self.assertListEqual([line.split('\t')[0] for line in problems[1:5]],
+                                 ['exported', 'garbage', 'input5', 'mycraftedinput2'])
+            self.assertEqual(problems[5], '')
+
+            archive = os.path.join(tmp, 'dumps.tar.gz')
+            with tarfile.open(archive, 'w:gz') as tar:
+                tar.add(dumps, arcname='dumps')
+            self.assertDictEqual(fleet.analyze_fleet(archive, jobs=2).to_dict(), summary.to_dict())
+            with self.assertRaises(ValueError):
+                fleet.analyze_fleet(os.path.join(dumps, 'garbage.txt'))
+
+    def test_host_name(self):
+        self.assertEqual(fleet.host_name('dumps/web01.example.com.txt'), 'web01.example.com')
+        self.assertEqual(fleet.host_name('dumps/web02.example.com.bin'), 'web02.example.com')
+        self.assertEqual(fleet.host_name('web03'), 'web03')
+
+
+def fat_dir_entry(name: str, short: bytes, attributes: int, cluster: int) -> bytes:
+    """A directory entry, preceded by long file name entries if name is not the 8.3 one"""
+    entries = b''
+    if name != fat.short_name(short):
+        chars = (name + '\0').encode('utf-16-le')
+        chars += b'\xff' * (-len(chars) % 26)
+        parts = [chars[start:start + 26] for start in range(0, len(chars), 26)]
+        for seq in range(len(parts), 0, -1):
+            part = parts[seq - 1]
+            entries += bytes([seq | (fat.LAST_LONG_ENTRY if seq == len(parts) else 0)]) + part[:10] + \
+                bytes([fat.ATTR_LONG_NAME, 0, fat.short_name_checksum(short)]) + part[10:22] + bytes(2) + part[22:]
+    return entries + short + bytes([attributes]) + bytes(8) + bytes(2) + bytes(4) + struct.pack('<HI', cluster, 0)
+
+
+def make_fat12_image(path: str):
+    """A 32 KiB FAT12 image with \\EFI\\BOOT\\BOOTX64.EFI and \\EFI\\refind\\refind_x64.efi"""
+    boot_sector = bytearray(512)
+    struct.pack_into('<HBHBHHBH', boot_sector, 11, 512, 1, 1, 1, 16, 64, 0xf8, 1)
+    boot_sector[510:512] = b'\x55\xaa'
+    # clusters 0 and 1 are reserved, 2 to 6 are the last of their chain
+    values = [0xff8, 0xfff] + [0xfff] * 5 + [0]
+    fat_sector = bytearray(512)
+    for index in range(0, len(values), 2):
+        packed = values[index] | values[index + 1] << 12
+        fat_sector[index * 3 // 2:index * 3 // 2 + 3] = packed.to_bytes(3, 'little')
+    directory = fat.ATTR_DIRECTORY
+    dots = fat_dir_entry('.', b'.          ', directory, 0) + fat_dir_entry('..', b'..         ', directory, 0)
+    clusters = [
+        # root directory
+        b'\xe5' + bytes(31) + fat_dir_entry('EFI', b'EFI        ', directory, 2),
+        dots + fat_dir_entry('BOOT', b'BOOT       ', directory, 3) +
+        fat_dir_entry('refind', b'REFIND     ', directory, 4),
+        dots + fat_dir_entry('BOOTX64.EFI', b'BOOTX64 EFI', 0x20, 5),
+        dots + fat_dir_entry('refind_x64.efi', b'REFIND~1EFI', 0x20, 6),
+    ]
+    with open(path, 'wb') as f:
+        f.write(boot_sector + fat_sector)
+        for data in clusters:
+            f.write(data.ljust(512, b'\0'))
+        f.truncate(64 * 512)
+
+
+class TestIntegrity(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.image = os.path.join(self.tmp, 'esp.img')
+        make_fat12_image(self.image)
+        efibootmgr = EfibootmgrEfivarfs(Efivarfs(str(test_dir / 'efivars')))
+        self.parsed = efibootmgr.parse(efibootmgr.run())
+        refind = copy.copy(self.parsed.entries[1])
+        refind.num = '0010'
+        self.parsed.entries.append(refind)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_fat(self):
+        with open(self.image, 'rb') as f:
+            self.assertListEqual(fat.FatFileSystem(f).walk(), ['\\EFI\\BOOT\\BOOTX64.EFI',
+                                                               '\\EFI\\refind\\refind_x64.efi'])
+        with self.assertRaises(ValueError):
+            fat.FatFileSystem(open(test_dir / 'myinput.test', 'rb'))
+
+    def test_check(self):
+        guid = 'fda4f976-b250-4569-be80-0449804ab7c2'
+        checker = IntegrityChecker(guids={guid: self.image}, mounts={})
+        issues = checker.check(self.parsed)
+        self.assertListEqual([(issue.num, issue.kind) for issue in issues],
+                             [('0003', MISSING), ('0007', MISSING), ('0010', DUPLICATE)])
+        self.assertEqual(len(checker.indexes[self.image]), 2)
+
+        # mounted, the tree is walked instead
+        Path(self.tmp, 'mnt', 'efi', 'manjaro').mkdir(parents=True)
+        Path(self.tmp, 'mnt', 'efi', 'manjaro', 'grubx64.efi').touch()
+        checker = IntegrityChecker(guids={guid: '/dev/sda1'},
+                                   mounts={os.path.join(self.tmp, 'mnt'): ('/dev/sda1', 'vfat')})
+        self.assertListEqual([(issue.num, issue.kind) for issue in checker.check(self.parsed)],
+                             [('0001', MISSING), ('0003', MISSING), ('0005', MISSING), ('0010', DUPLICATE),
+                              ('0010', MISSING)])
+
+        self.assertSetEqual({issue.kind for issue in IntegrityChecker(guids={}, mounts={}).check(self.parsed)},
+                            {UNREACHABLE, DUPLICATE})
+        checker = IntegrityChecker(guids={guid: os.path.join(self.tmp, 'missing')}, mounts={})
+        self.assertEqual(checker.check(self.parsed)[0].kind, UNREADABLE)
+        # an unreadable partition table doesn't make every entry unreachable
+        with mock.patch.object(partitions.PartitionResolver, 'list', side_effect=OSError("Can't list partitions")):
+            with self.assertRaises(OSError):
+                IntegrityChecker(mounts={}).check(self.parsed)
+
+        # entries parsed from efibootmgr output carry their partition GUID too
+        text = EfibootmgrText.parse((test_dir / 'myinput.test').read_text().splitlines())
+        issues = IntegrityChecker(guids={guid: self.image}, mounts={}).check(text)
+        self.assertListEqual([issue.num for issue in issues], ['0003', '0007'])
+        # the ones without it are looked up on the given ESP
+        for entry in text.entries:
+            entry.partition = None
+        issues = IntegrityChecker(guids={}, mounts={}, esp=self.image).check(text)
+        self.assertListEqual([issue.num for issue in issues], ['0003', '0007'])
+
+
+class TestPartitions(unittest.TestCase):
+    guid = 'fda4f976-b250-4569-be80-0449804ab7c2'
+
+    def test_entry_partition(self):
+        text = EfibootmgrText.parse((test_dir / 'myinput.test').read_text().splitlines())
+        efibootmgr = EfibootmgrEfivarfs(Efivarfs(str(test_dir / 'efivars')))
+        parsed = efibootmgr.parse(efibootmgr.run())
+        for entries in (text.entries, parsed.entries):
+            self.assertEqual(entries[1].partition, self.guid)
+        self.assertIsNone(text.entries[0].partition)
+
+    def test_boot_model_partition(self):
+        efibootmgr = EfibootmgrEfivarfs(Efivarfs(str(test_dir / 'efivars')))
+        parsed = efibootmgr.parse(efibootmgr.run())
+        model = BootModel()
+        model.load(parsed)
+        for entry in parsed.entries:
+            self.assertEqual(model.entries[entry.num].partition, entry.partition)
+            self.assertIsNot(model.entries[entry.num], entry)
+        self.assertEqual(model.entries['0001'].partition, self.guid)
+
+    def test_read_partitions(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        dev = Path(tmp, 'dev')
+        by_partuuid = dev / 'disk' / 'by-partuuid'
+        by_partuuid.mkdir(parents=True)
+        sys_class_block = Path(tmp, 'sys', 'class', 'block')
+        sys_class_block.mkdir(parents=True)
+        disk = Path(tmp, 'sys', 'devices', 'nvme0n1')
+        (disk / 'device').mkdir(parents=True)
+        (disk / 'device' / 'model').write_text('Samsung SSD 980 PRO 1TB   \n')
+        (sys_class_block / 'nvme0n1').symlink_to(disk)
+        for name, guid in (('nvme0n1p1', self.guid.upper()), ('nvme0n1p2', '8b824cbb-3248-4aeb-8ca0-3073b5a41bc4')):
+            (disk / name).mkdir()
+            (sys_class_block / name).symlink_to(disk / name)
+            (dev / name).touch()
+            (by_partuuid / guid).symlink_to(dev / name)
+        mountinfo = Path(tmp, 'mountinfo')
+        mountinfo.write_text(f'36 1 259:1 / /boot/efi rw - vfat {dev}/nvme0n1p1 rw\n'
+                             f'37 1 259:1 / /efi rw - vfat {dev}/nvme0n1p1 rw\n')
+
+        found = partitions.read_partitions(str(by_partuuid), str(sys_class_block), str(mountinfo))
+        self.assertEqual(found[self.guid], partitions.PartitionInfo(str(dev / 'nvme0n1p1'), '/dev/nvme0n1',
+                                                                    'Samsung SSD 980 PRO 1TB', '/efi'))
+        self.assertEqual(str(found['8b824cbb-3248-4aeb-8ca0-3073b5a41bc4']),
+                         f'{dev}/nvme0n1p2 (Samsung SSD 980 PRO 1TB)')
+
+    def test_resolver(self):
+        partition = partitions.PartitionInfo('/dev/sda1', '/dev/sda')
+        resolver = partitions.PartitionResolver({self.guid: partition})
+        self.assertEqual(resolver.resolve(self.guid.upper()), partition)
+        self.assertIsNone(resolver.resolve(None))
+        self.assertDictEqual(resolver.devices(), {self.guid: '/dev/sda1'})
+        with mock.patch.object(resolver, 'list', return_value={}) as list_partitions:
+            self.assertEqual(resolver.resolve(self.guid), partition)
+            resolver.invalidate()
+            self.assertIsNone(resolver.resolve(self.guid))
+            self.assertIsNone(resolver.resolve(self.guid))
+            list_partitions.assert_called_once()
+            list_partitions.return_value = {self.guid: partition}
+            self.assertDictEqual(resolver.refresh(), {self.guid: partition})
+            self.assertEqual(resolver.resolve(self.guid), partition)
+            self.assertEqual(list_partitions.call_count, 2)
+            # the previous partitions are kept when they can't be listed again
+            list_partitions.side_effect = OSError("Can't list partitions")
+            self.assertDictEqual(resolver.refresh(), {self.guid: partition})
+            resolver.invalidate()
+            self.assertIsNone(resolver.resolve(self.guid))
+
+    def test_list_partitions(self):
+        output = ('{"blockdevices": [{"name": "/dev/sda", "model": "QEMU HARDDISK ", "children": '
+                  f'[{{"name": "/dev/sda1", "partuuid": "{self.guid.upper()}", "mountpoint": "/boot/efi"}}]}}]}}')
+        with mock.patch.object(partitions, 'subprocess_run_wrapper', return_value=output):
+            self.assertDictEqual(partitions.list_partitions(), {self.guid: partitions.PartitionInfo(
+                '/dev/sda1', '/dev/sda', 'QEMU HARDDISK', '/boot/efi')})
+        with mock.patch.object(partitions, 'subprocess_run_wrapper', return_value='{"devices": []}'):
+            with self.assertRaises(ValueError):
+                partitions.list_partitions()